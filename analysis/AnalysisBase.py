@@ -1,67 +1,207 @@
-import networkx as nx
+import unittest
+
+from analysis.profiler import stage
+from ir_graph import IrGraph
 
 
 class DiGraphAnalysisBase:
     def __init__(self):
-        self.ast: nx.DiGraph = nx.DiGraph()
+        self.ast: IrGraph = IrGraph()
+        self.scope = None
+        self.dead_nodes = []
+        # set by AnalysisManager when profiling
+        self.profiler = None
 
-    def is_entry(self, n: str):
+    def is_entry(self, n: int):
         return self.ast.in_degree[n] == 0
 
     def entries(self):
-        return list(filter(self.is_entry, self.ast.nodes))
-
-    def run(self, ast: nx.DiGraph):
-        assert isinstance(ast, nx.DiGraph)
+        if self.scope is None:
+            return list(filter(self.is_entry, self.ast.nodes))
+        return list(filter(self.is_entry, self.ancestors(self.scope)))
+
+    def ancestors(self, nodes):
+        visited = set(nodes)
+        worklist = list(visited)
+        while worklist:
+            for p in self.ast.predecessors(worklist.pop()):
+                if p not in visited:
+                    visited.add(p)
+                    worklist.append(p)
+        return visited
+
+    def run(self, ast: IrGraph, scope=None):
+        assert isinstance(ast, IrGraph)
         self.ast = ast
+        self.scope = scope
+
+    def stage(self, name):
+        # profiles a part of the pass on its own, e.g. `with self.stage(..):`
+        return stage(self.profiler, f'{type(self).__name__}.{name}', self.ast)
+
+    def config(self):
+        # everything besides the input graph the result of the pass depends on
+        return type(self).__name__,
 
     def node(self, n):
         return self.ast.nodes[n]
 
-    def is_op(self, n: str):
+    def is_op(self, n: int):
         return self.ast.nodes[n]['ntyp'] == 'op'
 
-    def is_const(self, n: str):
+    def is_const(self, n: int):
         return self.ast.nodes[n]['ntyp'] == 'c'
 
-    def is_constexpr(self, n: str):
+    def is_constexpr(self, n: int):
         return self.ast.nodes[n]['ntyp'] == 'ce'
 
-    def is_var(self, n: str):
+    def is_var(self, n: int):
         return self.ast.nodes[n]['ntyp'] == 'v'
 
-    def dfs(self, fn_visitor):
-        for entry in self.entries():
-            self.__dfs(entry, fn_visitor)
-
-    def __dfs(self, n, fn_visitor):
-        if not self.ast.has_node(n):
-            return
+    def post_order(self, roots=None, visited=None):
+        # Iterative dfs yielding every node once, after all of its
+        # successors. Successor lists are snapshot when a node is entered,
+        # and nodes removed by the caller in the meantime are skipped, so
+        # the graph may be changed between two steps.
+        roots = self.entries() if roots is None else roots
+        visited = set() if visited is None else visited
+        for root in roots:
+            if root in visited or not self.ast.has_node(root):
+                continue
+            visited.add(root)
+            stack = [(root, iter(list(self.ast.successors(root))))]
+            while stack:
+                n, succs = stack[-1]
+                for s in succs:
+                    if s not in visited and self.ast.has_node(s):
+                        visited.add(s)
+                        stack.append((s, iter(list(self.ast.successors(s)))))
+                        break
+                else:
+                    stack.pop()
+                    if self.ast.has_node(n):
+                        yield n
+
+    def traverse(self, fn_visitor, roots=None):
+        self.dead_nodes = []
+        for n in self.post_order(roots):
+            fn_visitor(n)
+        self.ast.remove_nodes_from(self.dead_nodes)
+        self.dead_nodes = []
+
+    def defer_remove(self, n):
+        # removed once the running traversal is over
+        self.dead_nodes.append(n)
 
-        successors = list(self.ast.successors(n))
-        if len(successors) == 0:
-            return
-
-        assert len(successors) == 1
-
-        if self.is_op(successors[0]):
-            op = successors[0]
-            opr_list = list(self.ast.successors(op))
-
-            for opr in opr_list:
-                self.__dfs(opr, fn_visitor)
+    def dfs(self, fn_visitor):
+        def visit(n):
+            if self.is_op(n) or self.ast.out_degree[n] != 1:
+                return
 
-            fn_visitor(n, op)
+            succ = next(self.ast.successors(n))
+            if self.is_op(succ):
+                fn_visitor(n, succ)
+            elif self.is_var(succ):
+                fn_visitor(n, None)
 
-        elif self.is_var(successors[0]):
-            var = successors[0]
-            self.__dfs(var, fn_visitor)
-            fn_visitor(n, None)
+        self.traverse(visit)
 
     def merge_node(self, n, dead_n):
-        in_edges = [(p, n) for p in self.ast.predecessors(dead_n)]
-        out_edges = [(n, s) for s in self.ast.successors(dead_n)]
-
-        self.ast.add_edges_from(in_edges + out_edges)
-        self.ast.remove_edge(n, n)
-        self.ast.remove_node(dead_n)
+        self.ast.merge_node(n, dead_n)
+
+    def unlink(self, n, opr):
+        # drop the edge n->opr, and opr with its operand tree once nothing
+        # else uses it, operands may be shared after value numbering
+        self.ast.remove_edge(n, opr)
+        self.drop_unused([opr])
+
+    def drop_unused(self, nodes):
+        # nodes nothing uses anymore go with their operand trees, except
+        # for vars and constant expressions
+        worklist = list(nodes)
+        while worklist:
+            curr = worklist.pop()
+            if not self.ast.has_node(curr) or self.ast.in_degree[curr] > 0:
+                continue
+            if self.is_var(curr) or self.is_constexpr(curr):
+                continue
+            worklist.extend(self.ast.successors(curr))
+            self.ast.remove_node(curr)
+
+
+def const_value(label: str):
+    if label.lstrip('-').startswith('0x'):
+        return int(label, 16)
+    return int(label)
+
+
+def bit_width(typ, default=64):
+    if typ and typ.startswith('i') and typ[1:].isdigit():
+        return int(typ[1:])
+    return default
+
+
+def bit_mask(width: int):
+    return (1 << width) - 1
+
+
+def node_width(ast: IrGraph, n: int):
+    # explicit type first, then the operands', then the users'
+    for m in [n], ast.successors(n), ast.predecessors(n):
+        for k in m:
+            typ = ast.get_attr(k, 'typ')
+            if typ:
+                return bit_width(typ)
+    return bit_width(None)
+
+
+def is_inner(ast: IrGraph, n: int):
+    # the ops and the constants they use, named 'label#id' by the parsers
+    # and passes, as opposed to vars and constants folded from vars, which
+    # keep the var's name, e.g. the BAP temporary #12.1
+    ntyp = ast.ntyp(n)
+    return ntyp == 'op' or \
+        ntyp == 'c' and ast.name(n).startswith(f'{ast.label(n)}#')
+
+
+class Test(unittest.TestCase):
+    def test_post_order_visits_once(self):
+        g = IrGraph()
+        a, b, c, d = [g.add_node(name, name, 'v') for name in 'abcd']
+        g.add_edges_from([(a, b), (a, c), (b, d), (c, d)])
+
+        base = DiGraphAnalysisBase()
+        base.run(g)
+        self.assertEqual([d, b, c, a], list(base.post_order()))
+
+    def test_deep_chain(self):
+        from analysis.simplify import Simplify
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        lines = ['%0 = xor i32 %reg, 0xFFFFFFFF']
+        lines += [f'%{k} = and i32 %{k - 1}, 0xFFFFFFFF'
+                  for k in range(1, 5000)]
+        parser = LlvmIrBlockParser()
+        parser.parser(lines)
+
+        ast = Simplify().run(parser.ast)
+        self.assertEqual(['%4999', '~', '%reg'],
+                         [ast.label(n) for n in ast.topological_sort()])
+
+    def test_deferred_remove(self):
+        g = IrGraph()
+        a, b, c = [g.add_node(name, name, 'v') for name in 'abc']
+        g.add_edges_from([(a, b), (b, c)])
+
+        base = DiGraphAnalysisBase()
+        base.run(g)
+        visited = []
+
+        def visit(n):
+            visited.append(n)
+            if n == c:
+                base.defer_remove(b)
+
+        base.traverse(visit)
+        self.assertEqual([c, b, a], visited)
+        self.assertEqual([a, c], list(g.nodes))
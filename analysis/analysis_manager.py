@@ -1,13 +1,334 @@
-import networkx as nx
-import pydot
+import gc
+import inspect
+import os
+import time
+import unittest
+
+from analysis.profiler import stage
+from ir_graph import IrGraph
 
 
 class AnalysisManager:
-    def __init__(self, passes):
+    def __init__(self, passes, max_iterations=16, time_budget=None,
+                 profiler=None):
         self.passes = passes
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.profiler = profiler
+        self.iterations = 0
+        self.converged = False
+
+    def __call__(self, ast: IrGraph, copy=False, settled=0, changed=()):
+        # the first `settled` passes, or those at the indices in it, are
+        # known to be at their fixed point on ast already, they only rerun
+        # for what the others change, and for the nodes in changed, which
+        # the caller has touched since
+        if copy:
+            ast = ast.copy()
+
+        deadline = None if self.time_budget is None else \
+            time.monotonic() + self.time_budget
+
+        # nodes changed since each pass last ran, None for the whole graph
+        settled = _indices(settled)
+        pending = [set(changed) if i in settled else None
+                   for i in range(len(self.passes))]
+        self.iterations = 0
+        self.converged = False
 
-    def __call__(self, ast: pydot.Graph):
-        nx_ast = nx.drawing.nx_pydot.from_pydot(ast)
         for p in self.passes:
-            nx_ast = p.run(nx_ast)
-        return nx.drawing.nx_pydot.to_pydot(nx_ast)
+            if hasattr(p, 'profiler'):
+                p.profiler = self.profiler
+
+        ast.track_changes()
+        try:
+            while self.iterations < self.max_iterations and \
+                    any(p is None or p for p in pending):
+                self.iterations += 1
+                for i, p in enumerate(self.passes):
+                    if pending[i] is not None and not pending[i]:
+                        continue
+                    if deadline is not None and time.monotonic() > deadline:
+                        return ast
+
+                    ast = self.__run_pass(p, ast, pending[i])
+                    pending[i] = set()
+
+                    changes = ast.take_changes()
+                    for dirty in pending:
+                        if dirty is not None:
+                            dirty |= changes
+            self.converged = not any(p is None or p for p in pending)
+        finally:
+            ast.stop_tracking()
+        return ast
+
+    def __run_pass(self, p, ast: IrGraph, dirty):
+        with stage(self.profiler, type(p).__name__, ast) as s:
+            ast = self.__call_pass(p, ast, dirty)
+            if s is not None:
+                s.ast = ast
+        return ast
+
+    @staticmethod
+    def __call_pass(p, ast: IrGraph, dirty):
+        if dirty is None:
+            return p.run(ast)
+        if 'scope' not in inspect.signature(p.run).parameters:
+            return p.run(ast)
+        return p.run(ast, scope=_neighbourhood(ast, dirty))
+
+
+class ParallelAnalysisManager(AnalysisManager):
+    # Runs the passes on the weakly connected components of the graph in a
+    # process pool and stitches the results together. A pass with
+    # whole_graph set, PruneBranches choosing the main entry, ends a stage:
+    # the passes before it reach their fixed point on the components, then
+    # it runs on the stitched graph, and the others only rerun there for
+    # what it changes. Small components are batched up to batch_nodes.
+    # make_passes has to be picklable, each worker builds its own passes
+    # with it; batches go back and forth as snapshots.
+    def __init__(self, make_passes, workers=None, max_iterations=16,
+                 time_budget=None, profiler=None, batch_nodes=20000):
+        super().__init__(make_passes(), max_iterations, time_budget,
+                         profiler)
+        self.make_passes = make_passes
+        self.workers = workers
+        self.batch_nodes = batch_nodes
+
+    def __call__(self, ast: IrGraph, copy=False, settled=0):
+        if copy:
+            ast = ast.copy()
+
+        deadline = None if self.time_budget is None else \
+            time.monotonic() + self.time_budget
+        settled = _indices(settled)
+        whole = [i for i, p in enumerate(self.passes)
+                 if getattr(p, 'whole_graph', False)]
+        self.iterations = 0
+        self.converged = False
+
+        for end in whole + [len(self.passes)]:
+            local = [i for i in range(end) if i not in whole]
+            if not settled.issuperset(local):
+                ast, converged = self.__run_components(
+                    ast, local, settled, _remaining(deadline))
+                if not converged:
+                    return ast
+                # the whole graph passes have not seen the result yet
+                settled = settled.union(local).difference(whole)
+
+            manager = AnalysisManager(self.passes[:end + 1],
+                                      self.max_iterations,
+                                      _remaining(deadline), self.profiler)
+            ast = manager(ast, settled=settled.intersection(range(end + 1)))
+            self.iterations += manager.iterations
+            if not manager.converged:
+                return ast
+            settled.update(range(end + 1))
+        self.converged = True
+        return ast
+
+    def __run_components(self, ast: IrGraph, local, settled, time_budget):
+        # positions among the local passes, which are all a worker runs
+        local_settled = [i for i, p in enumerate(local) if p in settled]
+        # at least one batch per worker where the components allow it
+        workers = self.workers or os.cpu_count() or 1
+        batches = list(_batches(ast.weakly_connected_components(),
+                                min(self.batch_nodes, len(ast) // workers)))
+        if len(batches) < 2 or workers == 1:
+            manager = AnalysisManager([self.passes[i] for i in local],
+                                      self.max_iterations, time_budget,
+                                      self.profiler)
+            ast = manager(ast, settled=local_settled)
+            self.iterations += manager.iterations
+            return ast, manager.converged
+
+        with stage(self.profiler, 'components', ast) as s:
+            ast, iterations, converged = self.__run_batches(
+                ast, batches, local, local_settled, time_budget)
+            if s is not None:
+                s.ast = ast
+        self.iterations += iterations
+        return ast, converged
+
+    def __run_batches(self, ast: IrGraph, batches, local, settled,
+                      time_budget):
+        import concurrent.futures as cf
+
+        import snapshot
+
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with cf.ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                        initargs=(self.make_passes,)) as pool:
+                # the biggest first, the rest fill in around them
+                futures = {i: pool.submit(
+                    _run_batch, snapshot.dumps(ast.subgraph(batches[i])),
+                    local, settled, self.max_iterations, time_budget)
+                    for i in sorted(range(len(batches)),
+                                    key=lambda i: -len(batches[i]))}
+                results = [futures[i].result() for i in range(len(batches))]
+            ast = IrGraph.disjoint_union(snapshot.loads(data)
+                                         for data, _, _ in results)
+        finally:
+            if enabled:
+                gc.enable()
+        return (ast, max(i for _, i, _ in results),
+                all(c for _, _, c in results))
+
+
+_worker_passes = None
+
+
+def _init_worker(make_passes):
+    global _worker_passes
+    _worker_passes = make_passes()
+
+
+def _run_batch(data, local, settled, max_iterations, time_budget):
+    import snapshot
+
+    manager = AnalysisManager([_worker_passes[i] for i in local],
+                              max_iterations, time_budget)
+    ast = manager(snapshot.loads(data), settled=settled)
+    return snapshot.dumps(ast), manager.iterations, manager.converged
+
+
+def _batches(components, batch_nodes):
+    # components in order, the small ones together up to batch_nodes
+    batch = []
+    for component in components:
+        batch.extend(component)
+        if len(batch) >= batch_nodes:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+def _indices(settled):
+    return set(range(settled)) if isinstance(settled, int) else set(settled)
+
+
+def _neighbourhood(ast: IrGraph, nodes):
+    scope = set()
+    for n in nodes:
+        if ast.has_node(n):
+            scope.add(n)
+            scope.update(ast.successors(n))
+            scope.update(ast.predecessors(n))
+    return scope
+
+
+class Test(unittest.TestCase):
+    def test_fixed_point(self):
+        from analysis.fold_constant import FoldConstant
+        from analysis.simplify import Simplify
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        block = '''
+%1 = xor i32 %reg, %reg
+%2 = add i32 %1, 0x5
+%3 = and i32 %2, %b
+'''
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+
+        # %2 can only be folded once Simplify has turned %1 into 0
+        manager = AnalysisManager([FoldConstant(), Simplify()])
+        ast = manager(parser.ast)
+        self.assertLess(1, manager.iterations)
+        self.assertLess(manager.iterations, manager.max_iterations)
+        self.assertEqual('0x5', ast.label(ast.node_id('$2')))
+
+    def test_settled(self):
+        class Count:
+            def __init__(self):
+                self.runs = 0
+
+            def run(self, ast):
+                self.runs += 1
+                return ast
+
+        first, second = Count(), Count()
+        manager = AnalysisManager([first, second])
+        manager(IrGraph(), settled=1)
+        self.assertEqual((0, 1), (first.runs, second.runs))
+        self.assertTrue(manager.converged)
+
+        # both settled, but a node the caller touched is news to both
+        manager(IrGraph(), settled=2, changed={0})
+        self.assertEqual((1, 2), (first.runs, second.runs))
+
+    def test_profiler(self):
+        from analysis.fold_constant import FoldConstant
+        from analysis.profiler import StageProfiler
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        class Split(FoldConstant):
+            def run(self, ast, scope=None):
+                with self.stage('fold'):
+                    return super().run(ast, scope)
+
+        parser = LlvmIrBlockParser()
+        parser.parser('%1 = xor i32 0x1, 0x2\n%2 = and i32 %1, %a\n')
+        profiler = StageProfiler()
+        AnalysisManager([Split()], profiler=profiler)(parser.ast)
+
+        fold, split = profiler.records[:2]
+        self.assertEqual(('Split.fold', 'Split'),
+                         (fold['name'], split['name']))
+        self.assertEqual((7, 4), (split['nodes_before'], split['nodes_after']))
+
+    def test_iteration_budget(self):
+        class Grow:
+            def run(self, ast):
+                ast.add_node(f'n{len(ast)}', 'n', 'v')
+                return ast
+
+        manager = AnalysisManager([Grow()], max_iterations=3)
+        ast = manager(IrGraph())
+        self.assertEqual(3, manager.iterations)
+        self.assertEqual(3, len(ast))
+        self.assertFalse(manager.converged)
+
+    @staticmethod
+    def passes():
+        from analysis.fold_constant import FoldConstant
+        from analysis.prune_branches import PruneBranches
+        from analysis.simplify import Simplify
+        from analysis.value_numbering import ValueNumbering
+
+        return [ValueNumbering(), FoldConstant(), PruneBranches(), Simplify()]
+
+    def test_parallel(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        def shape(ast):
+            return {ast.name(n): [ast.label(s) for s in ast.successors(n)]
+                    for n in ast if '#' not in ast.name(n)}
+
+        parser = LlvmIrBlockParser()
+        parser.parser('%1 = xor i32 %a, %a\n'
+                      '%2 = add i32 %1, %b\n'
+                      '%3 = and i32 %2, %c\n'
+                      '%4 = or i32 %3, 0\n'
+                      '%5 = mul i32 %d, 1\n'
+                      '%6 = sub i32 %e, %d\n')
+        self.assertEqual(2, len(list(
+            parser.ast.weakly_connected_components())))
+        serial = AnalysisManager(self.passes())(parser.ast, copy=True)
+
+        manager = ParallelAnalysisManager(self.passes, workers=2,
+                                          batch_nodes=1)
+        parallel = manager(parser.ast)
+        self.assertTrue(manager.converged)
+        self.assertEqual(shape(serial), shape(parallel))
+        # the main entry is that of the whole graph
+        self.assertEqual({'$2', '$4', '$c'}, set(shape(parallel)))
@@ -1,17 +1,14 @@
-import networkx as nx
+from analysis.AnalysisBase import DiGraphAnalysisBase
+from ir_graph import IrGraph
 
 
-class CleanDropOff:
-    def __init__(self):
-        self.ast: nx.Graph = nx.Graph()
+class CleanDropOff(DiGraphAnalysisBase):
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
 
-    def run(self, ast: nx.Graph):
-        assert isinstance(ast, nx.Graph)
-        self.ast = ast
-
-        for drop_off in list(filter(self.__is_drop_off, self.ast.nodes)):
-            self.ast.remove_node(drop_off)
+        nodes = self.ast.nodes if scope is None else scope
+        self.ast.remove_nodes_from(list(filter(self.__is_drop_off, nodes)))
         return self.ast
 
-    def __is_drop_off(self, n: str):
+    def __is_drop_off(self, n: int):
         return self.ast.degree[n] == 0
@@ -0,0 +1,641 @@
+import gc
+import time
+import unittest
+from collections import deque
+from itertools import chain
+
+from analysis.AnalysisBase import DiGraphAnalysisBase, bit_mask, is_inner, \
+    node_width
+from analysis.fold_constant import FoldConstant
+from analysis.rewrite import RuleSet, const_of, op_label
+from analysis.simplify import rules as simplify_rules
+from ir_graph import IrGraph
+
+# Simplify's rules and ones that shrink nothing on their own but lead to
+# something that does; saturation applies them all at once, so they need
+# no order and may well undo each other
+rules = simplify_rules + [
+    ('(+ (+ ?x ?y) ?z)', '(+ ?x (+ ?y ?z))'),
+    ('(* (* ?x ?y) ?z)', '(* ?x (* ?y ?z))'),
+    ('(& (& ?x ?y) ?z)', '(& ?x (& ?y ?z))'),
+    ('(| (| ?x ?y) ?z)', '(| ?x (| ?y ?z))'),
+    ('(^ (^ ?x ?y) ?z)', '(^ ?x (^ ?y ?z))'),
+    ('(~ (& ?x ?y))', '(| (~ ?x) (~ ?y))'),
+    ('(~ (| ?x ?y))', '(& (~ ?x) (~ ?y))'),
+    ('(| (~ ?x) (~ ?y))', '(~ (& ?x ?y))'),
+    ('(& (~ ?x) (~ ?y))', '(~ (| ?x ?y))'),
+    ('(~ ?x)', '(- -1 ?x)'),
+    ('(- -1 ?x)', '(~ ?x)'),
+    ('(- ?x ?y)', '(+ ?x (- ?y))'),
+    ('(+ ?x (- ?y))', '(- ?x ?y)'),
+    ('(- (- ?x))', '?x'),
+    ('(- (~ ?x))', '(+ ?x 1)'),
+    ('(~ (- ?x))', '(- ?x 1)'),
+    ('(+ ?x ?x)', '(* ?x 2)'),
+    ('(* ?x 2)', '(+ ?x ?x)'),
+    ('(<< ?x 1)', '(* ?x 2)'),
+]
+
+_OP_START = 3
+
+
+class _TooExpensive(Exception):
+    pass
+
+
+class EGraph:
+    # E-classes in a union-find, a hashcons from canonical e-nodes to their
+    # class, and egg's deferred rebuild restoring both after unions. An
+    # e-node is a tuple: (label, cast, width, *classes) for an op,
+    # ('#', value, width) for a constant and ('$', node, width) for
+    # anything the rules can not look into.
+    def __init__(self):
+        self.parent = []
+        self.nodes = []
+        # (e-node, class) pairs using a class, for the rebuild
+        self.users = []
+        self.width = []
+        self.const = []
+        self.memo = {}
+        self.dirty = []
+        self.fold = FoldConstant().op_fn_map
+        self.__steps = 0
+
+    def __len__(self):
+        return len(self.memo)
+
+    def find(self, c):
+        parent = self.parent
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    def canonical(self, e):
+        if len(e) == _OP_START:
+            return e
+        find = self.find
+        return e[:_OP_START] + tuple(find(c) for c in e[_OP_START:])
+
+    def classes(self):
+        # the live classes with their e-nodes canonical and unique, only
+        # meaningful after a rebuild
+        for c in range(len(self.parent)):
+            if self.parent[c] == c:
+                self.nodes[c] = list(dict.fromkeys(
+                    map(self.canonical, self.nodes[c])))
+                yield c
+
+    def add(self, e):
+        e = self.canonical(e)
+        c = self.memo.get(e)
+        if c is not None:
+            return self.find(c)
+
+        c = len(self.parent)
+        self.parent.append(c)
+        self.nodes.append([e])
+        self.users.append([])
+        self.width.append(e[2])
+        self.const.append(e[1] if e[0] == '#' else None)
+        self.memo[e] = c
+        for child in set(e[_OP_START:]):
+            self.users[child].append((e, c))
+
+        value = self.__fold(e)
+        if value is not None:
+            return self.union(c, self.add(('#', value, e[2])))
+        return c
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if len(self.users[a]) < len(self.users[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.nodes[a] += self.nodes[b]
+        self.users[a] += self.users[b]
+        self.nodes[b] = self.users[b] = None
+        if self.const[a] is None:
+            self.const[a] = self.const[b]
+        self.dirty.append(a)
+        return a
+
+    def rebuild(self):
+        while self.dirty:
+            todo = {self.find(c) for c in self.dirty}
+            self.dirty = []
+            for c in todo:
+                self.__repair(self.find(c))
+
+    def __repair(self, c):
+        # the users of a merged class may have become equal to each other
+        # or, with a constant operand now, foldable
+        users = self.users[c]
+        for e, _ in users:
+            self.memo.pop(e, None)
+        repaired = {}
+        for e, u in users:
+            e = self.canonical(e)
+            if e in repaired:
+                u = self.union(repaired[e], u)
+            value = self.__fold(e)
+            if value is not None:
+                u = self.union(u, self.add(('#', value, e[2])))
+            repaired[e] = self.memo[e] = self.find(u)
+        if self.find(c) == c:
+            # merged away otherwise, its users are repaired with the winner
+            self.users[c] = list(repaired.items())
+
+    def __fold(self, e):
+        if len(e) == _OP_START or e[1] is not None:
+            return None
+        fn = self.fold.get(e[0])
+        values = [self.const[self.find(c)] for c in e[_OP_START:]]
+        if fn is None or None in values:
+            return None
+        try:
+            return fn(e[2], *values) & bit_mask(e[2])
+        except TypeError:
+            # an arity the op has no meaning for
+            return None
+
+    def saturate(self, rules: RuleSet, node_limit, deadline,
+                 match_steps=2000):
+        # Applies the rules until nothing changes, True then, or until the
+        # e-node or time budget runs out. Every round matches against the
+        # graph as it was before applying anything. Big classes make for a
+        # product of their sizes to search, a rule gives up on a root after
+        # match_steps e-nodes looked at.
+        self.rebuild()
+        rounds = 0
+        while True:
+            rounds += 1
+            matches, in_time = [], True
+            for c in list(self.classes()):
+                for e in self.nodes[c]:
+                    if len(e) == _OP_START or e[1] is not None:
+                        continue
+                    for rule in rules.by_root(e[0], len(e) - _OP_START):
+                        self.__steps = match_steps
+                        try:
+                            for binds in self.__match_node(rule.lhs, e, {}):
+                                matches.append((c, rule.rhs, binds))
+                        except _TooExpensive:
+                            pass
+                if time.monotonic() > deadline:
+                    in_time = False
+                    break
+
+            changed = False
+            for c, rhs, binds in matches:
+                new = self.__instantiate(rhs, binds, self.width[self.find(c)])
+                if self.find(new) != self.find(c):
+                    self.union(c, new)
+                    changed = True
+                if len(self.memo) > node_limit or \
+                        time.monotonic() > deadline:
+                    in_time = False
+                    break
+            self.rebuild()
+            if not in_time:
+                return False, rounds
+            if not changed:
+                return True, rounds
+
+    def __match_node(self, p, e, binds):
+        if e[0] != p[0] or e[1] is not None or \
+                len(e) - _OP_START != len(p) - 1:
+            return
+        yield from self.__match_all(p[1:], e[_OP_START:], binds)
+
+    def __match_all(self, ps, cs, binds):
+        if not ps:
+            yield binds
+            return
+        for b in self.__match_class(ps[0], cs[0], binds):
+            yield from self.__match_all(ps[1:], cs[1:], b)
+
+    def __match_class(self, p, c, binds):
+        c = self.find(c)
+        if isinstance(p, int):
+            value = self.const[c]
+            if value is not None and not (value - p) & bit_mask(self.width[c]):
+                yield binds
+        elif isinstance(p, str):
+            if p.startswith('#') and self.const[c] is None:
+                return
+            bound = binds.get(p)
+            if bound is None:
+                yield {**binds, p: c}
+            elif self.find(bound) == c:
+                yield binds
+        else:
+            for e in self.nodes[c]:
+                self.__steps -= 1
+                if self.__steps < 0:
+                    raise _TooExpensive
+                yield from self.__match_node(p, e, binds)
+
+    def __instantiate(self, p, binds, width):
+        if isinstance(p, str):
+            return binds[p]
+        if isinstance(p, int):
+            return self.add(('#', p & bit_mask(width), width))
+        return self.add((p[0], None, width,
+                         *(self.__instantiate(q, binds, width)
+                           for q in p[1:])))
+
+    def extract(self, preferred=(), only=False, deadline=None):
+        # The cheapest e-node of every class, cost being the size of the
+        # expression as a tree, ties going to the preferred e-nodes; with
+        # only, nothing else is looked at. Costs only ever drop, so a queue
+        # of the classes that got cheaper settles them all. Returns
+        # {class: (cost, e-node)}, None if past the deadline before that.
+        best, queue = {}, deque()
+
+        def consider(c, e):
+            cost = 1
+            for child in e[_OP_START:]:
+                known = best.get(self.find(child))
+                if known is None:
+                    return
+                cost += known[0]
+            unpreferred = e not in preferred
+            if only and unpreferred:
+                return
+            key = cost, unpreferred
+            old = best.get(c)
+            if old is None or key < old[2]:
+                best[c] = cost, e, key
+                queue.append(c)
+
+        for c in self.classes():
+            for e in self.nodes[c]:
+                if len(e) == _OP_START:
+                    consider(c, e)
+        steps = 0
+        while queue:
+            steps += 1
+            if deadline is not None and not steps % 1024 and \
+                    time.monotonic() > deadline:
+                return None
+            c = queue.popleft()
+            for e, u in self.users[c] or ():
+                consider(self.find(u), self.canonical(e))
+        return {c: (cost, e) for c, (cost, e, _) in best.items()}
+
+
+class EqualitySaturation(DiGraphAnalysisBase):
+    # Loads the graph into an e-graph, saturates it with the rules within
+    # the budget and writes the cheapest equivalent expressions back.
+    # Vars and whatever is opaque to the rules stay as they are, the ops
+    # and constants in between are rebuilt, reusing the old nodes where
+    # the expression did not change. The graph is only touched if the
+    # expressions of the vars get smaller altogether.
+    def __init__(self, rules=rules, node_limit=100_000, time_limit=5.):
+        super().__init__()
+        self.rules = RuleSet(rules)
+        self.node_limit = node_limit
+        self.time_limit = time_limit
+        self.stats = {}
+        # signatures of the components left by the last runs
+        self.__settled = set()
+
+    def config(self):
+        return super().config() + (self.rules.config(), self.node_limit,
+                                   self.time_limit)
+
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
+        # with a scope only the components it touches are looked at, and
+        # of those only the ones changed since this pass last left them
+        if scope is None:
+            self.__settled = set()
+            nodes = list(self.ast.nodes)
+        else:
+            nodes = [n for c in _components(self.ast, scope)
+                     if _signature(self.ast, c) not in self.__settled
+                     for n in c]
+        if not nodes:
+            return self.ast
+
+        # millions of small tuples and lists but no cycles, collections
+        # would find nothing while taking most of the time
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.__run(nodes)
+        finally:
+            if enabled:
+                gc.enable()
+        left = [n for n in nodes if self.ast.has_node(n)]
+        self.__settled.update(_signature(self.ast, c)
+                              for c in _components(self.ast, left))
+        return self.ast
+
+    def __run(self, nodes):
+        # seeding, saturating, extracting and rebuilding all count against
+        # the time limit; saturation leaves a fifth of it to the others
+        started = time.monotonic()
+        deadline = started + self.time_limit
+        egraph = EGraph()
+
+        def roots():
+            yield from (egraph.find(classes[n]) for n in named)
+            yield from (egraph.find(classes[s]) for succs in opaque.values()
+                        for s in succs)
+
+        with self.stage('seed'):
+            classes, origins, named, opaque = self.__seed(egraph, nodes)
+            egraph.rebuild()
+            origins = _canonical(egraph, origins)
+            # the expressions as they are, before the rules put cheaper
+            # ones into their classes
+            seeded = egraph.extract(origins, only=True, deadline=deadline)
+        if seeded is None:
+            self.stats = dict(rounds=0, saturated=False, enodes=len(egraph),
+                              seconds=time.monotonic() - started)
+            return
+        before = sum(seeded[c][0] for c in roots())
+        with self.stage('saturate'):
+            saturated, rounds = egraph.saturate(
+                self.rules, self.node_limit,
+                started + self.time_limit * 0.8)
+        with self.stage('extract'):
+            origins = _canonical(egraph, origins)
+            best = egraph.extract(origins, deadline=deadline)
+
+        after = before if best is None else \
+            sum(best[c][0] for c in roots())
+        self.stats = dict(rounds=rounds, saturated=saturated,
+                          enodes=len(egraph), cost_before=before,
+                          cost_after=after)
+
+        if after < before:
+            with self.stage('rebuild'):
+                self.__rebuild(egraph, best, classes, origins, named, opaque,
+                               nodes)
+        self.stats['seconds'] = time.monotonic() - started
+
+    def __seed(self, egraph: EGraph, nodes):
+        # operands first; classes maps nodes to their e-class, origins the
+        # e-nodes to the inner nodes they came from, to None for kept ones
+        classes, origins, named, opaque = {}, {}, [], {}
+        for n in self.post_order(nodes):
+            succs = list(self.ast.successors(n))
+            width = node_width(self.ast, n)
+            cast = self.ast.get_attr(n, 'cast')
+            value = const_of(self.ast, n)
+            if is_inner(self.ast, n):
+                if self.is_op(n):
+                    e = (op_label(self.ast, n), cast, width,
+                         *(classes[s] for s in succs))
+                elif value is not None:
+                    e = '#', value & bit_mask(width), width
+                else:
+                    e = '$', n, width
+                origins.setdefault(e, n)
+                classes[n] = egraph.add(e)
+                continue
+
+            if len(succs) == 1 and not cast and \
+                    self.ast.ntyp(n) in ('v', 'ce'):
+                classes[n] = classes[succs[0]]
+                named.append(n)
+                continue
+            if value is not None:
+                e = '#', value & bit_mask(width), width
+                named.append(n)
+            else:
+                e = '$', n, width
+                opaque[n] = succs
+            origins.setdefault(e, None)
+            classes[n] = egraph.add(e)
+        return classes, origins, named, opaque
+
+    def __rebuild(self, egraph: EGraph, best, classes, origins, named,
+                  opaque, nodes):
+        # references to a class go to the var standing for it, if any
+        reps = {}
+        for n in sorted(named):
+            reps.setdefault(egraph.find(classes[n]), n)
+        inner = [n for n in nodes if is_inner(self.ast, n)]
+        saved = {n: (self.ast.name(n), self.ast.attrs(n)) for n in inner}
+        self.ast.remove_nodes_from(inner)
+
+        built = {}
+
+        def build(root):
+            stack = [egraph.find(root)]
+            while stack:
+                c = stack[-1]
+                if c in built:
+                    stack.pop()
+                    continue
+                e = best[c][1]
+                oprs = [egraph.find(d) for d in e[_OP_START:]]
+                todo = [d for d in oprs if d not in reps and d not in built]
+                if todo:
+                    stack.extend(todo)
+                    continue
+                stack.pop()
+                built[c] = self.__node(e, origins.get(e), saved)
+                for d in oprs:
+                    self.ast.add_edge(built[c], reps.get(d, built.get(d)))
+            return built[egraph.find(root)]
+
+        for n in named:
+            if self.ast.ntyp(n) != 'c':
+                self.ast.add_edge(n, build(classes[n]))
+        for n, succs in opaque.items():
+            for s in succs:
+                c = egraph.find(classes[s])
+                self.ast.add_edge(n, reps[c] if c in reps else build(c))
+
+    def __node(self, e, origin, saved):
+        if origin is not None:
+            name, attrs = saved[origin]
+            attrs = dict(attrs)
+            return self.ast.add_node(self.ast.free_name(name),
+                                     attrs.pop('label'), attrs.pop('ntyp'),
+                                     **attrs)
+        if e[0] == '$':
+            # an opaque node which is not inner is kept, see __seed
+            return e[1]
+        label, ntyp = (hex(e[1]), 'c') if e[0] == '#' else (e[0], 'op')
+        # ids in names need not be unique in a batch of components
+        return self.ast.add_node(
+            self.ast.free_name(f'{label}#e{self.ast.id_bound()}'), label,
+            ntyp, typ=f'i{e[2]}')
+
+
+def _components(ast: IrGraph, nodes):
+    # the weakly connected components holding nodes, each as a list
+    seen, components = set(), []
+    for n in nodes:
+        if n in seen or not ast.has_node(n):
+            continue
+        seen.add(n)
+        component, stack = [], [n]
+        while stack:
+            m = stack.pop()
+            component.append(m)
+            for k in chain(ast.successors(m), ast.predecessors(m)):
+                if k not in seen:
+                    seen.add(k)
+                    stack.append(k)
+        components.append(component)
+    return components
+
+
+def _signature(ast: IrGraph, component):
+    # everything about a component the pass looks at, to tell if it is
+    # still the one the pass left
+    return tuple(sorted((n, tuple(sorted(ast.attrs(n).items())),
+                         tuple(ast.successors(n))) for n in component))
+
+
+def _canonical(egraph: EGraph, origins):
+    # the first node an e-node came from wins once e-nodes become equal
+    canonical = {}
+    for e, n in origins.items():
+        e = egraph.canonical(e)
+        if canonical.get(e) is None:
+            canonical[e] = n
+    return canonical
+
+
+class Test(unittest.TestCase):
+    def test_rules_hold(self):
+        from analysis.rewrite import check_rule
+
+        for lhs, rhs in rules:
+            self.assertIsNone(check_rule(lhs, rhs), f'{lhs} -> {rhs}')
+
+    def test_egraph(self):
+        g = EGraph()
+        x, y = g.add(('$', 0, 8)), g.add(('$', 1, 8))
+        a = g.add(('+', None, 8, x, y))
+        b = g.add(('+', None, 8, y, x))
+        fa, fb = g.add(('*', None, 8, a, x)), g.add(('*', None, 8, b, x))
+        self.assertNotEqual(fa, fb)
+        g.union(a, b)
+        g.rebuild()
+        # congruence: equal operands make equal users
+        self.assertEqual(g.find(fa), g.find(fb))
+        self.assertEqual(g.find(g.add(('^', None, 8, y, y))),
+                         g.find(g.add(('^', None, 8, y, y))))
+
+        # constants fold, also once a class turns out to be one
+        one, three = g.add(('#', 1, 8)), g.add(('#', 3, 8))
+        total = g.add(('+', None, 8, one, g.add(('#', 2, 8))))
+        self.assertEqual(g.find(three), g.find(total))
+        s = g.add(('-', None, 8, x, one))
+        g.union(x, g.add(('#', 0, 8)))
+        g.rebuild()
+        self.assertEqual(0xff, g.const[g.find(s)])
+
+    def test_extract(self):
+        g = EGraph()
+        x = g.add(('$', 0, 8))
+        big = g.add(('^', None, 8, x, g.add(('#', 0, 8))))
+        g.union(big, x)
+        g.rebuild()
+        cost, e = g.extract()[g.find(big)]
+        self.assertEqual((1, ('$', 0, 8)), (cost, e))
+
+    @staticmethod
+    def analyze(block, **kwargs):
+        from analysis.analysis_manager import AnalysisManager
+        from analysis.fold_constant import FoldConstant
+        from analysis.simplify import Simplify
+        from analysis.value_numbering import ValueNumbering
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        saturation = EqualitySaturation(**kwargs)
+        ast = AnalysisManager([ValueNumbering(), FoldConstant(), Simplify(),
+                               saturation])(parser.ast)
+        return ast, saturation
+
+    def test_mba(self):
+        from analysis.evaluator import mismatches
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        # (a ^ b) + 2 * (a & b) is a + b, but only by way of rewriting
+        # x + x into 2 * x first, which does not make anything smaller
+        block = '''
+%1 = and i32 %a, %b
+%2 = xor i32 %a, %b
+%3 = add i32 %1, %1
+%4 = add i32 %2, %3
+%5 = sub i32 -1, %a
+%6 = and i32 %a, %5
+%7 = or i32 %4, %6
+'''
+        ast, saturation = self.analyze(block)
+        # settled, the last run found nothing better
+        self.assertEqual(saturation.stats['cost_after'],
+                         saturation.stats['cost_before'])
+        op = next(ast.successors(ast.node_id('$7')))
+        self.assertEqual('+', ast.label(op))
+        self.assertEqual(['$a', '$b'],
+                         sorted(ast.name(n) for n in ast.successors(op)))
+
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        self.assertEqual([], mismatches(parser.ast, ast, size=1024, seed=0))
+
+    def test_alone(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        # without Simplify in front, the cheaper forms are e-nodes seeded
+        # from the graph itself
+        parser = LlvmIrBlockParser()
+        parser.parser('%1 = xor i32 %a, 0\n'
+                      '%2 = xor i32 %a, %b\n'
+                      '%3 = xor i32 %2, %b\n')
+        saturation = EqualitySaturation()
+        ast = saturation.run(parser.ast)
+        self.assertEqual((11, 5), (saturation.stats['cost_before'],
+                                  saturation.stats['cost_after']))
+        for name in ['$1', '$3']:
+            self.assertEqual(['$a'], [ast.name(n) for n in
+                                      ast.successors(ast.node_id(name))])
+
+    def test_scope(self):
+        ast, saturation = self.analyze('%1 = xor i32 %a, 0\n'
+                                       '%2 = xor i32 %a, %b\n'
+                                       '%3 = xor i32 %2, %b\n'
+                                       '%4 = add i32 %c, %c\n')
+        stats = saturation.stats
+        # the components are as the last run left them, nothing to redo
+        saturation.run(ast, scope=list(ast.nodes))
+        self.assertIs(stats, saturation.stats)
+
+        # a changed one is looked at again, on its own
+        ast.set_attr(ast.node_id('$4'), 'fill_color', 'red')
+        saturation.run(ast, scope=[ast.node_id('$4')])
+        self.assertIsNot(stats, saturation.stats)
+        whole = EqualitySaturation()
+        whole.run(ast.copy())
+        self.assertLess(saturation.stats['enodes'], whole.stats['enodes'])
+
+    def test_deadline(self):
+        import synth
+
+        # extracting counts against the limit as well
+        _, saturation = self.analyze(synth.llvm_block(300, seed=1),
+                                     time_limit=0.3)
+        self.assertLess(saturation.stats['seconds'], 0.3 + 0.1)
+
+    def test_budget(self):
+        import synth
+
+        ast, saturation = self.analyze(synth.llvm_block(200, seed=1),
+                                       node_limit=2000)
+        self.assertFalse(saturation.stats['saturated'])
+        self.assertLessEqual(saturation.stats['enodes'], 2000 + 64)
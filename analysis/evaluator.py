@@ -0,0 +1,255 @@
+import unittest
+from functools import reduce
+
+import numpy as np
+
+from analysis.AnalysisBase import bit_mask, const_value, is_inner, \
+    node_width
+from analysis.fold_constant import op_alias
+from ir_graph import IrGraph
+
+
+class BatchEvaluator:
+    # Evaluates a whole graph for N input assignments at once. Each node
+    # holds one array of N values, computed in topological order with the
+    # same width and cast rules as FoldConstant. Inputs are the free vars,
+    # outputs every other var, both keyed by node name.
+    def __init__(self, ast: IrGraph):
+        self.ast = ast
+        # operands before their users
+        self.order = list(reversed(ast.topological_sort()))
+        self.widths = {n: node_width(ast, n) for n in self.order}
+
+        bits = max(self.__widest(n) for n in self.order) if self.order else 0
+        if bits > 64:
+            raise ValueError(f'Can not evaluate {bits}-bit values')
+        self.bits = 32 if bits <= 32 else 64
+        self.dtype = np.uint32 if self.bits == 32 else np.uint64
+        self.signed_dtype = np.int32 if self.bits == 32 else np.int64
+
+        self.inputs = [ast.name(n) for n in self.order if self.__is_free(n)]
+        self.outputs = [ast.name(n) for n in self.order
+                        if ast.ntyp(n) in ('v', 'ce', 'c') and
+                        not is_inner(ast, n) and not self.__is_free(n)]
+
+        self.op_fn_map = {
+            '&': lambda w, *x: reduce(np.bitwise_and, x),
+            '|': lambda w, *x: reduce(np.bitwise_or, x),
+            '^': lambda w, *x: reduce(np.bitwise_xor, x),
+            '+': lambda w, *x: reduce(np.add, x),
+            '-': lambda w, a, b=None:
+                np.negative(a) if b is None else np.subtract(a, b),
+            '*': lambda w, *x: reduce(np.multiply, x),
+            '~': lambda w, a: np.invert(a),
+            '<<': lambda w, a, b:
+                np.where(b < w, a << np.minimum(b, w - 1), 0),
+            '>>': lambda w, a, b:
+                np.where(b < w, a >> np.minimum(b, w - 1), 0),
+            '~>>': lambda w, a, b: (self.__signed(a, w) >>
+                                    np.minimum(b, w - 1)).astype(self.dtype),
+            'cast': lambda w, a: a,
+        }
+
+    def __call__(self, inputs, columns=None):
+        # inputs is an (N, k) array, one column per name in columns, which
+        # defaults to self.inputs; free vars may also be named by label
+        inputs = np.asarray(inputs)
+        if inputs.ndim == 1:
+            inputs = inputs[:, np.newaxis]
+        columns = self.inputs if columns is None else list(columns)
+        if inputs.shape[1] != len(columns):
+            raise ValueError(f'Expected {len(columns)} input columns, '
+                             f'got {inputs.shape[1]}')
+
+        free = {}
+        for n in self.order:
+            if self.__is_free(n):
+                free[self.ast.name(n)] = free[self.ast.label(n)] = n
+        given = {free[c]: inputs[:, i] for i, c in enumerate(columns)
+                 if c in free}
+        missing = [self.ast.name(n) for n in set(free.values()) - set(given)]
+        if missing:
+            raise KeyError(f'No input for {", ".join(sorted(missing))}')
+
+        outputs = set(map(self.ast.node_id, self.outputs))
+        users = {n: self.ast.in_degree[n] for n in self.order}
+        values = {}
+        for n in self.order:
+            values[n] = self.__evaluate(n, values, given)
+            # drop the values nobody is going to read anymore
+            for s in self.ast.successors(n):
+                users[s] -= 1
+                if not users[s] and s not in outputs:
+                    values.pop(s, None)
+
+        size = len(inputs)
+        return {self.ast.name(n): np.broadcast_to(values[n], (size,))
+                for n in outputs}
+
+    def random_inputs(self, size, seed=None):
+        rng = np.random.default_rng(seed)
+        return rng.integers(0, 1 << self.bits, (size, len(self.inputs)),
+                            dtype=self.dtype, endpoint=False)
+
+    def invariants(self, size=1 << 16, seed=None):
+        # outputs not folded yet but constant over all the random inputs,
+        # likely opaque predicates or MBA identities
+        values = self(self.random_inputs(size, seed))
+        return {name: int(v[0]) for name, v in values.items()
+                if self.ast.ntyp(self.ast.node_id(name)) != 'c'
+                and (v == v[0]).all()}
+
+    def __evaluate(self, n, values, given):
+        ntyp, width = self.ast.ntyp(n), self.widths[n]
+        if n in given:
+            value = np.asarray(given[n]).astype(np.uint64) & bit_mask(width)
+            return self.__cast(n, value.astype(self.dtype), width)
+        if ntyp == 'c':
+            value = const_value(self.ast.label(n)) & bit_mask(width)
+            return self.__cast(n, np.full(1, value, self.dtype), width)
+
+        oprs = [values[s] for s in self.ast.successors(n)]
+        if ntyp == 'op':
+            label = self.ast.label(n)
+            fn = self.op_fn_map.get(op_alias(label))
+            if fn is None:
+                raise ValueError(f'Can not evaluate op {label!r}')
+            value = fn(width, *oprs) & self.__mask(width)
+            return self.__cast(n, value, width)
+
+        # vars only ever point to the single expression they hold
+        if len(oprs) != 1:
+            raise ValueError(f'Var {self.ast.name(n)} holds {len(oprs)} '
+                             f'expressions')
+        return self.__cast(n, oprs[0], width)
+
+    def __cast(self, n, value, width):
+        casts = self.ast.get_attr(n, 'cast')
+        if not casts:
+            return value
+
+        for cast in reversed(casts.split()):
+            kind, cast_width = cast.split(':')
+            cast_width = int(cast_width)
+            if kind == 'low':
+                value = value & self.__mask(cast_width)
+            elif kind == 'high':
+                value = value >> max(width - cast_width, 0)
+            elif kind in ('extend', 'signed'):
+                value = self.__signed(value, width).astype(self.dtype) & \
+                    self.__mask(cast_width)
+            width = cast_width
+        return value
+
+    def __signed(self, value, width):
+        shift = self.bits - width
+        return (value << shift).view(self.signed_dtype) >> shift
+
+    def __mask(self, width):
+        return self.dtype(bit_mask(min(width, self.bits)))
+
+    def __widest(self, n):
+        casts = self.ast.get_attr(n, 'cast') or ''
+        return max([self.widths[n]] +
+                   [int(c.split(':')[1]) for c in casts.split()])
+
+    def __is_free(self, n):
+        return self.ast.ntyp(n) in ('v', 'ce') and \
+            self.ast.out_degree[n] == 0
+
+
+def mismatches(ast_a: IrGraph, ast_b: IrGraph, size=1 << 16, seed=None):
+    # names of the outputs both graphs share but compute differently, on
+    # the same random inputs
+    eval_a, eval_b = BatchEvaluator(ast_a), BatchEvaluator(ast_b)
+    names = sorted(set(eval_a.inputs) | set(eval_b.inputs))
+    rng = np.random.default_rng(seed)
+    inputs = rng.integers(0, 1 << 64, (size, len(names)), dtype=np.uint64,
+                          endpoint=False)
+
+    def run(evaluator):
+        cols = [names.index(name) for name in evaluator.inputs]
+        return evaluator(inputs[:, cols])
+
+    values_a, values_b = run(eval_a), run(eval_b)
+    return [name for name in values_a
+            if name in values_b and
+            not (values_a[name].astype(np.uint64) ==
+                 values_b[name].astype(np.uint64)).all()]
+
+
+class Test(unittest.TestCase):
+    def test_evaluate(self):
+        from bap_ir_parser import BapIrBlockParser
+
+        block = '''
+00000001: RAX := (RSI ^ RDX) + 2 * (RSI & RDX)
+00000002: RCX := low:32[RAX] << 4
+'''
+        parser = BapIrBlockParser()
+        parser.parser(block)
+        evaluator = BatchEvaluator(parser.ast)
+        self.assertEqual(['RDX.0', 'RSI.0'], sorted(evaluator.inputs))
+
+        inputs = evaluator.random_inputs(1000, seed=0)
+        rsi = inputs[:, evaluator.inputs.index('RSI.0')].astype(object)
+        rdx = inputs[:, evaluator.inputs.index('RDX.0')].astype(object)
+        values = evaluator(inputs)
+
+        rax = (rsi + rdx) & bit_mask(64)
+        self.assertEqual(list(rax), list(values['RAX.1']))
+        self.assertEqual(list((rax << 4) & bit_mask(32)),
+                         list(values['RCX.1']))
+
+    def test_temporaries(self):
+        from analysis.fold_constant import FoldConstant
+        from bap_ir_parser import BapIrBlockParser
+
+        # BAP temporaries are vars like any other, also once folded
+        block = '''
+00000001: #12 := 0x5
+00000002: #13 := RSI + #12
+'''
+        parser = BapIrBlockParser()
+        parser.parser(block)
+        folded = FoldConstant().run(parser.ast.copy())
+        self.assertEqual(['#12.1', '#13.1'],
+                         sorted(BatchEvaluator(folded).outputs))
+
+        folded.nodes[folded.node_id('#12.1')]['label'] = '0x6'
+        self.assertEqual(['#12.1', '#13.1'],
+                         sorted(mismatches(parser.ast, folded, size=16)))
+
+    def test_mismatches(self):
+        from analysis.fold_constant import FoldConstant
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        block = '''
+%1 = xor i32 0xFFFFFFFF, 0xFFFFFFF0
+%2 = shl i32 %1, 0x1F
+%3 = ashr i32 %2, 0x4
+%4 = add i32 %reg, %3
+'''
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        folded = FoldConstant().run(parser.ast.copy())
+        self.assertEqual([], mismatches(parser.ast, folded, size=256, seed=0))
+
+        folded.nodes[folded.node_id('$3')]['label'] = '0x0'
+        self.assertEqual(['$3', '$4'],
+                         sorted(mismatches(parser.ast, folded, size=256)))
+
+    def test_invariants(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        # x * (x + 1) is always even
+        block = '''
+%1 = add i32 %x, 0x1
+%2 = mul i32 %x, %1
+%3 = and i32 %2, 0x1
+%4 = and i32 %2, %y
+'''
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        invariants = BatchEvaluator(parser.ast).invariants(4096, seed=0)
+        self.assertEqual({'$3': 0}, invariants)
@@ -1,69 +1,179 @@
+import re
+import unittest
 from functools import reduce
 
-import networkx as nx
+from analysis.AnalysisBase import DiGraphAnalysisBase, bit_mask, \
+    const_value, node_width
+from ir_graph import IrGraph
 
 
-class FoldConstant:
+op_alias_map = {
+    'and': '&', 'or': '|', 'xor': '^', 'add': '+', 'sub': '-',
+    'mul': '*', 'not': '~', 'shl': '<<', 'shr': '>>', 'lshr': '>>',
+    'ashr': '~>>',
+}
+
+# a cast of a var is an op of its own labeled with the casts it applies,
+# outermost first, e.g. 'pad:64 low:32'
+_cast_label_re = re.compile(r'\w+:\d+( \w+:\d+)*')
+
+
+def op_alias(label: str):
+    if _cast_label_re.fullmatch(label):
+        return 'cast'
+    return op_alias_map.get(label, label)
+
+
+class FoldConstant(DiGraphAnalysisBase):
     def __init__(self):
-        self.ast: nx.DiGraph = nx.DiGraph()
-        self.dead_edges = []
-        self.dead_nodes = []
+        super().__init__()
+        self.values = {}
 
         self.op_fn_map = {
-            '&': lambda x, y: x & y,
-            '|': lambda x, y: x | y,
-            '^': lambda x, y: x ^ y,
+            '&': lambda w, *x: reduce(lambda a, b: a & b, x),
+            '|': lambda w, *x: reduce(lambda a, b: a | b, x),
+            '^': lambda w, *x: reduce(lambda a, b: a ^ b, x),
+            '+': lambda w, *x: sum(x),
+            '-': lambda w, a, b=None: -a if b is None else a - b,
+            '*': lambda w, *x: reduce(lambda a, b: a * b, x),
+            '~': lambda w, a: ~a,
+            '<<': lambda w, a, b: a << b if b < w else 0,
+            '>>': lambda w, a, b: a >> b,
+            '~>>': lambda w, a, b: _signed(a, w) >> min(b, w),
+            # a cast of a var, the cast itself is on the node
+            'cast': lambda w, a: a,
         }
 
-    def run(self, ast: nx.DiGraph):
-        assert isinstance(ast, nx.DiGraph)
-        self.ast = ast
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
+        self.values = {}
+
+        roots = list(self.ast.nodes if scope is None else scope)
+        order = list(self.post_order(roots))
+        for n in order:
+            self.values[n] = self.__evaluate(n)
 
-        for n in self.ast.nodes:
-            self.__fold_constexpr(n)
-        self.__clean_dead()
+        # parents first, so that a folded var drops its whole operand tree
+        # before the ops inside it would be folded one by one
+        for n in reversed(order):
+            if self.ast.has_node(n) and self.values[n] is not None and \
+                    self.ast.ntyp(n) != 'c' and self.ast.out_degree[n] > 0:
+                self.__fold(n, self.values[n])
         return self.ast
 
-    def __fold_constexpr(self, curr):
-        node_curr = self.ast.nodes[curr]
-        if node_curr['ntyp'] == 'c':
-            return node_curr
-        if node_curr['ntyp'] != 'ce':
+    def __evaluate(self, n):
+        ntyp = self.ast.ntyp(n)
+        width = node_width(self.ast, n)
+        if ntyp == 'c':
+            try:
+                value = const_value(self.ast.label(n))
+            except ValueError:
+                return None
+            return self.__cast(n, value & bit_mask(width), width)
+
+        oprs = [self.values[s] for s in self.ast.successors(n)]
+        if not oprs or None in oprs:
             return None
 
-        # collect operands
-        op = list(self.ast.successors(curr))[0]
-        opr_node_list = []
-        for succ in self.ast.successors(op):
-            folded_node = self.__fold_constexpr(succ)
-            if not folded_node:
+        if ntyp == 'op':
+            fn = self.__fn_of(n)
+            if fn is None:
                 return None
-            opr_node_list.append(folded_node)
-        const = self.__simulate_exp(op, opr_node_list)
+            value = fn(width, *oprs) & bit_mask(width)
+            return self.__cast(n, value, width)
+
+        # vars only ever point to the single expression they hold
+        if len(oprs) != 1:
+            return None
+        return self.__cast(n, oprs[0], width)
 
-        # clean expression relationships
-        self.dead_edges.append((curr, op))
-        for succ in self.ast.successors(op):
-            self.dead_edges.append((op, succ))
-        self.dead_nodes.append(op)
+    def __fold(self, n, value):
+        node = self.ast.nodes[n]
+        node['ntyp'] = 'c'
+        node['label'] = hex(value)
+        self.ast.del_attr(n, 'cast')
 
-        # update node attributes
-        node_curr = self.ast.nodes[curr]
-        node_curr['ntyp'] = 'c'
-        node_curr['label'] = hex(const)
+        for succ in list(self.ast.successors(n)):
+            self.unlink(n, succ)
 
-        return node_curr
+    def __fn_of(self, op):
+        return self.op_fn_map.get(op_alias(self.ast.label(op)))
 
-    def __clean_dead(self):
-        self.ast.remove_edges_from(self.dead_edges)
-        self.ast.remove_nodes_from(self.dead_nodes)
+    def __cast(self, n, value, width):
+        # casts are stored outermost first, e.g. 'pad:64 low:32'
+        casts = self.ast.get_attr(n, 'cast')
+        if not casts:
+            return value
 
-    def __simulate_exp(self, op, opr_node_list: list):
-        l = map(lambda node: int(node['label'], 16), opr_node_list)
-        return reduce(self.__fn_of(op), l)
+        for cast in reversed(casts.split()):
+            kind, cast_width = cast.split(':')
+            cast_width = int(cast_width)
+            if kind == 'low':
+                value &= bit_mask(cast_width)
+            elif kind == 'high':
+                value >>= max(width - cast_width, 0)
+            elif kind in ('extend', 'signed'):
+                value = _signed(value, width) & bit_mask(cast_width)
+            width = cast_width
+        return value
 
-    def __fn_of(self, op):
-        op = self.ast.nodes[op]['label']
-        if op not in self.op_fn_map:
-            raise NotImplementedError(f'Op {op} is not supported yet!')
-        return self.op_fn_map[op]
+
+def _signed(value, width):
+    return value - (1 << width) if value >> (width - 1) & 1 else value
+
+
+class Test(unittest.TestCase):
+    def test_fold_llvm(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        block = '''
+%1 = xor i32 0xFFFFFFFF, 0xFFFFFFF0
+%2 = shl i32 %1, 0x1F
+%3 = add i32 %2, %2
+%4 = sub i32 %1, 0x10
+%5 = and i32 %reg, %4
+'''
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        ast = FoldConstant().run(parser.ast)
+
+        labels = {ast.label(n): ast.ntyp(n) for n in ast.nodes}
+        for var, const in [('$2', '0x80000000'), ('$3', '0x0'),
+                           ('$4', '0xffffffff')]:
+            n = ast.node_id(var)
+            self.assertEqual(('c', const), (ast.ntyp(n), ast.label(n)))
+        self.assertEqual('v', labels['%5'])
+
+    def test_fold_bap_casts(self):
+        from bap_ir_parser import BapIrBlockParser
+
+        block = '''
+00000001: RSI := pad:64[low:32[0x1FFFFFFFF] + 2]
+00000002: RDX := pad:64[~low:32[RSI] << 4] ^ low:8[RSI]
+'''
+        parser = BapIrBlockParser()
+        parser.parser(block)
+        ast = FoldConstant().run(parser.ast)
+
+        rsi, rdx = ast.node_id('RSI.1'), ast.node_id('RDX.1')
+        self.assertEqual('0x1', ast.label(rsi))
+        self.assertEqual('0xffffffe1', ast.label(rdx))
+        self.assertEqual(2, len(ast))
+
+    def test_fold_var_casts(self):
+        from bap_ir_parser import BapIrBlockParser
+
+        # a cast of a var applies to that use only
+        block = '''
+00000001: RAX := 0x180000000
+00000002: RBX := high:32[RAX] & 1
+00000003: RCX := extend:64[low:32[RAX]]
+00000004: RDX := pad:64[low:8[RAX]] + RAX
+'''
+        parser = BapIrBlockParser()
+        parser.parser(block)
+        ast = FoldConstant().run(parser.ast)
+
+        for var, const in [('RBX.1', '0x1'), ('RCX.1', '0xffffffff80000000'),
+                           ('RDX.1', '0x180000000')]:
+            self.assertEqual(const, ast.label(ast.node_id(var)))
@@ -1,23 +1,23 @@
-import networkx as nx
+from analysis.AnalysisBase import DiGraphAnalysisBase
+from ir_graph import IrGraph
 
 
-class MarkEntries:
+class MarkEntries(DiGraphAnalysisBase):
     def __init__(self, fill_color='black', font_color='white'):
-        self.ast: nx.DiGraph = nx.DiGraph()
+        super().__init__()
         self.fill_color = fill_color
         self.font_color = font_color
 
-    def run(self, ast: nx.DiGraph):
-        assert isinstance(ast, nx.DiGraph)
-        self.ast = ast
+    def config(self):
+        return super().config() + (self.fill_color, self.font_color)
 
-        for n in self.ast.nodes:
-            if self.__is_entry(n):
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
+
+        for n in self.ast.nodes if scope is None else scope:
+            if self.is_entry(n):
                 node = self.ast.nodes[n]
                 node['style'] = 'filled'
                 node['fillcolor'] = self.fill_color
                 node['fontcolor'] = self.font_color
         return self.ast
-
-    def __is_entry(self, n: str):
-        return self.ast.in_degree[n] == 0
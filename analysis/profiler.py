@@ -0,0 +1,182 @@
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+import unittest
+from contextlib import nullcontext
+
+from ir_graph import IrGraph
+
+
+class StageProfiler:
+    # Records wall and cpu time, node and edge counts before and after, and
+    # with memory=True the tracemalloc peak of every stage. Stages nest; with
+    # cprofile_dir each stage name also gets a cProfile dump of all its runs.
+    def __init__(self, memory=False, cprofile_dir=None):
+        self.memory = memory
+        self.cprofile_dir = cprofile_dir
+        self.records = []
+        self.__stack = []
+        self.__profiles = {}
+        self.__started_tracing = False
+
+    def stage(self, name, ast: IrGraph = None):
+        return _Stage(self, name, ast)
+
+    def enter(self, record):
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__started_tracing = True
+            # the peak so far belongs to the enclosing stage
+            if self.__stack:
+                self.__stack[-1].fold_peak(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            record['memory_before'] = tracemalloc.get_traced_memory()[0]
+
+        if self.__stack:
+            self.__switch(self.__stack[-1].name, False)
+        record['depth'] = len(self.__stack)
+        self.__stack.append(_Open(record['name']))
+        self.__switch(record['name'], True)
+
+    def exit(self, record):
+        self.__switch(record['name'], False)
+        current = self.__stack.pop()
+        if self.memory:
+            size, peak = tracemalloc.get_traced_memory()
+            current.fold_peak(peak)
+            record['peak'] = current.peak
+            record['memory_after'] = size
+            tracemalloc.reset_peak()
+            if self.__stack:
+                self.__stack[-1].fold_peak(current.peak)
+        if self.__stack:
+            self.__switch(self.__stack[-1].name, True)
+        self.records.append(record)
+
+    def totals(self):
+        totals = {}
+        for r in self.records:
+            t = totals.setdefault(r['name'], {'runs': 0, 'wall': 0.,
+                                              'cpu': 0.})
+            t['runs'] += 1
+            t['wall'] += r['wall']
+            t['cpu'] += r['cpu']
+            if 'peak' in r:
+                t['peak'] = max(t.get('peak', 0), r['peak'])
+            if 'nodes_before' in r and 'nodes_after' in r:
+                t['nodes_removed'] = t.get('nodes_removed', 0) + \
+                    r['nodes_before'] - r['nodes_after']
+                t['edges_removed'] = t.get('edges_removed', 0) + \
+                    r['edges_before'] - r['edges_after']
+        return totals
+
+    def report(self):
+        return {'stages': self.records, 'totals': self.totals()}
+
+    def dump(self, path):
+        with open(path, 'w+') as f:
+            json.dump(self.report(), f, indent=2)
+        self.dump_profiles()
+
+    def dump_profiles(self):
+        if not self.cprofile_dir:
+            return
+        os.makedirs(self.cprofile_dir, exist_ok=True)
+        for i, (name, profile) in enumerate(self.__profiles.items()):
+            profile.dump_stats(os.path.join(self.cprofile_dir,
+                                            f'{i:02}-{name}.prof'))
+
+    def close(self):
+        if self.__started_tracing:
+            tracemalloc.stop()
+            self.__started_tracing = False
+
+    def __switch(self, name, on):
+        # only one cProfile can be active, the inner stage takes over
+        if not self.cprofile_dir:
+            return
+        if name not in self.__profiles:
+            self.__profiles[name] = cProfile.Profile()
+        if on:
+            self.__profiles[name].enable()
+        else:
+            self.__profiles[name].disable()
+
+
+class _Open:
+    # a stage on the stack, collects the peak of everything it encloses
+    def __init__(self, name):
+        self.name = name
+        self.peak = 0
+
+    def fold_peak(self, peak):
+        self.peak = max(self.peak, peak)
+
+
+class _Stage:
+    # `with profiler.stage(name, ast) as s:`, set s.ast when the stage hands
+    # back a different graph than it got
+    def __init__(self, profiler: StageProfiler, name, ast):
+        self.profiler = profiler
+        self.ast = ast
+        self.record = {'name': name}
+        self.__wall = self.__cpu = 0.
+
+    def __enter__(self):
+        if self.ast is not None:
+            self.record['nodes_before'] = self.ast.number_of_nodes()
+            self.record['edges_before'] = self.ast.number_of_edges()
+        self.profiler.enter(self.record)
+        self.__wall, self.__cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['wall'] = time.perf_counter() - self.__wall
+        self.record['cpu'] = time.process_time() - self.__cpu
+        self.profiler.exit(self.record)
+        if self.ast is not None:
+            self.record['nodes_after'] = self.ast.number_of_nodes()
+            self.record['edges_after'] = self.ast.number_of_edges()
+
+
+def stage(profiler, name, ast: IrGraph = None):
+    # a no-op unless someone asked for profiling
+    return nullcontext() if profiler is None else profiler.stage(name, ast)
+
+
+class Test(unittest.TestCase):
+    def test_stages(self):
+        import tempfile
+
+        g = IrGraph()
+        profiler = StageProfiler(memory=True)
+        with profiler.stage('outer', g):
+            g.add_node('a', 'a', 'v')
+            with profiler.stage('inner', g) as s:
+                data = [0] * 100000
+                s.ast = IrGraph()
+            del data
+        profiler.close()
+
+        inner, outer = profiler.records
+        self.assertEqual(('inner', 1, 1, 0), (inner['name'], inner['depth'],
+                                              inner['nodes_before'],
+                                              inner['nodes_after']))
+        self.assertEqual((0, 1), (outer['nodes_before'], outer['nodes_after']))
+        self.assertLessEqual(inner['peak'], outer['peak'])
+        self.assertLess(800000, outer['peak'] - outer['memory_before'])
+        self.assertEqual(1, profiler.totals()['inner']['nodes_removed'])
+
+        with tempfile.TemporaryDirectory() as d:
+            profiler = StageProfiler(cprofile_dir=d)
+            for _ in range(2):
+                with profiler.stage('work'):
+                    sum(range(1000))
+            profiler.dump(os.path.join(d, 'profile.json'))
+            self.assertEqual(['00-work.prof', 'profile.json'],
+                             sorted(os.listdir(d)))
+            with open(os.path.join(d, 'profile.json')) as f:
+                self.assertEqual(2, json.load(f)['totals']['work']['runs'])
@@ -1,37 +1,65 @@
-import networkx as nx
+from collections import Counter
 
+from analysis.AnalysisBase import DiGraphAnalysisBase
+from ir_graph import IrGraph
 
-class PruneBranches:
-    def __init__(self):
-        self.ast: nx.DiGraph = nx.DiGraph()
 
-    def run(self, ast: nx.DiGraph):
-        assert isinstance(ast, nx.DiGraph)
-        self.ast = ast
+class PruneBranches(DiGraphAnalysisBase):
+    # the main entry is the biggest of the whole graph, not of a component
+    whole_graph = True
 
-        entries = set(filter(self.__is_entry, self.ast.nodes))
-        main_entry = max(entries, key=self.__tree_size)
-        entries.remove(main_entry)
+    def __init__(self, keep=1):
+        super().__init__()
+        self.keep = keep
+        # sort key for the entries, the first of equally big ones wins;
+        # node ids, i.e. the order they were parsed in, if None
+        self.rank = None
 
-        self.__clean(entries)
-        return self.ast
+    def config(self):
+        return super().config() + (self.keep,)
+
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
 
-    def __clean(self, worklist: set):
-        while worklist:
-            curr = worklist.pop()
-            if not self.__is_entry(curr):
-                continue
+        # picking the main entry needs the whole graph, only redo it if the
+        # changes since the last run have left new entries behind
+        if scope is not None and not any(map(self.is_entry, scope)):
+            return self.ast
 
-            succs = set(self.ast.successors(curr))
-            out_edges_of_curr = [(curr, succ) for succ in succs]
+        entries = sorted(filter(self.is_entry, self.ast.nodes),
+                         key=self.rank)
+        if len(entries) <= self.keep:
+            return self.ast
 
-            self.ast.remove_edges_from(out_edges_of_curr)
-            self.ast.remove_node(curr)
+        reach = self.__reaching_entries(entries)
+        sizes = self.__reach_sizes(entries, reach)
+        main_entries = sorted(range(len(entries)), key=lambda i: -sizes[i])
+        keep_mask = sum(1 << i for i in main_entries[:self.keep])
+
+        self.__clean(n for n, mask in reach.items() if not mask & keep_mask)
+        return self.ast
 
-            worklist |= succs
+    def __reaching_entries(self, entries):
+        # one sweep in topological order, the bitset of a node tells which
+        # entries reach it
+        reach = dict.fromkeys(self.ast.nodes, 0)
+        for i, entry in enumerate(entries):
+            reach[entry] = 1 << i
+        for n in self.ast.topological_sort():
+            mask = reach[n]
+            for succ in self.ast.successors(n):
+                reach[succ] |= mask
+        return reach
 
-    def __is_entry(self, n: str):
-        return self.ast.in_degree[n] == 0
+    @staticmethod
+    def __reach_sizes(entries, reach):
+        sizes = [0] * len(entries)
+        for mask, count in Counter(reach.values()).items():
+            while mask:
+                low = mask & -mask
+                sizes[low.bit_length() - 1] += count
+                mask ^= low
+        return sizes
 
-    def __tree_size(self, n: str):
-        return 1 + sum(map(self.__tree_size, self.ast.successors(n)))
+    def __clean(self, dead_nodes):
+        self.ast.remove_nodes_from(list(dead_nodes))
@@ -0,0 +1,237 @@
+import re
+import unittest
+from collections import namedtuple
+from itertools import product
+
+from analysis.AnalysisBase import bit_mask, const_value
+from analysis.fold_constant import op_alias
+from analysis.value_numbering import commutative_ops
+from ir_graph import IrGraph
+
+# Rewrite rules are data, a pattern and its replacement written as
+# s-expressions over op labels, e.g. ('(^ ?x -1)', '(~ ?x)'). ?x matches
+# any operand, #k any constant, a name used twice the same node. Numbers
+# are read at the width of the matched op, so -1 is all ones at any width.
+# Inside a pattern an op also matches a var holding just that op.
+Rule = namedtuple('Rule', 'lhs rhs kinds text')
+
+_token_re = re.compile(r'\(|\)|[^\s()]+')
+
+
+def parse_sexp(text: str):
+    # ops become tuples (label, *operands), numbers ints, names stay str
+    stack, top = [], []
+    for token in _token_re.findall(text):
+        if token == '(':
+            stack.append(top)
+            top = []
+        elif token == ')':
+            if not stack or not top:
+                raise ValueError(f'Unbalanced rule {text!r}')
+            stack[-1].append(tuple(top))
+            top = stack.pop()
+        elif stack and not top:
+            # the op label
+            top.append(token)
+        else:
+            top.append(_atom(token))
+    if stack or len(top) != 1:
+        raise ValueError(f'Malformed rule {text!r}')
+    return top[0]
+
+
+def _atom(token: str):
+    if token[0] in '?#':
+        return token
+    try:
+        return const_value(token)
+    except ValueError:
+        raise ValueError(f'Not a number or pattern variable: {token}')
+
+
+def compile_rule(lhs: str, rhs: str):
+    # one Rule per operand order of the commutative ops in the pattern
+    pattern, result = parse_sexp(lhs), parse_sexp(rhs)
+    if not isinstance(pattern, tuple):
+        raise ValueError(f'A pattern has to be an op: {lhs!r}')
+    unbound = _names(result) - _names(pattern)
+    if unbound:
+        raise ValueError(f'Unbound {", ".join(sorted(unbound))} in {rhs!r}')
+    return [Rule(p, result, tuple(map(_kind, p[1:])), f'{lhs} -> {rhs}')
+            for p in dict.fromkeys(_orders(pattern))]
+
+
+def check_rule(lhs: str, rhs: str, widths=(8, 32, 64), samples=100, seed=0):
+    # a counterexample (width, bindings) on random values, None if the rule
+    # held on all of them
+    import random
+
+    fns = {'&': int.__and__, '|': int.__or__, '^': int.__xor__,
+           '+': int.__add__, '*': int.__mul__, '~': int.__invert__,
+           '-': lambda a, b=None: -a if b is None else a - b,
+           '<<': int.__lshift__, '>>': int.__rshift__}
+
+    def evaluate(e, env, mask):
+        if isinstance(e, tuple):
+            return fns[e[0]](*(evaluate(x, env, mask) for x in e[1:])) & mask
+        return env[e] if isinstance(e, str) else e & mask
+
+    rng = random.Random(seed)
+    pattern, result = parse_sexp(lhs), parse_sexp(rhs)
+    names = sorted(_names(pattern))
+    for width in widths:
+        mask = bit_mask(width)
+        for _ in range(samples):
+            env = {name: rng.getrandbits(width) for name in names}
+            if evaluate(pattern, env, mask) != evaluate(result, env, mask):
+                return width, env
+    return None
+
+
+def _names(p):
+    if isinstance(p, tuple):
+        return set().union(*map(_names, p[1:]))
+    return {p} if isinstance(p, str) else set()
+
+
+def _orders(p):
+    if not isinstance(p, tuple):
+        yield p
+        return
+    for oprs in product(*map(list, map(_orders, p[1:]))):
+        yield (p[0], *oprs)
+        if p[0] in commutative_ops and len(oprs) == 2:
+            yield p[0], oprs[1], oprs[0]
+
+
+def _kind(p):
+    # what an operand has to be for the pattern to stand a chance
+    if isinstance(p, tuple):
+        return 'op'
+    if isinstance(p, int) or p.startswith('#'):
+        return 'c'
+    return '*'
+
+
+class RuleSet:
+    # Rules by root op and arity, narrowed down to the operand kinds of a
+    # node once per combination, so a lookup costs the same however many
+    # rules there are. Earlier rules win.
+    def __init__(self, rules):
+        self.rules = [r for lhs, rhs in rules for r in compile_rule(lhs, rhs)]
+        self.__by_root = {}
+        for r in self.rules:
+            self.__by_root.setdefault((r.lhs[0], len(r.kinds)), []).append(r)
+        self.__index = {}
+
+    def config(self):
+        return tuple(dict.fromkeys(r.text for r in self.rules))
+
+    def by_root(self, label, arity):
+        return self.__by_root.get((label, arity), ())
+
+    def candidates(self, label, kinds):
+        key = label, kinds
+        found = self.__index.get(key)
+        if found is None:
+            found = self.__index[key] = [
+                r for r in self.by_root(label, len(kinds))
+                if all(p == '*' or p == k for p, k in zip(r.kinds, kinds))]
+        return found
+
+
+def op_label(ast: IrGraph, n: int):
+    return op_alias(ast.label(n))
+
+
+def expr(ast: IrGraph, n: int):
+    # the op n stands for, looking through a var holding only that op; a
+    # cast in between changes the value, so nothing is seen through it
+    if ast.get_attr(n, 'cast'):
+        return None
+    ntyp = ast.ntyp(n)
+    if ntyp == 'op':
+        return n
+    if ntyp == 'v' and ast.out_degree[n] == 1:
+        succ = next(ast.successors(n))
+        if ast.ntyp(succ) == 'op' and not ast.get_attr(succ, 'cast'):
+            return succ
+    return None
+
+
+def const_of(ast: IrGraph, n: int):
+    if ast.ntyp(n) != 'c' or ast.get_attr(n, 'cast'):
+        return None
+    try:
+        return const_value(ast.label(n))
+    except ValueError:
+        return None
+
+
+def operand_kind(ast: IrGraph, n: int):
+    if const_of(ast, n) is not None:
+        return 'c'
+    return 'op' if expr(ast, n) is not None else 'v'
+
+
+def match(ast: IrGraph, n: int, pattern, width: int):
+    # the bindings of the pattern variables, None if n does not match
+    binds, mask = {}, bit_mask(width)
+    stack = [(n, pattern)]
+    while stack:
+        n, p = stack.pop()
+        if isinstance(p, int):
+            value = const_of(ast, n)
+            if value is None or (value - p) & mask:
+                return None
+        elif isinstance(p, str):
+            if p.startswith('#') and const_of(ast, n) is None:
+                return None
+            if binds.setdefault(p, n) != n:
+                return None
+        else:
+            e = expr(ast, n)
+            if e is None or op_label(ast, e) != p[0] or \
+                    ast.out_degree[e] != len(p) - 1:
+                return None
+            stack.extend(zip(ast.successors(e), p[1:]))
+    return binds
+
+
+class Test(unittest.TestCase):
+    def test_compile(self):
+        self.assertEqual(('^', '?x', ('~', 0)), parse_sexp('(^ ?x (~ 0x0))'))
+        rules = compile_rule('(+ (& ?x ?y) #k)', '(| ?x #k)')
+        self.assertEqual(4, len(rules))
+        self.assertEqual([('op', 'c'), ('c', 'op')],
+                         list(dict.fromkeys(r.kinds for r in rules)))
+        for bad in ['(^ ?x', '?x', '(^ ?x foo)']:
+            with self.assertRaises(ValueError):
+                compile_rule(bad, '?x')
+        with self.assertRaises(ValueError):
+            compile_rule('(^ ?x 0)', '?y')
+
+    def test_index(self):
+        many = [(f'(- ?x {k})', f'(+ ?x {-k})') for k in range(1, 500)]
+        rules = RuleSet([('(^ ?x -1)', '(~ ?x)'), ('(^ ?x ?x)', '0'), *many])
+        self.assertEqual(['(^ ?x -1) -> (~ ?x)', '(^ ?x ?x) -> 0'],
+                         [r.text for r in rules.candidates('^', ('v', 'c'))])
+        self.assertEqual(['(^ ?x ?x) -> 0'],
+                         [r.text for r in rules.candidates('^', ('v', 'v'))])
+        self.assertEqual([], rules.candidates('^', ('v',)))
+        self.assertEqual(499, len(rules.candidates('-', ('v', 'c'))))
+
+    def test_match(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser()
+        parser.parser('%1 = xor i8 %a, 255\n%2 = and i8 %1, %a\n')
+        ast = parser.ast
+        xor = next(ast.successors(ast.node_id('$1')))
+        and_ = next(ast.successors(ast.node_id('$2')))
+        a = ast.node_id('$a')
+        self.assertEqual({'?x': a}, match(ast, xor, ('^', '?x', -1), 8))
+        self.assertIsNone(match(ast, xor, ('^', '?x', -1), 16))
+        self.assertEqual({'?x': a}, match(
+            ast, and_, ('&', ('^', '?x', -1), '?x'), 8))
+        self.assertIsNone(match(ast, and_, ('&', '?x', '?x'), 8))
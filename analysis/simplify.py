@@ -1,132 +1,183 @@
-from functools import reduce
-
-import networkx as nx
-
-from analysis.AnalysisBase import DiGraphAnalysisBase
+import unittest
+
+from analysis.AnalysisBase import DiGraphAnalysisBase, bit_mask, node_width
+from analysis.rewrite import RuleSet, match, op_label, operand_kind
+from ir_graph import IrGraph
+
+# see analysis.rewrite for the notation, commutative ops match their
+# operands either way round
+rules = [
+    ('(^ ?x ?x)', '0'),
+    ('(^ ?x 0)', '?x'),
+    ('(^ ?x -1)', '(~ ?x)'),
+    ('(^ ?x (~ ?x))', '-1'),
+    ('(^ (^ ?x ?y) ?y)', '?x'),
+    ('(& ?x ?x)', '?x'),
+    ('(& ?x 0)', '0'),
+    ('(& ?x -1)', '?x'),
+    ('(& ?x (~ ?x))', '0'),
+    ('(& ?x (| ?x ?y))', '?x'),
+    ('(| ?x ?x)', '?x'),
+    ('(| ?x 0)', '?x'),
+    ('(| ?x -1)', '-1'),
+    ('(| ?x (~ ?x))', '-1'),
+    ('(| ?x (& ?x ?y))', '?x'),
+    ('(~ (~ ?x))', '?x'),
+    ('(+ ?x 0)', '?x'),
+    ('(- ?x 0)', '?x'),
+    ('(- ?x ?x)', '0'),
+    ('(* ?x 0)', '0'),
+    ('(* ?x 1)', '?x'),
+    ('(<< ?x 0)', '?x'),
+    ('(>> ?x 0)', '?x'),
+    # mixed boolean-arithmetic
+    ('(+ (^ ?x ?y) (* 2 (& ?x ?y)))', '(+ ?x ?y)'),
+    ('(+ (^ ?x ?y) (<< (& ?x ?y) 1))', '(+ ?x ?y)'),
+    ('(+ (& ?x ?y) (| ?x ?y))', '(+ ?x ?y)'),
+    ('(- (| ?x ?y) (& ?x ?y))', '(^ ?x ?y)'),
+    ('(^ (| ?x ?y) (& ?x ?y))', '(^ ?x ?y)'),
+    ('(- (+ ?x ?y) (& ?x ?y))', '(| ?x ?y)'),
+    ('(- (+ ?x ?y) (* 2 (& ?x ?y)))', '(^ ?x ?y)'),
+    ('(+ (& ?x (~ ?y)) ?y)', '(| ?x ?y)'),
+    ('(- (^ ?x ?y) (* 2 (& (~ ?x) ?y)))', '(- ?x ?y)'),
+]
 
 
 class Simplify(DiGraphAnalysisBase):
-    def __init__(self):
+    def __init__(self, rules=rules):
         super().__init__()
-        self.fn_reduce_map = {
-            '^': self.__reduce_xor,
-            '|': self.__reduce_or,
-            '&': self.__reduce_and,
-            '?': self.__reduce_default,
-        }
-        self.fn_op_map = {
-            '^': lambda a, b: a ^ b,
-            '|': lambda a, b: a | b,
-            '&': lambda a, b: a & b,
-        }
-
-    def run(self, ast: nx.DiGraph):
-        super().run(ast)
-
-        self.dfs(self.__visit)
+        self.rules = RuleSet(rules)
+
+    def config(self):
+        return super().config() + (self.rules.config(),)
+
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
+
+        # operands first; whatever a rewrite touches is visited again
+        order = list(self.post_order()) if scope is None else \
+            [n for n in scope if self.ast.has_node(n)]
+        worklist, queued = order[::-1], set(order)
+        while worklist:
+            n = worklist.pop()
+            queued.discard(n)
+            if not self.ast.has_node(n):
+                continue
+            for m in self.__visit(n):
+                if m not in queued:
+                    queued.add(m)
+                    worklist.append(m)
         return self.ast
 
-    def __visit(self, n, op):
-        if op is None:
-            copy_n = list(self.ast.successors(n))[0]
-            self.__reduce_copy(n, copy_n)
-            return
-
-        opr_list = list(self.ast.successors(op))
-        if all(map(self.is_const, opr_list)) and op in self.fn_op_map:
-            op_symbol = self.node(op)['label']
-            self.__reduce_const(n, op, opr_list, self.fn_op_map[op_symbol])
-            return
-
-        # noinspection PyArgumentList
-        self.__dispatch(op)(n, op, opr_list)
-
-    def __reduce_xor(self, n: str, op: str, opr_list):
-        if len(opr_list) == 1:
-            self.merge_node(n, op)
-            self.merge_node(n, opr_list[0])
-            return
-
-        for i, k in [(0, 1), (1, 0)]:
-            if self.is_const(opr_list[i]):
-                val, var = opr_list[i], opr_list[k]
-                c_val = int(self.node(opr_list[i])['label'], 16)
-                if c_val == 0xFFFF_FFFF:
-                    self.ast.remove_node(val)
-                    self.node(op)['label'] = '~'
-                elif c_val == 0:
-                    self.merge_node(n, op)
-                    self.merge_node(n, var)
-                    self.ast.remove_node(val)
-                return
-
-    def __reduce_and(self, n: str, op: str, opr_list):
-        if len(opr_list) == 1:
-            self.merge_node(n, op)
-            self.merge_node(n, opr_list[0])
-            return
-
-        for i, k in [(0, 1), (1, 0)]:
-            if self.is_const(opr_list[i]):
-                val, var = opr_list[i], opr_list[k]
-                val_node = self.node(opr_list[i])
-                c_val = int(val_node['label'], 16)
-                if c_val == 0xFFFF_FFFF:
-                    self.merge_node(n, op)
-                    self.merge_node(n, var)
-                    self.ast.remove_node(val)
-                elif c_val == 0:
-                    self.ast.remove_nodes_from(opr_list)
-                    self.ast.remove_node(op)
-
-                    self.node(op)['ntyp'] = 'c'
-                    self.node(op)['label'] = val_node['label']
-                return
-
-    def __reduce_or(self, n: str, op: str, opr_list):
-        if len(opr_list) == 1:
-            self.merge_node(n, op)
-            self.merge_node(n, opr_list[0])
-            return
-
-        for i, k in [(0, 1), (1, 0)]:
-            if self.is_const(opr_list[i]):
-                val, var = opr_list[i], opr_list[k]
-                val_node = self.node(opr_list[i])
-                c_val = int(val_node['label'], 16)
-                if c_val == 0xFFFF_FFFF:
-                    self.ast.remove_nodes_from(opr_list)
-                    self.ast.remove_node(op)
-
-                    self.node(op)['ntyp'] = 'c'
-                    self.node(op)['label'] = val_node['label']
-                elif c_val == 0:
-                    self.merge_node(n, op)
-                    self.merge_node(n, var)
-                    self.ast.remove_node(val)
-                return
-
-    def __reduce_default(self, n, op, opr_list):
-        pass
-
-    def __reduce_const(self, n, op, opr_list, fn_op):
-        node = self.node(n)
-
-        opr_list_ = map(lambda x: self.node(x)['label'], opr_list)
-        opr_list_ = map(lambda x: int(x, 16), opr_list_)
-        result = reduce(fn_op, opr_list_)
-
-        self.ast.remove_nodes_from(opr_list)
-        self.ast.remove_node(op)
-
-        node['ntyp'] = 'c'
-        node['label'] = hex(result)
-
-    def __reduce_copy(self, n, copy_n):
-        self.merge_node(n, copy_n)
-
-    def __dispatch(self, op):
-        op_symbol = self.node(op)['label']
-        if op_symbol not in self.fn_reduce_map:
-            op_symbol = '?'
-        return self.fn_reduce_map[op_symbol]
+    def __visit(self, n):
+        if self.is_op(n):
+            return self.__rewrite(n)
+
+        if self.ast.out_degree[n] == 1:
+            copy_n = next(self.ast.successors(n))
+            if self.is_var(copy_n):
+                self.merge_node(n, copy_n)
+                return [n, *self.ast.predecessors(n)]
+        return []
+
+    def __rewrite(self, op):
+        kinds = tuple(operand_kind(self.ast, s)
+                      for s in self.ast.successors(op))
+        width = node_width(self.ast, op)
+        cast = self.ast.get_attr(op, 'cast')
+        for rule in self.rules.candidates(op_label(self.ast, op), kinds):
+            # a cast on op has to go onto the result, not onto a shared node
+            if cast and isinstance(rule.rhs, str):
+                continue
+            binds = match(self.ast, op, rule.lhs, width)
+            if binds is None:
+                continue
+
+            new = self.__build(rule.rhs, binds, width,
+                               self.ast.get_attr(op, 'typ'))
+            if cast:
+                self.ast.set_attr(new, 'cast', cast)
+            users = list(self.ast.predecessors(op))
+            oprs = list(self.ast.successors(op))
+            # users of op now use new in its place
+            self.merge_node(new, op)
+            self.drop_unused(oprs)
+            return [new, *users]
+        return []
+
+    def __fresh_name(self, label):
+        # a batch of components cut out of a graph can hold names with ids
+        # beyond its own
+        return self.ast.free_name(f'{label}#r{self.ast.id_bound()}')
+
+    def __build(self, rhs, binds, width, typ):
+        if isinstance(rhs, str):
+            return binds[rhs]
+        if isinstance(rhs, int):
+            label = hex(rhs & bit_mask(width))
+            return self.ast.add_node(self.__fresh_name(label), label,
+                                     'c', typ=typ or f'i{width}')
+
+        label = rhs[0]
+        attrs = {'typ': typ} if typ else {}
+        n = self.ast.add_node(self.__fresh_name(label), label, 'op',
+                              **attrs)
+        for opr in rhs[1:]:
+            self.ast.add_edge(n, self.__build(opr, binds, width, typ))
+        return n
+
+
+class Test(unittest.TestCase):
+    @staticmethod
+    def simplify(block):
+        from analysis.analysis_manager import AnalysisManager
+        from analysis.fold_constant import FoldConstant
+        from analysis.value_numbering import ValueNumbering
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser()
+        parser.parser(block)
+        return AnalysisManager([ValueNumbering(), FoldConstant(),
+                                Simplify()])(parser.ast)
+
+    def shape(self, ast, name):
+        def walk(n):
+            oprs = [walk(s) for s in ast.successors(n)]
+            return (ast.label(n), *oprs) if oprs else ast.label(n)
+        return walk(ast.node_id(name))
+
+    def test_rules_hold(self):
+        from analysis.rewrite import check_rule
+
+        for lhs, rhs in rules:
+            self.assertIsNone(check_rule(lhs, rhs), f'{lhs} -> {rhs}')
+
+    def test_width(self):
+        # all ones is whatever the width of the op says
+        ast = self.simplify('%1 = xor i8 %a, 255\n'
+                            '%2 = and i64 %b, 4294967295\n'
+                            '%3 = or i16 %c, -1\n')
+        self.assertEqual(('%1', ('~', '%a')), self.shape(ast, '$1'))
+        self.assertEqual(('%2', ('&', '%b', '4294967295')),
+                         self.shape(ast, '$2'))
+        self.assertEqual('0xffff', self.shape(ast, '$3'))
+
+    def test_mba(self):
+        ast = self.simplify('%1 = xor i32 %a, %b\n'
+                            '%2 = and i32 %b, %a\n'
+                            '%3 = mul i32 %2, 2\n'
+                            '%4 = add i32 %1, %3\n'
+                            '%5 = or i32 %a, %b\n'
+                            '%6 = sub i32 %5, %2\n')
+        self.assertEqual(('%4', ('+', '%a', '%b')), self.shape(ast, '$4'))
+        self.assertEqual(('%6', ('^', '%a', '%b')), self.shape(ast, '$6'))
+
+    def test_nested(self):
+        from bap_ir_parser import BapIrBlockParser
+
+        # the inner ~~ has no var of its own to hang off, the cast stays
+        parser = BapIrBlockParser()
+        parser.parser('0005af1f: RSI := low:32[RDX] & ~~(RAX ^ 0)\n')
+        ast = Simplify().run(parser.ast)
+        self.assertEqual(('RSI.1', ('&', ('low:32', 'RDX.0'), 'RAX.0')),
+                         self.shape(ast, 'RSI.1'))
@@ -0,0 +1,135 @@
+import unittest
+
+from analysis.AnalysisBase import DiGraphAnalysisBase, const_value, \
+    is_inner
+from ir_graph import IrGraph
+
+
+commutative_ops = {
+    '&', '|', '^', '+', '*', '=', '<>',
+    'and', 'or', 'xor', 'add', 'mul',
+}
+
+
+class HashCons:
+    def __init__(self, ast: IrGraph):
+        self.ast = ast
+        self.table = {}
+
+    def intern(self, n):
+        # Requires the operands of n to be interned already. Returns the
+        # representative of n, which n has been merged into if it differs.
+        key = self.key(n)
+        if key is None:
+            return n
+
+        rep = self.table.get(key)
+        if rep is None or rep == n or not self.ast.has_node(rep) or \
+                self.key(rep) != key:
+            self.table[key] = n
+            return n
+
+        # nothing points from rep to n, so this just redirects n's users
+        self.ast.merge_node(rep, n)
+        return rep
+
+    def key(self, n):
+        ntyp = self.ast.ntyp(n)
+        typ = self.ast.get_attr(n, 'typ')
+        cast = self.ast.get_attr(n, 'cast')
+        if ntyp == 'c':
+            if not is_inner(self.ast, n):
+                # a var folded to a constant is still a definition of its
+                # own, however many others hold the same value
+                return None
+            try:
+                value = const_value(self.ast.label(n))
+            except ValueError:
+                value = self.ast.label(n)
+            return 'c', value, typ, cast
+
+        if ntyp == 'op':
+            label = self.ast.label(n)
+            oprs = list(self.ast.successors(n))
+            if label in commutative_ops:
+                oprs.sort(key=self.number)
+                self.ast.reorder_successors(n, oprs)
+            return label, typ, cast, tuple(map(self.number, oprs))
+        return None
+
+    def number(self, n):
+        # a var defined by a single expression has the number of that one
+        while self.ast.ntyp(n) in ('v', 'ce') and self.ast.out_degree[n] == 1 \
+                and not self.ast.get_attr(n, 'cast'):
+            n = next(self.ast.successors(n))
+        return n
+
+
+class ValueNumbering(DiGraphAnalysisBase):
+    def __init__(self):
+        super().__init__()
+        self.hash_cons = None
+
+    def run(self, ast: IrGraph, scope=None):
+        super().run(ast, scope)
+        if self.hash_cons is None or self.hash_cons.ast is not ast:
+            # a fresh table has to see the whole graph, not only the scope
+            self.hash_cons = HashCons(ast)
+            scope = None
+
+        roots = self.ast.nodes if scope is None else scope
+        for n in list(self.post_order(list(roots))):
+            if self.ast.has_node(n):
+                self.hash_cons.intern(n)
+        return self.ast
+
+
+class Test(unittest.TestCase):
+    block = '''
+%1882 = xor i32 0xFFFFFFFF, 0xFFFFFFFF
+%1888 = xor i32 %shl2.i92, 0xFFFFFFFF
+%1889 = xor i32 0xFFFFFFFF, %shl2.i92
+%1890 = and i32 %1888, 0x2E2882F
+%1891 = and i32 0x2E2882F, %1889
+%1892 = xor i32 0xFFFFFFFF, 0xFFFFFFFF
+'''
+
+    def check(self, ast):
+        def op_of(var):
+            return next(ast.successors(ast.node_id(var)))
+
+        self.assertEqual(op_of('$1882'), op_of('$1892'))
+        self.assertEqual(op_of('$1888'), op_of('$1889'))
+        self.assertEqual(op_of('$1890'), op_of('$1891'))
+
+        labels = [ast.label(n) for n in ast.nodes]
+        self.assertEqual(1, labels.count('0xFFFFFFFF'))
+        self.assertEqual(1, labels.count('0x2E2882F'))
+
+    def test_value_numbering(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser()
+        parser.parser(self.block)
+        self.check(ValueNumbering().run(parser.ast))
+
+    def test_hash_cons_at_parse_time(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser(hash_cons=True)
+        parser.parser(self.block)
+        self.check(parser.ast)
+        self.assertEqual(12, len(parser.ast))
+
+    def test_folded_definitions(self):
+        from analysis.analysis_manager import AnalysisManager
+        from analysis.fold_constant import FoldConstant
+        from bap_ir_parser import BapIrBlockParser
+
+        # equal values, but each register keeps its own definition
+        parser = BapIrBlockParser()
+        parser.parser('00000001: RAX := 0x1 + 0x2\n'
+                      '00000002: RBX := 0x2 + 0x1\n')
+        ast = AnalysisManager([ValueNumbering(), FoldConstant()])(parser.ast)
+        self.assertEqual(['0x3', '0x3'], [ast.label(ast.node_id(name))
+                                          for name in ('RAX.1', 'RBX.1')])
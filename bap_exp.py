@@ -0,0 +1,166 @@
+import re
+import unittest
+from collections import namedtuple
+
+
+Var = namedtuple('Var', 'name')
+Const = namedtuple('Const', 'text width')
+UnOp = namedtuple('UnOp', 'op opr')
+BinOp = namedtuple('BinOp', 'op lhs rhs')
+Cast = namedtuple('Cast', 'kind width opr')
+
+Token = namedtuple('Token', 'kind text pos')
+
+
+class BapIrParseError(ValueError):
+    def __init__(self, msg, lineno=None, line=None):
+        self.msg = msg
+        self.lineno = lineno
+        self.line = line
+        where = f'line {lineno}: ' if lineno is not None else ''
+        ctx = f' in {line!r}' if line is not None else ''
+        super().__init__(f'{where}{msg}{ctx}')
+
+
+# binding power of the binary operators, the higher the tighter
+binop_bp = {
+    '|': 10,
+    '^': 20,
+    '&': 30,
+    '=': 40, '<>': 40,
+    '<': 50, '<=': 50, '<$': 50, '<=$': 50,
+    '<<': 60, '>>': 60, '~>>': 60,
+    '+': 70, '-': 70,
+    '*': 80, '/': 80, '/$': 80, '%': 80, '%$': 80,
+}
+unop_bp = 90
+unop_list = {'~', '-'}
+cast_kinds = {'pad', 'extend', 'low', 'high', 'signed', 'unsigned'}
+
+_token_re = re.compile(r'''
+    \s*(?:
+      (?P<cast>(?P<kind>[a-z]+):(?P<width>\d+)\[)
+    | (?P<num>0x[0-9a-fA-F]+|\d+)(?::(?P<num_width>\d+))?
+    | (?P<name>[A-Za-z_#][\w#.']*)
+    | (?P<op>~>>|<=\$|<<|>>|<=|<>|<\$|/\$|%\$|[-+*/%&|^~=<()\]])
+    )''', re.X)
+
+
+def tokenize(exp: str, lineno=None):
+    pos, end = 0, len(exp.rstrip())
+    while pos < end:
+        m = _token_re.match(exp, pos)
+        if not m or m.end() == pos:
+            raise BapIrParseError(f'Unexpected {exp[pos:].strip()[:1]!r} '
+                                  f'at column {pos}', lineno, exp)
+        kind = m.lastgroup if m.lastgroup != 'num_width' else 'num'
+        if kind in ('kind', 'width'):
+            kind = 'cast'
+        if kind == 'cast' and m.group('kind') not in cast_kinds:
+            raise BapIrParseError(f'Unknown cast {m.group("kind")!r} '
+                                  f'at column {pos}', lineno, exp)
+        yield m, Token(kind, m.group(kind), m.start(kind))
+        pos = m.end()
+
+
+def parse_exp(exp: str, lineno=None):
+    # Operator precedence parsing with explicit operand/operator stacks, so
+    # the tree is built in one pass over the tokens and casts or parens can
+    # nest arbitrarily deep without hitting the recursion limit.
+    oprs, ops = [], []
+    expect_opr = True
+
+    def error(msg, pos):
+        raise BapIrParseError(f'{msg} at column {pos}', lineno, exp)
+
+    def reduce():
+        kind, op = ops.pop()[:2]
+        if kind == 'un':
+            oprs.append(UnOp(op, oprs.pop()))
+        else:
+            rhs = oprs.pop()
+            oprs.append(BinOp(op, oprs.pop(), rhs))
+
+    def close(opening, pos):
+        while ops and ops[-1][0] in ('un', 'bin'):
+            reduce()
+        if not ops or ops[-1][0] != opening:
+            error(f'Unmatched {"]" if opening == "cast" else ")"!r}', pos)
+        marker = ops.pop()
+        if opening == 'cast':
+            oprs.append(Cast(marker[1], marker[2], oprs.pop()))
+
+    for m, tok in tokenize(exp, lineno):
+        if expect_opr:
+            if tok.kind == 'num':
+                width = m.group('num_width')
+                oprs.append(Const(tok.text, int(width) if width else None))
+                expect_opr = False
+            elif tok.kind == 'name':
+                oprs.append(Var(tok.text))
+                expect_opr = False
+            elif tok.kind == 'cast':
+                ops.append(('cast', m.group('kind'), int(m.group('width')),
+                            tok.pos))
+            elif tok.text == '(':
+                ops.append(('(', None, None, tok.pos))
+            elif tok.text in unop_list:
+                ops.append(('un', tok.text, unop_bp, tok.pos))
+            else:
+                error(f'Unexpected {tok.text!r}', tok.pos)
+        elif tok.text in binop_bp:
+            bp = binop_bp[tok.text]
+            while ops and ops[-1][0] in ('un', 'bin') and ops[-1][2] >= bp:
+                reduce()
+            ops.append(('bin', tok.text, bp, tok.pos))
+            expect_opr = True
+        elif tok.text == ']':
+            close('cast', tok.pos)
+        elif tok.text == ')':
+            close('(', tok.pos)
+        else:
+            error(f'Unexpected {tok.text!r}', tok.pos)
+
+    if expect_opr:
+        error('Unexpected end of expression', len(exp))
+    while ops:
+        if ops[-1][0] not in ('un', 'bin'):
+            error(f'Expected {"]" if ops[-1][0] == "cast" else ")"!r}',
+                  ops[-1][3])
+        reduce()
+    return oprs.pop()
+
+
+class Test(unittest.TestCase):
+    def test_parse_exp(self):
+        rsi, rdx = Var('RSI'), Var('RDX')
+        cases = [
+            ('low:32[RSI] & 0xD7D921C0',
+             BinOp('&', Cast('low', 32, rsi), Const('0xD7D921C0', None))),
+            ('pad:64[low:32[RSI] << 6]',
+             Cast('pad', 64,
+                  BinOp('<<', Cast('low', 32, rsi), Const('6', None)))),
+            ('~low:32[RDX]', UnOp('~', Cast('low', 32, rdx))),
+            ('RSI | RDX & 0x1:32 ^ ~RSI',
+             BinOp('|', rsi,
+                   BinOp('^', BinOp('&', rdx, Const('0x1', 32)),
+                         UnOp('~', rsi)))),
+            ('(RSI | RDX) - #11290',
+             BinOp('-', BinOp('|', rsi, rdx), Var('#11290'))),
+        ]
+        for exp, expect in cases:
+            self.assertEqual(expect, parse_exp(exp))
+
+    def test_deep_nesting(self):
+        exp = 'RSI'
+        for _ in range(2000):
+            exp = f'pad:64[low:32[{exp}]]'
+        e = parse_exp(exp)
+        self.assertEqual(('pad', 64), (e.kind, e.width))
+
+    def test_error(self):
+        for exp in ['low:32[RSI', 'RSI &', 'RSI $ 1', 'wat:8[RSI]']:
+            with self.assertRaises(BapIrParseError) as ctx:
+                parse_exp(exp, lineno=7)
+            self.assertEqual(7, ctx.exception.lineno)
+            self.assertIn('line 7', str(ctx.exception))
@@ -1,75 +1,156 @@
 import re
 import unittest
 
-import pydot
+from analysis.AnalysisBase import bit_width
+from analysis.value_numbering import HashCons
+from bap_exp import BapIrParseError, BinOp, Cast, Const, Var, parse_exp, \
+    tokenize
+from ir_graph import IrGraph
+from ir_reader import numbered_inst_lines, rereadable, \
+    reversed_inst_lines
 
 
 class BapIrBlockParser:
-    def __init__(self):
-        self.ast = pydot.Dot()
+    def __init__(self, hash_cons=False):
+        self.ast = IrGraph()
         self.__id_base = 0
         self.__id_ssa_base = {}
-
-    def parser(self, ir_block: str):
-        for inst_line in ir_block.split(sep='\n'):
-            inst_line = inst_line.strip()
-            if not inst_line:
-                continue
-            self.__parse_inst_line(inst_line)
-
-    def __parse_inst_line(self, line):
-        r = re.match(r'[0-9a-z]{8}: ([^\b]+) := (.+)', line)
+        # (casts, var) -> the op casting var, and back
+        self.__casts = {}
+        self.__cast_of = {}
+        self.hash_cons = HashCons(self.ast) if hash_cons else None
+
+    def parser(self, ir_block):
+        for lineno, inst_line in numbered_inst_lines(ir_block):
+            self.__parse_inst_line(lineno, inst_line)
+
+    def parse_slice(self, ir_block, targets=()):
+        # only the lines the targets depend on, see backward_slice; the
+        # left out definitions still count, so the ssa names stay the ones
+        # a full parse would give
+        kept, count = backward_slice(ir_block, targets)
+        for var, exp, ssa in kept:
+            self.__id_ssa_base.update(ssa)
+            self.__handle_exp(var, exp)
+        self.__id_ssa_base.update(count)
+
+    def parse_line(self, lineno, line, ssa):
+        # one instruction into a graph parsed already, ssa giving the number
+        # each of its registers has up to that line, see def_use
+        self.__id_ssa_base.update(ssa)
+        self.__parse_inst_line(lineno, line)
+
+    def __parse_inst_line(self, lineno, line):
+        r = _inst_line_re.match(line)
         if not r:
-            print(f'Failed to parse {line}')
-            return
+            raise BapIrParseError('Not an assignment', lineno, line)
 
         var, exp = r.groups()
-        node_op = self.__parse_exp(exp)
+        self.__handle_exp(var, parse_exp(exp, lineno))
+
+    def __handle_exp(self, var, exp):
+        start = self.ast.id_bound()
+        node_op, width = self.__build_exp(exp)
+        if self.hash_cons:
+            # op nodes are created before their operands, so interning the
+            # new nodes backwards sees the operands first
+            for n in reversed(range(start, self.ast.id_bound())):
+                if self.ast.has_node(n):
+                    node = self.hash_cons.intern(n)
+                    node_op = node if n == node_op else node_op
         node_var = self.__var_node(var, False)
-        edge = pydot.Edge(node_var, node_op)
-        self.ast.add_edge(edge)
-
-    def __parse_exp(self, s: str):
-        s = s.strip()
-        op, opr_list = _break_exp(s)
-        if op is None:
-            if _is_cast(s):
-                # unwrap the cast
-                start, end = s.index('[') + 1, s.rindex(']')
-                return self.__parse_exp(s[start:end])
-
-            # is var
-            return self.__var_node(s, True)
+        if width:
+            self.ast.set_attr(node_var, 'typ', f'i{width}')
+        self.ast.add_edge(node_var, node_op)
+
+    def __build_exp(self, exp):
+        # Iterative post-order walk over the expression tree. Op nodes are
+        # created on the way down so that node ids follow the textual order.
+        # Each result is (node, width).
+        results, stack = [], [(exp, None)]
+        while stack:
+            e, node_op = stack.pop()
+            if isinstance(e, Var):
+                results.append((self.__var_node(e.name, True), None))
+            elif isinstance(e, Const):
+                results.append((self.__const_node(e), e.width))
+            elif node_op is None:
+                node_op = -1 if isinstance(e, Cast) else self.__op_node(e.op)
+                stack.append((e, node_op))
+                stack.extend((opr, None) for opr in reversed(_operands(e)))
+            elif isinstance(e, Cast):
+                results.append(self.__cast(*results.pop(), e))
+            else:
+                results.append(self.__link_op(node_op, results, len(e) - 1))
+        return results.pop()
+
+    def __cast(self, node, width, cast: Cast):
+        cast_name = f'{cast.kind}:{cast.width}'
+        if self.ast.ntyp(node) == 'v' or node in self.__cast_of:
+            # a var is shared by all its uses, the cast goes onto an op of
+            # its own passing the value through at the width of the var
+            var, inner = self.__cast_of.get(node, (node, None))
+            if inner:
+                cast_name = f'{cast_name} {inner}'
+                if self.ast.in_degree[node] == 0:
+                    self.ast.remove_node(node)
+            return self.__cast_node(var, cast_name), cast.width
+
+        inner = self.ast.get_attr(node, 'cast')
+        self.ast.set_attr(node, 'cast',
+                          f'{cast_name} {inner}' if inner else cast_name)
+        return node, cast.width
+
+    def __cast_node(self, var, cast_name):
+        # the same cast of the same var is one node for all its uses
+        n = self.__casts.get((cast_name, var))
+        if n is not None and self.ast.has_node(n) and \
+                self.ast.label(n) == cast_name and \
+                list(self.ast.successors(n)) == [var]:
+            return n
+
+        typ = self.ast.get_attr(var, 'typ') or f'i{bit_width(None)}'
+        n = self.ast.add_node(f'cast#{self.__id():02}', cast_name, 'op',
+                              typ=typ, cast=cast_name)
+        self.ast.add_edge(n, var)
+        self.__casts[cast_name, var] = n
+        self.__cast_of[n] = var, cast_name
+        return n
 
-        node_op = self.__op_node(op)
-        for opr in opr_list:
-            node_opr = self.__parse_exp(opr)
-            edge = pydot.Edge(node_op, node_opr)
-            self.ast.add_edge(edge)
+    def __link_op(self, node_op, results, arity):
+        oprs = results[-arity:]
+        del results[-arity:]
 
-        return node_op
+        width = next((w for _, w in oprs if w), None)
+        for node_opr, _ in oprs:
+            self.ast.add_edge(node_op, node_opr)
+            if width and self.ast.ntyp(node_opr) == 'c' and \
+                    not self.ast.get_attr(node_opr, 'typ'):
+                self.ast.set_attr(node_opr, 'typ', f'i{width}')
+        if width:
+            self.ast.set_attr(node_op, 'typ', f'i{width}')
+        return node_op, width
 
     def __op_node(self, op: str):
-        op_name, ntyp = f'"{op}#{self.__id():02}"', 'op'
-        n = pydot.Node(op_name, label=op, ntyp=ntyp)
-        self.ast.add_node(n)
-        return n
+        op_name, ntyp = f'{op}#{self.__id():02}', 'op'
+        return self.ast.add_node(op_name, op, ntyp)
+
+    def __const_node(self, const: Const):
+        const_name, ntyp = f'{const.text}#{self.__id()}', 'c'
+        if const.width:
+            return self.ast.add_node(const_name, const.text, ntyp,
+                                     typ=f'i{const.width}')
+        return self.ast.add_node(const_name, const.text, ntyp)
 
     def __var_node(self, var: str, is_use):
-        if _is_const(var):
-            var_name, ntyp = f'"{var}#{self.__id()}"', 'c'
-        else:
-            var_name, ntyp = self.__ssa_use_var_name(var) if is_use else \
-                self.__ssa_def_var_name(var), 'v'
-            var = var_name
-
-        n = self.ast.get_node(var_name)
-        if n:
-            return n[0]
-
-        n = pydot.Node(var_name, label=var, ntyp=ntyp)
-        self.ast.add_node(n)
-        return n
+        var_name, ntyp = self.__ssa_use_var_name(var) if is_use else \
+            self.__ssa_def_var_name(var), 'v'
+
+        n = self.ast.node_id(var_name)
+        if n is not None:
+            return n
+
+        return self.ast.add_node(var_name, var_name, ntyp)
 
     def __ssa_def_var_name(self, var: str):
         self.__id_ssa_base[var] = 1 + (self.__id_ssa_base.get(var) or 0)
@@ -85,71 +166,91 @@ class BapIrBlockParser:
         return self.__id_base
 
 
-unop_list = {
-    '~', '-'
-}
-
-
-def _is_cast(exp: str):
-    cast_prefix_list = [
-        'extend:', 'pad:', 'low:', 'high:'
-    ]
-    return any(map(exp.startswith, cast_prefix_list))
-
-
-def _is_const(exp: str):
-    return exp.startswith('0x') or exp.isdigit()
-
-
-def _break_exp(exp: str):
-    sub_exps = []
-    start = 0
-    cnt = 0
-
-    for i, c in enumerate(exp + ' '):
-        if c == '[':
-            cnt += 1
-        elif c == ']':
-            cnt -= 1
-
-        if cnt == 0 and c in [' ', '~']:
-            sub_exp = exp[start:i+1].strip()
-            sub_exp and sub_exps.append(sub_exp)
-            start = i + 1
-
-    if len(sub_exps) == 1:
-        if _is_cast(exp):
-            # unwrap the cast
-            start, end = exp.index('[') + 1, exp.rindex(']')
-            return _break_exp(exp[start:end])
-
-        return None, sub_exps
-
-    if len(sub_exps) == 2:
-        op = sub_exps[0]
-        opr_list = [sub_exps[1]]
-    elif len(sub_exps) == 3:
-        op = sub_exps[1]
-        opr_list = [sub_exps[0], sub_exps[2]]
-    else:
-        raise RuntimeError(f'Unknown sub_exp_list len: {len(sub_exps)}')
-
-    assert op in ['~', '+', '-', '*', '/', '<<', '>>', '&', '|', '^']
-    return op, opr_list
+_inst_line_re = re.compile(r'[0-9a-z]{8}: ([^\b]+) := (.+)')
+
+
+def backward_slice(ir_block, targets=()):
+    # Walks the instruction lines backwards from the targets, ssa names
+    # like RDX.3 or bare registers standing for their last definition, by
+    # default the last definition of every register. Only the definitions
+    # are counted going forwards, and only kept lines are held, as
+    # (var, exp, ssa) first to last, ssa numbering the registers the line
+    # reads and the one it defines as they are before it. Returns those
+    # and the number of definitions of every register. ir_block is gone
+    # through twice, so it can not be a generator or a pipe.
+    if not rereadable(ir_block):
+        raise TypeError('Slicing needs a str, a list of lines or a '
+                        'seekable file')
+    count = {}
+    for lineno, line in numbered_inst_lines(ir_block):
+        r = _inst_line_re.match(line)
+        if not r:
+            raise BapIrParseError('Not an assignment', lineno, line)
+        var = r.group(1)
+        count[var] = count.get(var, 0) + 1
+    live = {_ssa_target(t, count) for t in targets} if targets else \
+        {f'{var}.{n}' for var, n in count.items()}
+
+    kept, left = [], dict(count)
+    for lineno, line in reversed_inst_lines(ir_block):
+        if not live:
+            break
+        var, exp = _inst_line_re.match(line).groups()
+        name = f'{var}.{left[var]}'
+        # from here on back the uses see the definition before this one
+        left[var] -= 1
+        if name not in live:
+            continue
+        live.discard(name)
+        exp = parse_exp(exp, lineno)
+        uses = set(_var_names(exp))
+        ssa = {reg: left.get(reg, 0) for reg in (var, *uses)}
+        live.update(f'{reg}.{ssa[reg]}' for reg in uses)
+        kept.append((var, exp, ssa))
+    kept.reverse()
+    return kept, count
+
+
+def def_use(lineno, line):
+    # the register an instruction line defines and the ones it reads, in
+    # the order they first appear
+    r = _inst_line_re.match(line)
+    if not r:
+        raise BapIrParseError('Not an assignment', lineno, line)
+    var, exp = r.groups()
+    return var, tuple(dict.fromkeys(token.text for _, token
+                                    in tokenize(exp, lineno)
+                                    if token.kind == 'name'))
+
+
+def _ssa_target(target: str, count):
+    var, _, num = target.rpartition('.')
+    if var and num.isdigit():
+        if int(num) > count.get(var, 0):
+            raise ValueError(f'{target} is never defined')
+        return target
+    if target not in count:
+        raise ValueError(f'{target} is never defined')
+    return f'{target}.{count[target]}'
+
+
+def _var_names(exp):
+    stack = [exp]
+    while stack:
+        e = stack.pop()
+        if isinstance(e, Var):
+            yield e.name
+        elif not isinstance(e, Const):
+            stack.extend(_operands(e))
+
+
+def _operands(exp):
+    if isinstance(exp, BinOp):
+        return [exp.lhs, exp.rhs]
+    return [exp.opr]
 
 
 class Test(unittest.TestCase):
-    def test_break_exp(self):
-        cases = [
-            ('low:32[RSI] & 0xD7D921C0', ('&', ['low:32[RSI]', '0xD7D921C0'])),
-            ('pad:64[low:32[RSI] << 6]', ('<<', ['low:32[RSI]', '6'])),
-            ('low:32[RSI] << 6', ('<<', ['low:32[RSI]', '6'])),
-            ('~low:32[RDX]', ('~', ['low:32[RDX]']))
-        ]
-        for exp, expect in cases:
-            output = _break_exp(exp)
-            self.assertEqual(expect, output)
-
     def test_parse_inst_line(self):
         block = '0005b299: RBP := pad:64[low:32[RBP] ^ 0x8FB392AA]'
         parser = BapIrBlockParser()
@@ -172,3 +273,75 @@ class Test(unittest.TestCase):
         parser = BapIrBlockParser()
         parser.parser(block)
         print(parser.ast)
+
+    def test_cast_width(self):
+        block = '0005b116: RSI := pad:64[low:32[RSI] << 6]'
+        parser = BapIrBlockParser()
+        parser.parser(block)
+
+        ast = parser.ast
+        op = ast.node_id('<<#01')
+        self.assertEqual('i32', ast.get_attr(op, 'typ'))
+        self.assertEqual('pad:64', ast.get_attr(op, 'cast'))
+        self.assertEqual('i64', ast.get_attr(ast.node_id('RSI.1'), 'typ'))
+
+    def test_shared_casts(self):
+        block = '''
+00000001: RAX := pad:64[low:32[RDX] + low:32[RDX]]
+00000002: RBX := pad:64[low:32[RDX]]
+'''
+        parser = BapIrBlockParser()
+        parser.parser(block)
+
+        ast = parser.ast
+        rdx = ast.node_id('RDX.0')
+        casts = sorted(ast.label(n) for n in ast.predecessors(rdx))
+        self.assertEqual(['low:32', 'pad:64 low:32'], casts)
+        add = next(ast.successors(ast.node_id('RAX.1')))
+        self.assertEqual(['low:32', 'low:32'],
+                         [ast.label(n) for n in ast.successors(add)])
+        # the inner cast wrapped by pad:64 on the second line is not left
+        self.assertEqual(6, ast.number_of_nodes())
+
+    def test_parse_slice(self):
+        block = '''
+0005af1f: RSI := pad:64[low:32[RDX]]
+0005af28: RSI := pad:64[~low:32[RSI]]
+0005af37: RAX := pad:64[low:32[RSI] & 0x5312623B]
+0005af5e: RDX := pad:64[low:32[RDX] & 0xACED9DC4]
+0005af85: RSI := pad:64[low:32[RBX]]
+0005af90: RAX := pad:64[low:32[RAX] | low:32[RDX]]
+0005afa6: RDX := pad:64[low:32[RCX]]
+'''
+        def kept(targets=()):
+            return [f'{var}.{ssa[var] + 1}'
+                    for var, _, ssa in backward_slice(block, targets)[0]]
+
+        self.assertEqual(['RSI.1', 'RSI.2', 'RAX.1', 'RDX.1', 'RAX.2'],
+                         kept(['RAX']))
+        self.assertEqual(['RSI.1', 'RDX.2'], kept(['RSI.1', 'RDX']))
+        # by default whatever the registers end up holding
+        self.assertEqual(7, len(kept()))
+        with self.assertRaises(ValueError):
+            kept(['RSI.4'])
+        with self.assertRaises(TypeError):
+            backward_slice(iter(block.splitlines()))
+
+        full, sliced = BapIrBlockParser(), BapIrBlockParser()
+        full.parser(block)
+        sliced.parse_slice(block, ['RSI', 'RAX.1'])
+        names = {sliced.ast.name(n) for n in sliced.ast
+                 if sliced.ast.ntyp(n) == 'v'}
+        self.assertEqual({'RSI.3', 'RBX.0', 'RAX.1', 'RSI.2', 'RSI.1',
+                          'RDX.0'}, names)
+        self.assertTrue(all(full.ast.node_id(name) is not None
+                            for name in names))
+
+    def test_parse_error(self):
+        block = '''
+0005af1f: RSI := pad:64[low:32[RDX]]
+0005af28: RSI := pad:64[~low:32[RSI]
+'''
+        with self.assertRaises(BapIrParseError) as ctx:
+            BapIrBlockParser().parser(block)
+        self.assertEqual(3, ctx.exception.lineno)
@@ -0,0 +1,275 @@
+import concurrent.futures as cf
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import time
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+from drawer import ASTDrawer, parse_formats
+from main import analyze
+from result_cache import ResultCache
+
+ir_exts = ('.bc', '.bir')
+
+
+def collect_files(source):
+    # a directory is searched recursively, anything else is a glob pattern
+    if os.path.isdir(source):
+        files = [os.path.join(root, f)
+                 for root, _, names in os.walk(source) for f in names]
+    else:
+        files = glob.glob(source, recursive=True)
+    return sorted(f for f in files if f.endswith(ir_exts))
+
+
+def batch(source='.out', tag='ana-new', workers=None, render_workers=None,
+          timeout=60, render_timeout=60, fmt='png', render=True,
+          max_iterations=16, time_budget=None, cache_dir=None,
+          cache_size=1 << 30, report=None):
+    files = collect_files(source)
+    tag = f'-{tag}' if tag else tag
+    formats = [f for f in parse_formats(fmt) if f != 'dot']
+    render = render and formats
+    started = time.monotonic()
+
+    results = {}
+    # analysis runs in the process pool, each finished .dot file is handed
+    # over to a thread that waits on its dot subprocess
+    with cf.ThreadPoolExecutor(render_workers or workers) as renderer:
+        renders = {}
+        for result in _analyze_all(files, tag, workers, timeout,
+                                   max_iterations, time_budget, cache_dir):
+            results[result['file']] = result
+            if render and result['status'] == 'ok':
+                future = renderer.submit(render_dot, result['dot'], formats,
+                                         f'{result["file"]}{tag}',
+                                         render_timeout)
+                renders[future] = result
+        for future in cf.as_completed(renders):
+            renders[future].update(future.result())
+    if cache_dir:
+        ResultCache(cache_dir, cache_size).evict()
+
+    summary = _summarize([results[f] for f in files],
+                         time.monotonic() - started)
+    if report:
+        with open(report, 'w+') as f:
+            json.dump(summary, f, indent=2)
+    print(' '.join(f'{k}: {v}' for k, v in summary['counts'].items()),
+          f'in {summary["seconds"]:.1f}s')
+    return summary
+
+
+def _analyze_all(files, tag, workers, timeout, max_iterations, time_budget,
+                 cache_dir):
+    tasks = [(f, tag, timeout, max_iterations, time_budget, cache_dir)
+             for f in files]
+    for task, result in map_isolated(_analyze_one, tasks, workers):
+        yield result or _result(task[0], 'crashed', 0.,
+                                error='worker process died')
+
+
+def map_isolated(fn, tasks, workers=None, split=None):
+    # Yields (task, fn(*task)) from a process pool as they finish, None for
+    # the result if the worker died. A hard crash breaks the whole pool:
+    # the tasks a worker had started by then are retried each in a pool of
+    # its own, in parallel, so only the one crashing again is lost; the
+    # ones never started go on in a fresh shared pool. split may cut a
+    # started task up into smaller ones to retry.
+    pending = list(tasks)
+    while pending:
+        started = multiprocessing.Array('b', len(pending), lock=False)
+        suspects, rest = [], []
+        with cf.ProcessPoolExecutor(workers, initializer=_track,
+                                    initargs=(started,)) as pool:
+            futures = {pool.submit(_tracked, i, fn, *task): (i, task)
+                       for i, task in enumerate(pending)}
+            for future in cf.as_completed(futures):
+                i, task = futures[future]
+                try:
+                    yield task, future.result()
+                except BrokenProcessPool:
+                    (suspects if started[i] else rest).append(task)
+        if not suspects:
+            # died before any task got going, nothing to blame
+            suspects, rest = rest, []
+        if split:
+            suspects = [t for task in suspects for t in split(task)]
+
+        with cf.ThreadPoolExecutor(len(suspects) or 1) as retries:
+            futures = {retries.submit(_run_alone, fn, task): task
+                       for task in suspects}
+            for future in cf.as_completed(futures):
+                yield futures[future], future.result()
+        pending = rest
+
+
+_started = None
+
+
+def _track(started):
+    global _started
+    _started = started
+
+
+def _tracked(i, fn, *task):
+    _started[i] = 1
+    return fn(*task)
+
+
+def _run_alone(fn, task):
+    with cf.ProcessPoolExecutor(1) as pool:
+        try:
+            return pool.submit(fn, *task).result()
+        except BrokenProcessPool:
+            return None
+
+
+def _analyze_one(ir_file, tag, timeout, max_iterations, time_budget,
+                 cache_dir):
+    started = time.monotonic()
+    cache = ResultCache(cache_dir) if cache_dir else None
+    try:
+        with alarm(timeout):
+            ast = analyze(ir_file, max_iterations, time_budget, cache)
+            dot_file = f'{ir_file}{tag}.dot'
+            ASTDrawer(ast).render(f'{ir_file}{tag}', ['dot'])
+    except Timeout:
+        return _result(ir_file, 'timeout', time.monotonic() - started)
+    except Exception as e:
+        return _result(ir_file, 'failed', time.monotonic() - started,
+                       error=f'{type(e).__name__}: {e}')
+    return _result(ir_file, 'ok', time.monotonic() - started, dot=dot_file,
+                   nodes=ast.number_of_nodes(), edges=ast.number_of_edges())
+
+
+def render_dot(dot_file, formats, save_file, timeout):
+    # every format out of a single dot run
+    started = time.monotonic()
+    args, outputs = [], []
+    for fmt in formats:
+        outputs.append(f'{save_file}.{fmt}')
+        args += [f'-T{fmt}', '-o', outputs[-1]]
+    try:
+        subprocess.run(['dot', *args, dot_file],
+                       check=True, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'render': 'timeout'}
+    except (OSError, subprocess.CalledProcessError) as e:
+        error = e.stderr.decode(errors='replace').strip() \
+            if isinstance(e, subprocess.CalledProcessError) else str(e)
+        return {'render': 'failed', 'render_error': error}
+    return {'render': 'ok', 'render_seconds': time.monotonic() - started,
+            'outputs': outputs}
+
+
+def _result(ir_file, status, seconds, **extra):
+    return dict(file=ir_file, status=status, seconds=seconds, **extra)
+
+
+def _summarize(results, seconds):
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+        if r.get('render') not in (None, 'ok'):
+            key = f'render {r["render"]}'
+            counts[key] = counts.get(key, 0) + 1
+    return {'counts': counts, 'seconds': seconds, 'files': results}
+
+
+def _crash_on(*xs):
+    # for the tests, a worker dying on 1
+    if 1 in xs:
+        os._exit(1)
+    return sum(xs)
+
+
+def _pid_or_crash(x):
+    # for the tests, which worker ran x
+    if x == 1:
+        os._exit(1)
+    return os.getpid()
+
+
+class Timeout(Exception):
+    pass
+
+
+class alarm:
+    # SIGALRM based timeout, only usable on the main thread of a process
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.__handler = None
+
+    def __enter__(self):
+        if self.seconds:
+            self.__handler = signal.signal(signal.SIGALRM, self.__raise)
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, *exc):
+        if self.seconds:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.__handler)
+
+    @staticmethod
+    def __raise(*_):
+        raise Timeout()
+
+
+class Test(unittest.TestCase):
+    def test_batch(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            os.mkdir(os.path.join(d, 'sub'))
+            for name, block in [('good.bir', '00000001: RSI := RDX + 1\n'),
+                                ('sub/good.bc', '%1 = add i32 %reg, 0x1\n'),
+                                ('bad.bir', '00000001: RSI := (RDX\n'),
+                                ('notes.txt', 'not an ir file\n')]:
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(block)
+
+            report = os.path.join(d, 'report.json')
+            summary = batch(d, workers=2, render=False, report=report)
+            self.assertEqual({'ok': 2, 'failed': 1}, summary['counts'])
+            self.assertTrue(os.path.exists(
+                os.path.join(d, 'sub', 'good.bc-ana-new.dot')))
+            with open(report) as f:
+                failed, = [r for r in json.load(f)['files']
+                           if r['status'] == 'failed']
+            self.assertTrue(failed['file'].endswith('bad.bir'))
+            self.assertIn('BapIrParseError', failed['error'])
+
+    def test_map_isolated(self):
+        tasks = [(0,), (1,), (2,), (3,)]
+        results = dict(map_isolated(_crash_on, tasks, workers=2))
+        # the pool broke, only the task crashing again is lost
+        self.assertEqual({(0,): 0, (1,): None, (2,): 2, (3,): 3}, results)
+
+        results = dict(map_isolated(_crash_on, [(2, 1)], workers=2,
+                                     split=lambda t: [(x,) for x in t]))
+        self.assertEqual({(2,): 2, (1,): None}, results)
+
+    def test_map_isolated_not_started(self):
+        # a single worker dies on the first task, the rest never started
+        # and go on together in one fresh pool rather than one each
+        tasks = [(1,), (2,), (3,), (4,)]
+        results = dict(map_isolated(_pid_or_crash, tasks, workers=1))
+        self.assertIsNone(results.pop((1,)))
+        self.assertEqual(1, len(set(results.values())))
+
+    def test_alarm(self):
+        with self.assertRaises(Timeout), alarm(0.05):
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+    # the summary line is printed already, keep fire from dumping the report
+    import fire
+
+    fire.Fire(batch, serialize=lambda _: None)
@@ -0,0 +1,170 @@
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import synth
+from analysis.analysis_manager import AnalysisManager
+from analysis.profiler import StageProfiler
+from drawer import ASTDrawer, parse_formats
+from main import parser_factory, pipeline
+
+BASELINE = 'bench_baseline.json'
+DUMP_DOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'dump_dot.py')
+
+
+def run_once(kind, lines, depth=2, render_limit=5000, memory=False, seed=0):
+    # times every stage on one synthetic block, stage name -> stats
+    block = (synth.llvm_block if kind == 'bc' else synth.bap_block)(
+        lines, depth=depth, seed=seed)
+    profiler = StageProfiler(memory)
+    try:
+        parser = parser_factory(f'block.{kind}')
+        with profiler.stage('parse'):
+            parser.parser(block)
+        ast = AnalysisManager(pipeline(), profiler=profiler)(parser.ast)
+
+        drawer = ASTDrawer(ast)
+        with profiler.stage('write_dot'):
+            drawer.write_dot(io.StringIO())
+        # layout is superlinear and not ours, only done while it stays cheap
+        if shutil.which('dot') and len(ast) <= render_limit:
+            with profiler.stage('render'):
+                drawer.create('svg')
+    finally:
+        profiler.close()
+    return {name: {'seconds': t['wall'],
+                   **({'peak': t['peak']} if 'peak' in t else {})}
+            for name, t in profiler.totals().items()}
+
+
+def bench(sizes=(1000, 10000, 100000), kinds=('bir', 'bc'), depth=2,
+          memory=False, render_limit=5000):
+    # kind -> stage -> size -> stats; with memory the stages run a second
+    # time under tracemalloc, which would skew the timings otherwise
+    results = {}
+    for kind in parse_formats(kinds):
+        for lines in sorted(map(int, parse_formats(sizes))):
+            timed = run_once(kind, lines, depth, render_limit)
+            if memory:
+                traced = run_once(kind, lines, depth, render_limit, True)
+                for stage, stats in traced.items():
+                    timed[stage]['peak'] = stats['peak']
+            for stage, stats in timed.items():
+                results.setdefault(kind, {}).setdefault(stage, {})[
+                    str(lines)] = stats
+    return results
+
+
+def startup(runs=5):
+    # best wall time of a fresh interpreter dumping the dot of a one line
+    # block, what a pipeline calling us per file pays on top of the work
+    with tempfile.TemporaryDirectory() as d:
+        ir_file = os.path.join(d, 'block.bc')
+        with open(ir_file, 'w') as f:
+            f.write('%1 = add i32 %a, 0x1\n')
+        best = math.inf
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, DUMP_DOT, ir_file, '-o',
+                            os.devnull], check=True)
+            best = min(best, time.perf_counter() - started)
+    return best
+
+
+def check(results, baseline=None, max_exponent=1.35, tolerance=2.0,
+          min_seconds=0.05):
+    # Growth faster than n^max_exponent between two sizes fails on its own,
+    # so a quadratic stage shows up even without a baseline. Against a
+    # baseline a stage fails once it is tolerance times slower.
+    failures = []
+    for kind, stages in results.items():
+        for stage, by_size in stages.items():
+            sizes = sorted(by_size, key=int)
+            for small, large in zip(sizes, sizes[1:]):
+                t1 = by_size[small]['seconds']
+                t2 = by_size[large]['seconds']
+                if t2 < min_seconds or t1 <= 0:
+                    continue
+                exponent = math.log(t2 / t1) / math.log(int(large) /
+                                                        int(small))
+                if exponent > max_exponent:
+                    failures.append(f'{kind} {stage}: grows like n^'
+                                    f'{exponent:.2f} from {small} to {large}')
+
+            base = (baseline or {}).get(kind, {}).get(stage, {})
+            for size in sizes:
+                if size not in base:
+                    continue
+                t, t0 = by_size[size]['seconds'], base[size]['seconds']
+                if t > min_seconds and t > t0 * tolerance:
+                    failures.append(f'{kind} {stage}: {t:.3f}s at {size}, '
+                                    f'baseline {t0:.3f}s')
+    return failures
+
+
+def main(sizes=(1000, 10000, 100000), kinds=('bir', 'bc'), depth=2,
+         memory=False, render_limit=5000, baseline=BASELINE, save=False,
+         max_exponent=1.35, tolerance=2.0, max_startup=0.5):
+    results = bench(sizes, kinds, depth, memory, render_limit)
+    for kind, stages in results.items():
+        for stage, by_size in stages.items():
+            cells = [f'{size}: {s["seconds"]:.3f}s' +
+                     (f' {s["peak"] / 2 ** 20:.1f}MiB' if 'peak' in s else '')
+                     for size, s in by_size.items()]
+            print(f'{kind:4} {stage:16}', ', '.join(cells))
+
+    base = None
+    if baseline and os.path.exists(baseline) and not save:
+        with open(baseline) as f:
+            base = json.load(f)
+    failures = check(results, base, max_exponent, tolerance)
+    started = startup()
+    print(f'startup {started:.3f}s')
+    if started > max_startup:
+        failures.append(f'startup: {started:.3f}s, at most {max_startup}s')
+    for failure in failures:
+        print('FAIL', failure)
+
+    if save:
+        with open(baseline, 'w+') as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        raise SystemExit(1)
+
+
+class Test(unittest.TestCase):
+    def test_bench(self):
+        results = bench(sizes=(300, 600), kinds='bir', render_limit=0,
+                        memory=True)
+        stages = results['bir']
+        self.assertEqual({'parse', 'write_dot'} |
+                         {type(p).__name__ for p in pipeline()}, set(stages))
+        self.assertEqual(['300', '600'], list(stages['parse']))
+        self.assertLess(0, stages['parse']['600']['peak'])
+
+    def test_check(self):
+        def stats(*seconds):
+            return {'bir': {'parse': {
+                str(n): {'seconds': s} for n, s in zip((1000, 10000),
+                                                       seconds)}}}
+
+        self.assertEqual([], check(stats(0.1, 1.1)))
+        quadratic, = check(stats(0.1, 10.))
+        self.assertIn('n^2.00', quadratic)
+
+        slower, = check(stats(0.2, 2.), baseline=stats(0.1, 0.9))
+        self.assertIn('baseline 0.900s', slower)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main, serialize=lambda _: None)
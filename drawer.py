@@ -1,79 +1,138 @@
 import io
+import re
+import subprocess
+import tempfile
 import unittest
 
-import pydot
-from matplotlib import image as pimg, pyplot as plt
+from ir_graph import IrGraph
 
-from llvm_ir_parser import LlvmIrBlockParser
+_id_re = re.compile(r'[a-zA-Z_\x80-\xff][a-zA-Z0-9_\x80-\xff]*|'
+                    r'-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?)')
+_keywords = {'node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'}
 
 
 class ASTDrawer:
-    def __init__(self, g, font_name='"Fira Code"'):
-        self.g: pydot.Dot = g
+    def __init__(self, g: IrGraph, font_name='"Fira Code"'):
+        self.ast = g
 
         self.font_name = font_name
+        font = {'fontname': font_name}
         self.style_map = {
-            'v': self.__style_var_node,
-            'c': self.__style_const_node,
-            'ce': self.__style_constexpr_node,
-            'op': self.__style_op_node,
-            '?': self.__style_default_node
+            'v': font,
+            'c': dict(font, shape='box', color='blue'),
+            'ce': dict(font, color='blue'),
+            'op': dict(font, shape='circle', color='red'),
+            'sum': dict(font, shape='folder', style='dashed'),
+            '?': font
         }
 
+    def write_dot(self, f):
+        # streams the styled graph node by node, nothing is built up front
+        ast = self.ast
+        names = {}
+
+        f.write('digraph G {\n')
+        for n in ast.nodes:
+            names[n] = name = _quote(ast.name(n))
+            attrs = ast.attrs(n)
+            attrs.update(self.style_map.get(attrs.get('ntyp'),
+                                            self.style_map['?']))
+            f.write(f'{name} [{_attr_list(attrs)}];\n')
+        for u, v in ast.edges():
+            f.write(f'{names[u]} -> {names[v]};\n')
+        f.write('}\n')
+
+    def to_string(self):
+        s = io.StringIO()
+        self.write_dot(s)
+        return s.getvalue()
+
+    def render(self, save_file, formats=('png',)):
+        # one dot run writes every format, the .dot file is its input when
+        # asked for, otherwise the graph is piped in
+        formats = list(dict.fromkeys(formats))
+        dot_file = f'{save_file}.dot' if 'dot' in formats else None
+        if dot_file:
+            with open(dot_file, 'w+') as f:
+                self.write_dot(f)
+
+        args = []
+        for fmt in formats:
+            if fmt != 'dot':
+                args += [f'-T{fmt}', '-o', f'{save_file}.{fmt}']
+        if args:
+            self.__run_dot(args, dot_file)
+
+    def create(self, fmt='png') -> bytes:
+        return self.__run_dot([f'-T{fmt}'])
+
     def draw(self, show=False, save_file='', fmt='png'):
-        self.__adjust_style()
-        p = self.g.create(format=fmt)
+        if not show:
+            if save_file:
+                self.render(save_file, [fmt])
+            return
+
+        # slow to import, only loaded to show the picture
+        from matplotlib import image as pimg, pyplot as plt
 
+        p = self.create(fmt)
         if save_file:
             with open(f'{save_file}.{fmt}', 'wb+') as f:
                 f.write(p)
 
-        if show:
-            sio = io.BytesIO()
-            sio.write(p)
-            sio.seek(0)
-            img = pimg.imread(sio)
-
-            plt.figure(figsize=(24, 24), dpi=200)
-            plt.imshow(img)
-            plt.show()
-
-    def __adjust_style(self):
-        for n in self.g.get_node_list():
-            t = ASTDrawer.__node_type(n)
-            # noinspection PyArgumentList
-            self.style_map[t](n)
-        return
-
-    def __style_op_node(self, node: pydot.Node):
-        node.set('fontname', self.font_name)
-        node.set('shape', 'circle')
-        node.set('color', 'red')
-
-    def __style_var_node(self, node: pydot.Node):
-        node.set('fontname', self.font_name)
-
-    def __style_const_node(self, node: pydot.Node):
-        node.set('fontname', self.font_name)
-        node.set('shape', 'box')
-        node.set('color', 'blue')
-
-    def __style_constexpr_node(self, node: pydot.Node):
-        node.set('fontname', self.font_name)
-        node.set('color', 'blue')
-
-    def __style_default_node(self, node: pydot.Node):
-        node.set('fontname', self.font_name)
-
-    @staticmethod
-    def __node_type(node: pydot.Node):
-        ntyp = node.get('ntyp')
-        return ntyp if ntyp else 'default'
+        sio = io.BytesIO()
+        sio.write(p)
+        sio.seek(0)
+        img = pimg.imread(sio)
+
+        plt.figure(figsize=(24, 24), dpi=200)
+        plt.imshow(img)
+        plt.show()
+
+    def __run_dot(self, args, dot_file=None):
+        if dot_file:
+            return subprocess.run(['dot', *args, dot_file], check=True,
+                                  capture_output=True).stdout
+
+        # dot only starts writing once it has read the whole graph, so
+        # filling stdin first can not dead lock on a full stdout; warnings
+        # may come earlier and go to a file instead of a pipe
+        with tempfile.TemporaryFile() as stderr, \
+                subprocess.Popen(['dot', *args], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=stderr) as proc:
+            with io.TextIOWrapper(proc.stdin, encoding='utf-8') as stdin:
+                self.write_dot(stdin)
+            out = proc.stdout.read()
+            proc.wait()
+            stderr.seek(0)
+            err = stderr.read()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args,
+                                                out, err)
+        return out
+
+
+def parse_formats(fmt):
+    # 'png,svg' from the command line, or a list of formats
+    return fmt.split(',') if isinstance(fmt, str) else list(fmt)
+
+
+def _quote(s):
+    s = str(s)
+    if _id_re.fullmatch(s) and s.lower() not in _keywords:
+        return s
+    if len(s) > 1 and s[0] == s[-1] == '"':
+        return s
+    return '"' + s.replace('"', '\\"') + '"'
+
+
+def _attr_list(attrs):
+    return ', '.join(f'{k}={_quote(v)}' for k, v in attrs.items())
 
 
 class Test(unittest.TestCase):
-    def test_print_graph(self):
-        block = '''
+    block = '''
 %shl1.i90 = shl i32 %reg, 0x6, !dbg !807
 %shl2.i92 = shl i32 %1877, 0x17, !dbg !807
 %1878 = xor i32 %shl2.i92, 0xFFFFFFFF
@@ -101,8 +160,32 @@ class Test(unittest.TestCase):
 %1900 = and i32 %1899, 0x41F9C030
 %1901 = and i32 0xFFFFFFFF, %1897
 '''
+
+    def test_print_graph(self):
+        from llvm_ir_parser import LlvmIrBlockParser
+
         parser = LlvmIrBlockParser()
-        parser.parser(block)
+        parser.parser(self.block)
 
         drawer = ASTDrawer(parser.ast)
-        drawer.draw()
+        drawer.create()
+
+    def test_write_dot(self):
+        import pydot
+
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        parser = LlvmIrBlockParser()
+        parser.parser(self.block)
+        ast = parser.ast
+
+        dot = ASTDrawer(ast).to_string()
+        self.assertIn('"$1878" [label="%1878", ntyp=v, typ=i32, '
+                      'fontname="Fira Code"];', dot)
+
+        g, = pydot.graph_from_dot_data(dot)
+        self.assertEqual(len(ast), len(g.get_node_list()))
+        self.assertEqual(ast.number_of_edges(), len(g.get_edge_list()))
+        name = next(ast.name(n) for n in ast if ast.ntyp(n) == 'op')
+        op, = g.get_node(f'"{name}"')
+        self.assertEqual(('circle', 'red'), (op.get('shape'), op.get('color')))
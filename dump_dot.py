@@ -0,0 +1,107 @@
+import argparse
+import sys
+import unittest
+
+from drawer import ASTDrawer
+from ir_reader import open_ir
+from main import analyze, parser_factory
+
+# what a parse and dump must never pull in, see Test.test_light_imports
+heavy_modules = ('fire', 'pydot', 'networkx', 'matplotlib', 'numpy')
+
+
+def dump_dot(ir_file, out=sys.stdout, raw=False, max_iterations=16,
+             time_budget=None, targets=None):
+    # parse, analyze unless raw, and write the dot source; neither dot nor
+    # anything plotting is involved
+    if raw:
+        parser = parser_factory(ir_file)
+        with open_ir(ir_file) as lines:
+            if targets is None:
+                parser.parser(lines)
+            else:
+                parser.parse_slice(lines, targets)
+        ast = parser.ast
+    else:
+        ast = analyze(ir_file, max_iterations, time_budget,
+                      targets=targets)
+    ASTDrawer(ast).write_dot(out)
+
+
+def main(argv=None):
+    # argparse instead of fire, which alone takes longer to import than
+    # everything else this needs
+    args = argparse.ArgumentParser(
+        description='Write the dot source of an ir file.')
+    args.add_argument('ir_file')
+    args.add_argument('-o', '--out', default='-',
+                      help='output file, - for stdout')
+    args.add_argument('--raw', action='store_true',
+                      help='skip the analysis passes')
+    args.add_argument('--max-iterations', type=int, default=16)
+    args.add_argument('--time-budget', type=float, default=None)
+    args.add_argument('--targets', nargs='*', default=None,
+                      help='only the values these depend on, none for the '
+                           'default outputs')
+    args = args.parse_args(argv)
+
+    if args.out == '-':
+        dump_dot(args.ir_file, sys.stdout, args.raw, args.max_iterations,
+                 args.time_budget, args.targets)
+        return
+    with open(args.out, 'w+') as f:
+        dump_dot(args.ir_file, f, args.raw, args.max_iterations,
+                 args.time_budget, args.targets)
+
+
+class Test(unittest.TestCase):
+    def test_dump_dot(self):
+        import io
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            ir_file = os.path.join(d, 'block.bc')
+            with open(ir_file, 'w') as f:
+                f.write('%1 = xor i32 %a, %a\n%2 = add i32 %1, %b\n')
+
+            raw, analyzed = io.StringIO(), io.StringIO()
+            dump_dot(ir_file, raw, raw=True)
+            dump_dot(ir_file, analyzed)
+            self.assertIn('"xor#01"', raw.getvalue())
+            self.assertNotIn('"xor#01"', analyzed.getvalue())
+
+            out = os.path.join(d, 'block.dot')
+            main([ir_file, '-o', out])
+            with open(out) as f:
+                self.assertEqual(analyzed.getvalue(), f.read())
+
+            sliced = io.StringIO()
+            dump_dot(ir_file, sliced, raw=True, targets=['%1'])
+            self.assertIn('"xor#01"', sliced.getvalue())
+            self.assertNotIn('add', sliced.getvalue())
+
+    def test_light_imports(self):
+        import os
+        import subprocess
+        import tempfile
+
+        # a whole dump, not just the import, leaves out the heavy modules;
+        # how long startup takes is left to bench.startup
+        with tempfile.TemporaryDirectory() as d:
+            ir_file = os.path.join(d, 'block.bc')
+            with open(ir_file, 'w') as f:
+                f.write('%1 = add i32 %a, 0x1\n')
+            code = ('import os, sys, dump_dot; '
+                    f'dump_dot.main([{ir_file!r}, "-o", os.devnull]); '
+                    'print(" ".join(m for m in dump_dot.heavy_modules '
+                    'if m in sys.modules))')
+            here = os.path.dirname(os.path.abspath(__file__))
+            loaded = subprocess.run([sys.executable, '-c', code],
+                                    check=True, capture_output=True,
+                                    text=True, cwd=here).stdout
+        self.assertEqual('', loaded.strip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,615 @@
+import unittest
+from array import array
+from itertools import chain
+
+
+class IrGraph:
+    # Nodes are int ids; name/label/ntyp are columns of interned string ids,
+    # other attributes sit in a sparse per-node dict. Adjacency is kept as
+    # ordered int arrays so operand order survives. The api mirrors the part
+    # of networkx.DiGraph the passes use; networkx and pydot are only loaded
+    # by the conversions to them.
+
+    def __init__(self):
+        self.strings = []
+        self.__string_ids = {}
+
+        self.__name = array('i')
+        self.__label = array('i')
+        self.__ntyp = array('i')
+        self.__attrs = []
+        self.__alive = bytearray()
+
+        self.__succ = []
+        self.__pred = []
+        self.__index = {}
+        self.__n_alive = 0
+        self.__dirty = None
+        self.__merged = None
+
+        self.nodes = _NodeView(self, self.__alive)
+        self.in_degree = _DegreeView(self.__pred)
+        self.out_degree = _DegreeView(self.__succ)
+        self.degree = _DegreeView(self.__pred, self.__succ)
+
+    @classmethod
+    def from_columns(cls, strings, name, label, ntyp, alive, succ, pred,
+                     attrs=None):
+        # Bulk construction for loaders, the inverse of columns(): name,
+        # label and ntyp are ids into strings, alive has a byte per node id,
+        # succ and pred an int array each and attrs maps ids to attr dicts.
+        g = cls()
+        g.strings.extend(strings)
+        g.__string_ids.update(zip(g.strings, range(len(g.strings))))
+        g.__name.extend(name)
+        g.__label.extend(label)
+        g.__ntyp.extend(ntyp)
+        g.__alive.extend(alive)
+        g.__attrs.extend([None] * len(g.__name))
+        for n, a in (attrs or {}).items():
+            g.__attrs[n] = a or None
+        g.__succ.extend(succ)
+        g.__pred.extend(pred)
+        assert len(g.__name) == len(g.__alive) == len(g.__succ) == \
+            len(g.__pred)
+
+        names = map(g.strings.__getitem__, g.__name)
+        g.__index.update((s, n) for n, s in enumerate(names) if alive[n])
+        g.__n_alive = len(g.__index)
+        return g
+
+    def columns(self):
+        # the raw columns by node id, dead ids included, for writers only
+        return (self.strings, self.__name, self.__label, self.__ntyp,
+                self.__alive, self.__succ, self.__pred, self.__attrs)
+
+    def intern(self, s: str):
+        sid = self.__string_ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(s)
+            self.__string_ids[s] = sid
+        return sid
+
+    def add_node(self, name: str, label: str, ntyp: str, **attrs):
+        assert name not in self.__index, f'Node {name} exists already'
+
+        n = len(self.__name)
+        self.__name.append(self.intern(name))
+        self.__label.append(self.intern(label))
+        self.__ntyp.append(self.intern(ntyp))
+        self.__attrs.append(attrs or None)
+        self.__alive.append(1)
+        self.__succ.append(array('i'))
+        self.__pred.append(array('i'))
+
+        self.__index[name] = n
+        self.__n_alive += 1
+        self.__touch(n)
+        return n
+
+    def node_id(self, name: str):
+        return self.__index.get(name)
+
+    def name(self, n: int):
+        return self.strings[self.__name[n]]
+
+    def label(self, n: int):
+        return self.strings[self.__label[n]]
+
+    def ntyp(self, n: int):
+        return self.strings[self.__ntyp[n]]
+
+    def has_node(self, n: int):
+        return 0 <= n < len(self.__alive) and self.__alive[n] == 1
+
+    def __contains__(self, n):
+        return self.has_node(n)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return self.__n_alive
+
+    def id_bound(self):
+        # ids handed out so far, node ids are never reused
+        return len(self.__name)
+
+    def number_of_nodes(self):
+        return self.__n_alive
+
+    def number_of_edges(self):
+        return sum(map(len, self.__succ))
+
+    def successors(self, n: int):
+        return iter(self.__succ[n])
+
+    def predecessors(self, n: int):
+        return iter(self.__pred[n])
+
+    def edges(self):
+        for u in self.nodes:
+            for v in self.__succ[u]:
+                yield u, v
+
+    def add_edge(self, u: int, v: int):
+        assert self.has_node(u) and self.has_node(v)
+        self.__succ[u].append(v)
+        self.__pred[v].append(u)
+        self.__touch(u, v)
+
+    def add_edges_from(self, edges):
+        for u, v in edges:
+            self.add_edge(u, v)
+
+    def reorder_successors(self, n: int, succs):
+        succs = array('i', succs)
+        assert sorted(succs) == sorted(self.__succ[n])
+        if succs != self.__succ[n]:
+            self.__succ[n] = succs
+            self.__touch(n)
+
+    def has_edge(self, u: int, v: int):
+        return self.has_node(u) and v in self.__succ[u]
+
+    def remove_edge(self, u: int, v: int):
+        if not self.has_edge(u, v):
+            raise KeyError(f'Edge {u}->{v} is not in the graph')
+        self.__succ[u].remove(v)
+        self.__pred[v].remove(u)
+        self.__touch(u, v)
+
+    def remove_edges_from(self, edges):
+        for u, v in edges:
+            if self.has_edge(u, v):
+                self.remove_edge(u, v)
+
+    def remove_node(self, n: int):
+        if not self.has_node(n):
+            raise KeyError(f'Node {n} is not in the graph')
+
+        self.__touch(n, *self.__succ[n], *self.__pred[n])
+        for s in set(self.__succ[n]):
+            self.__pred[s] = _without(self.__pred[s], n)
+        for p in set(self.__pred[n]):
+            self.__succ[p] = _without(self.__succ[p], n)
+        self.__succ[n] = array('i')
+        self.__pred[n] = array('i')
+
+        # ids are never reused, what a removed node was stays readable
+        self.__alive[n] = 0
+        del self.__index[self.name(n)]
+        self.__n_alive -= 1
+
+    def merge_node(self, n: int, dead_n: int):
+        # n takes over dead_n: an edge n->dead_n is replaced in place by the
+        # out edges of dead_n, other users of dead_n are redirected to n.
+        succs = self.__succ[dead_n]
+        self.__touch(n, *succs, *self.__pred[dead_n])
+        for s in set(succs):
+            self.__pred[s] = _without(self.__pred[s], dead_n)
+
+        for p in set(self.__pred[dead_n]):
+            merged = array('i')
+            for x in self.__succ[p]:
+                if x != dead_n:
+                    merged.append(x)
+                elif p == n:
+                    for s in succs:
+                        if s != n:
+                            merged.append(s)
+                            self.__pred[s].append(n)
+                else:
+                    merged.append(n)
+                    self.__pred[n].append(p)
+            self.__succ[p] = merged
+
+        self.__succ[dead_n] = array('i')
+        self.__pred[dead_n] = array('i')
+        self.remove_node(dead_n)
+        if self.__merged is not None:
+            self.__merged[dead_n] = n
+
+    def remove_nodes_from(self, nodes):
+        # bulk removal, every surviving neighbour is filtered only once
+        dead = {n for n in nodes if self.has_node(n)}
+        if len(dead) == 1:
+            self.remove_node(dead.pop())
+            return
+
+        touched = set()
+        for n in dead:
+            touched.update(self.__succ[n])
+            touched.update(self.__pred[n])
+        self.__touch(*dead, *touched)
+
+        for t in touched - dead:
+            self.__succ[t] = array('i', (x for x in self.__succ[t]
+                                         if x not in dead))
+            self.__pred[t] = array('i', (x for x in self.__pred[t]
+                                         if x not in dead))
+        for n in dead:
+            self.__succ[n] = array('i')
+            self.__pred[n] = array('i')
+            self.__alive[n] = 0
+            del self.__index[self.name(n)]
+        self.__n_alive -= len(dead)
+
+    def topological_sort(self):
+        in_degree = {n: len(self.__pred[n]) for n in self.nodes}
+        order = [n for n, d in in_degree.items() if d == 0]
+        for n in order:
+            for s in self.__succ[n]:
+                in_degree[s] -= 1
+                if in_degree[s] == 0:
+                    order.append(s)
+
+        if len(order) != self.__n_alive:
+            raise ValueError('Graph contains a cycle')
+        return order
+
+    def get_attr(self, n: int, key: str, default=None):
+        if key == 'label':
+            return self.label(n)
+        if key == 'ntyp':
+            return self.ntyp(n)
+        attrs = self.__attrs[n]
+        return attrs.get(key, default) if attrs else default
+
+    def set_attr(self, n: int, key: str, value):
+        if self.__dirty is not None and self.get_attr(n, key) != value:
+            self.__dirty.add(n)
+
+        if key == 'label':
+            self.__label[n] = self.intern(value)
+        elif key == 'ntyp':
+            self.__ntyp[n] = self.intern(value)
+        elif self.__attrs[n] is None:
+            self.__attrs[n] = {key: value}
+        else:
+            self.__attrs[n][key] = value
+
+    def del_attr(self, n: int, key: str):
+        assert key not in ('label', 'ntyp')
+        if self.__attrs[n] and key in self.__attrs[n]:
+            del self.__attrs[n][key]
+            self.__touch(n)
+
+    def attrs(self, n: int):
+        attrs = {'label': self.label(n), 'ntyp': self.ntyp(n)}
+        attrs.update(self.__attrs[n] or {})
+        return attrs
+
+    def track_changes(self):
+        self.__dirty = set()
+
+    def take_changes(self):
+        # nodes touched by any mutation since the last call; for a removed
+        # node its former neighbours are recorded as well
+        changes = self.__dirty
+        if changes is not None:
+            self.__dirty = set()
+        return changes
+
+    def stop_tracking(self):
+        self.__dirty = None
+
+    def track_merges(self):
+        self.__merged = {}
+
+    def take_merges(self):
+        # {dead_n: n} of the merges since the last call, n standing for the
+        # value of dead_n from then on
+        merged = self.__merged
+        if merged is not None:
+            self.__merged = {}
+        return merged
+
+    def relabel_nodes(self, mapping):
+        # new names {n: name} given at once, so names may go round; checked
+        # before anything changes
+        names = set(mapping.values())
+        if len(names) != len(mapping):
+            raise ValueError('Two nodes would get the same name')
+        for name in names:
+            n = self.__index.get(name)
+            if n is not None and n not in mapping:
+                raise ValueError(f'Node {name} exists already')
+        for n in mapping:
+            del self.__index[self.name(n)]
+        for n, name in mapping.items():
+            self.__name[n] = self.intern(name)
+            self.__index[name] = n
+        self.__touch(*mapping)
+
+    def __touch(self, *nodes):
+        if self.__dirty is not None:
+            self.__dirty.update(nodes)
+
+    def copy(self):
+        return self.subgraph(self.nodes)
+
+    def subgraph(self, nodes):
+        # a new graph of the given nodes and the edges between them, ids
+        # renumbered in order and only the strings of those nodes kept
+        nodes = sorted(set(nodes))
+        ids = dict(zip(nodes, range(len(nodes))))
+        columns = [list(map(col.__getitem__, nodes))
+                   for col in (self.__name, self.__label, self.__ntyp)]
+        sids = {sid: i for i, sid in enumerate(dict.fromkeys(chain(*columns)))}
+        name, label, ntyp = (array('i', map(sids.__getitem__, col))
+                             for col in columns)
+
+        def adjacency(adj):
+            out = []
+            for n in nodes:
+                try:
+                    out.append(array('i', map(ids.__getitem__, adj[n])))
+                except KeyError:
+                    out.append(array('i', [x for x in adj[n] if x in ids]))
+            return out
+
+        attrs = {i: dict(self.__attrs[n]) for i, n in enumerate(nodes)
+                 if self.__attrs[n]}
+        return IrGraph.from_columns(
+            list(map(self.strings.__getitem__, sids)), name, label, ntyp,
+            b'\x01' * len(nodes), adjacency(self.__succ),
+            adjacency(self.__pred), attrs)
+
+    @classmethod
+    def disjoint_union(cls, graphs):
+        # The graphs side by side, each one's nodes numbered on from the
+        # last. A name an earlier graph has taken already gets a free
+        # variant, see free_name.
+        strings, sids, taken = [], {}, set()
+        name, label, ntyp = array('i'), array('i'), array('i')
+        succ, pred, attrs = [], [], {}
+
+        def intern(s):
+            sid = sids.get(s)
+            if sid is None:
+                sid = sids[s] = len(strings)
+                strings.append(s)
+            return sid
+
+        for g in graphs:
+            g_strings, g_name, g_label, g_ntyp, _, g_succ, g_pred, \
+                g_attrs = g.columns()
+            remap = list(map(intern, g_strings))
+            nodes = list(g.nodes)
+            ids = dict(zip(nodes, range(len(name), len(name) + len(nodes))))
+            for n in nodes:
+                s = _free(g_strings[g_name[n]], taken)
+                taken.add(s)
+                name.append(intern(s))
+                label.append(remap[g_label[n]])
+                ntyp.append(remap[g_ntyp[n]])
+                succ.append(array('i', map(ids.__getitem__, g_succ[n])))
+                pred.append(array('i', map(ids.__getitem__, g_pred[n])))
+                if g_attrs[n]:
+                    attrs[ids[n]] = dict(g_attrs[n])
+        return cls.from_columns(strings, name, label, ntyp,
+                                b'\x01' * len(name), succ, pred, attrs)
+
+    def weakly_connected_components(self):
+        # lists of node ids, in the order of their smallest id
+        seen = bytearray(len(self.__alive))
+        for n in self.nodes:
+            if seen[n]:
+                continue
+            seen[n] = 1
+            component = [n]
+            for x in component:
+                for y in chain(self.__succ[x], self.__pred[x]):
+                    if not seen[y]:
+                        seen[y] = 1
+                        component.append(y)
+            yield component
+
+    def free_name(self, name: str):
+        # name if no node has it, else the first of name.2, name.3, .. free
+        return _free(name, self.__index)
+
+    def to_string(self):
+        return self.to_pydot().to_string()
+
+    def to_pydot(self):
+        import pydot
+
+        g = pydot.Dot()
+        for n in self.nodes:
+            g.add_node(pydot.Node(f'"{self.name(n)}"', **self.attrs(n)))
+        for u, v in self.edges():
+            g.add_edge(pydot.Edge(f'"{self.name(u)}"', f'"{self.name(v)}"'))
+        return g
+
+    def to_networkx(self):
+        import networkx as nx
+
+        g = nx.DiGraph()
+        for n in self.nodes:
+            g.add_node(self.name(n), **self.attrs(n))
+        g.add_edges_from((self.name(u), self.name(v)) for u, v in self.edges())
+        return g
+
+
+class _NodeView:
+    def __init__(self, g: IrGraph, alive: bytearray):
+        self.__g = g
+        self.__alive = alive
+
+    def __iter__(self):
+        alive = self.__alive
+        return (n for n in range(len(alive)) if alive[n])
+
+    def __len__(self):
+        return len(self.__g)
+
+    def __contains__(self, n):
+        return self.__g.has_node(n)
+
+    def __getitem__(self, n):
+        if not self.__g.has_node(n):
+            raise KeyError(n)
+        return _NodeAttrs(self.__g, n)
+
+
+class _NodeAttrs:
+    def __init__(self, g: IrGraph, n: int):
+        self.__g = g
+        self.__n = n
+
+    def __getitem__(self, key):
+        value = self.__g.get_attr(self.__n, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.__g.set_attr(self.__n, key, value)
+
+    def __contains__(self, key):
+        return self.__g.get_attr(self.__n, key) is not None
+
+    def get(self, key, default=None):
+        return self.__g.get_attr(self.__n, key, default)
+
+    def items(self):
+        return self.__g.attrs(self.__n).items()
+
+
+class _DegreeView:
+    def __init__(self, *adjacency):
+        self.__adjacency = adjacency
+
+    def __getitem__(self, n):
+        return sum(len(adj[n]) for adj in self.__adjacency)
+
+
+def _free(name: str, taken):
+    free, i = name, 1
+    while free in taken:
+        i += 1
+        free = f'{name}.{i}'
+    return free
+
+
+def _without(arr: array, n: int):
+    return array('i', (x for x in arr if x != n))
+
+
+class Test(unittest.TestCase):
+    def test_index_and_adjacency(self):
+        g = IrGraph()
+        v = g.add_node('RSI.1', 'RSI.1', 'v')
+        op = g.add_node('&#02', '&', 'op')
+        c = g.add_node('0x3FC0#3', '0x3FC0', 'c', typ='i32')
+        g.add_edges_from([(v, op), (op, c), (op, v)])
+
+        self.assertEqual(op, g.node_id('&#02'))
+        self.assertEqual([c, v], list(g.successors(op)))
+        self.assertEqual(2, g.in_degree[v] + g.in_degree[c])
+        self.assertEqual('i32', g.nodes[c]['typ'])
+
+        g.remove_node(op)
+        self.assertIsNone(g.node_id('&#02'))
+        self.assertEqual([v, c], list(g.nodes))
+        self.assertEqual(0, g.number_of_edges())
+
+    def test_merge_node(self):
+        g = IrGraph()
+        v, w, op, x, c = [g.add_node(name, name, 'v') for name in 'vwoxc']
+        g.add_edges_from([(v, op), (w, op), (op, x), (op, c)])
+
+        g.merge_node(v, op)
+        self.assertFalse(g.has_node(op))
+        self.assertEqual([x, c], list(g.successors(v)))
+        self.assertEqual([v], list(g.successors(w)))
+        self.assertEqual([w], list(g.predecessors(v)))
+        self.assertEqual([v], list(g.predecessors(x)))
+
+    def test_bulk_remove_and_topological_sort(self):
+        g = IrGraph()
+        a, b, c, d = [g.add_node(name, name, 'v') for name in 'abcd']
+        g.add_edges_from([(a, b), (b, c), (a, c), (d, c)])
+        self.assertEqual([a, d, b, c], g.topological_sort())
+
+        g.set_attr(b, 'typ', 'i8')
+        g.remove_nodes_from([b, d])
+        self.assertEqual([a, c], list(g.nodes))
+        self.assertEqual(('b', 'i8'), (g.label(b), g.get_attr(b, 'typ')))
+        self.assertEqual([(a, c)], list(g.edges()))
+        self.assertEqual([a], list(g.predecessors(c)))
+
+    def test_track_changes(self):
+        g = IrGraph()
+        v, op, c = [g.add_node(name, name, 'v') for name in 'voc']
+        g.add_edges_from([(v, op), (op, c)])
+        self.assertIsNone(g.take_changes())
+
+        g.track_changes()
+        g.set_attr(v, 'ntyp', 'v')
+        self.assertEqual(set(), g.take_changes())
+        g.remove_node(op)
+        g.set_attr(c, 'label', '0x0')
+        self.assertEqual({v, op, c}, g.take_changes())
+
+    def test_merges_and_relabel(self):
+        g = IrGraph()
+        a, b, c = [g.add_node(x, x, 'v') for x in 'abc']
+        g.add_edges_from([(a, b), (b, c)])
+        self.assertIsNone(g.take_merges())
+
+        g.track_merges()
+        g.merge_node(a, b)
+        self.assertEqual({b: a}, g.take_merges())
+        self.assertEqual({}, g.take_merges())
+
+        g.relabel_nodes({a: 'c', c: 'a'})
+        self.assertEqual((c, a), (g.node_id('a'), g.node_id('c')))
+        self.assertEqual(['c', 'a'], [g.name(n) for n in g])
+        # a clash leaves all names as they were
+        d = g.add_node('d', 'd', 'v')
+        for mapping in [{a: 'x', c: 'd'}, {a: 'x', c: 'x'}]:
+            with self.assertRaises(ValueError):
+                g.relabel_nodes(mapping)
+            self.assertEqual((a, c, d), tuple(map(g.node_id, 'cad')))
+
+    def test_set_attr(self):
+        g = IrGraph()
+        n = g.add_node('%1', '%1', 'v')
+        g.nodes[n]['ntyp'] = 'ce'
+        g.nodes[n]['fillcolor'] = 'black'
+        self.assertEqual('ce', g.ntyp(n))
+        self.assertEqual({'label': '%1', 'ntyp': 'ce', 'fillcolor': 'black'},
+                         dict(g.nodes[n].items()))
+
+    def test_subgraph(self):
+        g = IrGraph()
+        a, b, c = [g.add_node(x, x, 'v', typ='i32') for x in 'abc']
+        g.add_edges_from([(a, b), (a, b), (b, c), (a, c)])
+
+        sub = g.subgraph([b, a])
+        self.assertEqual(['a', 'b'], [sub.name(n) for n in sub])
+        self.assertEqual([(0, 1), (0, 1)], list(sub.edges()))
+        self.assertEqual('i32', sub.get_attr(1, 'typ'))
+
+    def test_components_and_union(self):
+        g = IrGraph()
+        a, b, c, d, e = [g.add_node(x, x, 'v') for x in 'abcde']
+        g.add_edges_from([(a, c), (b, c), (d, e)])
+        g.remove_node(b)
+        self.assertEqual([[a, c], [d, e]],
+                         [sorted(c) for c in g.weakly_connected_components()])
+
+        h = IrGraph()
+        x, y = h.add_node('x', 'x', 'op', typ='i8'), h.add_node('c', 'c', 'v')
+        h.add_edges_from([(y, x), (y, x)])
+        union = IrGraph.disjoint_union([g, h])
+        self.assertEqual(['a', 'c', 'd', 'e', 'x', 'c.2'],
+                         [union.name(n) for n in union])
+        self.assertEqual([(0, 1), (2, 3), (5, 4), (5, 4)], list(union.edges()))
+        self.assertEqual('i8', union.get_attr(4, 'typ'))
+        self.assertEqual(('c.3', 'y'),
+                         (union.free_name('c'), union.free_name('y')))
@@ -0,0 +1,169 @@
+import io
+import mmap
+import os
+import unittest
+
+
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+class MmapLineReader:
+    def __init__(self, path, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        self.__file = None
+        self.__mm = None
+
+    def __enter__(self):
+        self.__file = open(self.path, 'rb')
+        if os.fstat(self.__file.fileno()).st_size > 0:
+            self.__mm = mmap.mmap(self.__file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        if self.__mm is None:
+            return
+        self.__mm.seek(0)
+        for line in iter(self.__mm.readline, b''):
+            yield line.decode(self.encoding)
+
+    def binary(self):
+        # the file underneath, for reading it backwards
+        return self.__file
+
+    def close(self):
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm = None
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+def open_ir(path, mmap_threshold=MMAP_THRESHOLD):
+    if os.path.getsize(path) >= mmap_threshold:
+        return MmapLineReader(path)
+    return open(path, 'r')
+
+
+def iter_lines(source):
+    if isinstance(source, str):
+        yield from _iter_str_lines(source)
+        return
+
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        yield line
+
+
+def inst_lines(source):
+    return (line for _, line in numbered_inst_lines(source))
+
+
+def numbered_inst_lines(source):
+    for lineno, line in enumerate(iter_lines(source), 1):
+        line = line.strip()
+        if line:
+            yield lineno, line
+
+
+def reversed_inst_lines(source, block_size=1 << 20):
+    # numbered_inst_lines last to first. A file is read in blocks from its
+    # end, so only a block is held at a time however long the file is.
+    f = _binary(source)
+    if f is None:
+        yield from reversed(list(numbered_inst_lines(source)))
+        return
+
+    f.seek(0)
+    lineno = 1 + sum(block.count(b'\n')
+                     for block in iter(lambda: f.read(block_size), b''))
+    pos, tail = f.seek(0, os.SEEK_END), b''
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        tail, *lines = (f.read(size) + tail).split(b'\n')
+        for line in reversed(lines):
+            line = line.decode('utf-8').strip()
+            if line:
+                yield lineno, line
+            lineno -= 1
+    line = tail.decode('utf-8').strip()
+    if line:
+        yield lineno, line
+
+
+def rereadable(source):
+    # whether source can be gone through more than once, a generator or a
+    # pipe can not
+    return isinstance(source, (str, list, tuple)) or \
+        _binary(source) is not None
+
+
+def _binary(source):
+    # the seekable binary file behind source, None for in memory sources
+    if isinstance(source, MmapLineReader):
+        return source.binary()
+    f = getattr(source, 'buffer', source)
+    if isinstance(f, io.BufferedIOBase) and f.seekable():
+        return f
+    return None
+
+
+def _iter_str_lines(s: str):
+    start = 0
+    while True:
+        end = s.find('\n', start)
+        if end < 0:
+            yield s[start:]
+            return
+        yield s[start:end]
+        start = end + 1
+
+
+class Test(unittest.TestCase):
+    def test_inst_lines(self):
+        expect = ['a := b', 'c := d']
+        for source in ['\na := b\n\n  c := d  ',
+                       ['a := b\n', '\n', 'c := d\n'],
+                       [b'a := b\n', b'c := d']]:
+            self.assertEqual(expect, list(inst_lines(source)))
+        self.assertEqual([(2, 'a := b'), (4, 'c := d')],
+                         list(numbered_inst_lines('\na := b\n\n  c := d  ')))
+
+    def test_mmap_reader(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'block.bir')
+            with open(path, 'w') as f:
+                f.write('a := b\nc := d\n')
+
+            with open_ir(path, mmap_threshold=0) as lines:
+                self.assertIsInstance(lines, MmapLineReader)
+                self.assertEqual(['a := b', 'c := d'], list(inst_lines(lines)))
+
+    def test_reversed(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'block.bir')
+            for text in ['\na := b\n\n  c := d  ', 'a := b\r\nc := d\n\n',
+                         ''.join(f'{i} := {i}\n' for i in range(100))]:
+                with open(path, 'w', newline='') as f:
+                    f.write(text)
+                expect = list(reversed(list(numbered_inst_lines(text))))
+                for threshold in (0, MMAP_THRESHOLD):
+                    with open_ir(path, threshold) as lines:
+                        self.assertEqual(expect, list(
+                            reversed_inst_lines(lines, block_size=7)))
+                self.assertEqual(expect, list(reversed_inst_lines(text)))
+                with open(path) as f:
+                    self.assertTrue(rereadable(f))
+        self.assertFalse(rereadable(iter(['a := b'])))
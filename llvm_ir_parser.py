@@ -1,88 +1,454 @@
 import re
 import unittest
+from collections import namedtuple
 
-import pydot
+from analysis.value_numbering import HashCons
+from ir_graph import IrGraph
+from ir_reader import numbered_inst_lines, reversed_inst_lines
+
+# typ is the type of the result, typs the ones of the operands
+Inst = namedtuple('Inst', 'var op typ operands typs')
+
+# one function of a module, body holds its (lineno, line) pairs
+LlvmFunction = namedtuple('LlvmFunction', 'name lineno blocks body')
+
+
+class LlvmIrParseError(ValueError):
+    def __init__(self, msg, lineno=None, line=None):
+        self.msg = msg
+        self.lineno = lineno
+        self.line = line
+        where = f'line {lineno}: ' if lineno is not None else ''
+        ctx = f' in {line!r}' if line is not None else ''
+        super().__init__(f'{where}{msg}{ctx}')
 
 
 class LlvmIrBlockParser:
-    def __init__(self):
-        self.ast = pydot.Dot()
+    # Builds the data flow of the value producing instructions. Labels,
+    # terminators, stores and other void instructions have no value to
+    # show and are skipped, so a whole function body parses as well.
+    def __init__(self, hash_cons=False):
+        self.ast = IrGraph()
         self.id_base = 0
+        self.hash_cons = HashCons(self.ast) if hash_cons else None
+        self.__defined = set()
 
-    def parser(self, ir_block: str):
-        for inst_line in ir_block.split(sep='\n'):
-            inst_line = inst_line.strip()
-            if not inst_line:
-                continue
-            self.__handle_inst_line(inst_line)
+    def parser(self, ir_block):
+        for lineno, inst_line in numbered_inst_lines(ir_block):
+            inst = _parse_inst_line(inst_line, lineno)
+            if inst is not None:
+                self.__handle_inst(inst)
 
-    def __handle_inst_line(self, line):
-        (var, op, typ, opr_list) = _parse_inst_line(line)
+    def parse_slice(self, ir_block, targets=()):
+        # only the instructions the targets depend on, see backward_slice
+        for inst in backward_slice(ir_block, targets):
+            self.__handle_inst(inst)
 
-        var_node = self.__var_node(var, typ)
-        op_node = self.__op_node(op)
-        edge = pydot.Edge(var_node, op_node)
-        self.ast.add_edge(edge)
+    def parse_line(self, lineno, line, later=()):
+        # one instruction into a graph parsed already; the values in later
+        # are defined further down, a phi gets them over a back edge
+        inst = _parse_inst_line(line, lineno)
+        if inst is not None:
+            self.__handle_inst(inst, later)
 
-        is_constexpr = var_node.get('ntyp') == 'v'
-        for opr in opr_list:
-            opr_node = self.__var_node(opr, typ)
-            is_constexpr &= opr_node.get('ntyp') in ['c', 'ce']
-            edge = pydot.Edge(op_node, opr_node)
-            self.ast.add_edge(edge)
+    def __handle_inst(self, inst: Inst, later=None):
+        start = self.ast.id_bound()
+
+        var_node = self.__var_node(inst.var, inst.typ)
+        op_node = self.__op_node(inst.op)
+        self.ast.add_edge(var_node, op_node)
+        self.__defined.add(inst.var)
+
+        is_constexpr = bool(inst.operands) and _is_pure(inst.op) and \
+            self.ast.ntyp(var_node) == 'v'
+        for opr, typ in zip(inst.operands, inst.typs):
+            if inst.op == 'phi' and opr.startswith('%') and \
+                    (opr not in self.__defined if later is None
+                     else opr in later):
+                # a value coming in over a back edge, linking it would
+                # close a cycle through the phi
+                opr_node = self.__back_edge_node(opr, typ)
+            else:
+                opr_node = self.__var_node(opr, typ)
+            is_constexpr &= self.ast.ntyp(opr_node) in ['c', 'ce']
+            self.ast.add_edge(op_node, opr_node)
 
         if is_constexpr:
-            var_node.set('ntyp', 'ce')
+            self.ast.set_attr(var_node, 'ntyp', 'ce')
+
+        if self.hash_cons:
+            # nodes are created parents first, so interning them backwards
+            # sees the operands before the ops using them
+            for n in reversed(range(start, self.ast.id_bound())):
+                if self.ast.has_node(n):
+                    self.hash_cons.intern(n)
 
     def __id(self):
         self.id_base += 1
         return self.id_base
 
     def __op_node(self, op):
-        op_name, ntyp = f'"{op}#{self.__id():02}"', 'op'
+        op_name, ntyp = f'{op}#{self.__id():02}', 'op'
         label = op_map[op] if op in op_map else op
-        n = pydot.Node(op_name, label=label, ntyp=ntyp)
-        self.ast.add_node(n)
-        return n
+        return self.ast.add_node(op_name, label, ntyp)
 
     def __var_node(self, var, typ):
-        var_name, ntyp = f'"${var[1:]}"', 'v'
-        if not var.startswith('%'):
-            var_name, ntyp = f'"{var}#{self.__id()}"', 'c'
-        n = self.ast.get_node(var_name)
-        if n:
-            return n[0]
+        var_name, ntyp = f'${var[1:]}', 'v'
+        if var.startswith('@'):
+            var_name = var
+        elif not var.startswith('%'):
+            var, ntyp = _const_label(var)
+            var_name = f'{var}#{self.__id()}'
+        n = self.ast.node_id(var_name)
+        if n is not None:
+            return n
+
+        return self.ast.add_node(var_name, var, ntyp, typ=typ)
+
+    def __back_edge_node(self, var, typ):
+        var_name = f'${var[1:]}@phi'
+        n = self.ast.node_id(var_name)
+        if n is not None:
+            return n
+        return self.ast.add_node(var_name, var, 'v', typ=typ)
+
+
+def split_module(source):
+    # Cuts a module into its defined functions. Declarations, globals,
+    # metadata and attribute groups live outside of any function body and
+    # are dropped; blocks lists the labels, '' standing for an unnamed entry.
+    fn = None
+    for lineno, line in numbered_inst_lines(source):
+        if fn is None:
+            if line.startswith('define '):
+                r = _define_re.search(line)
+                if not r:
+                    raise LlvmIrParseError('Malformed define', lineno, line)
+                fn = LlvmFunction(r.group(1), lineno, [], [])
+            continue
+
+        if line.startswith('}'):
+            yield fn
+            fn = None
+            continue
+
+        r = _label_re.match(line)
+        if r:
+            fn.blocks.append(r.group(1))
+            continue
+        if not fn.blocks:
+            fn.blocks.append('')
+        fn.body.append((lineno, line))
 
-        n = pydot.Node(var_name, label=var, typ=typ, ntyp=ntyp)
-        self.ast.add_node(n)
-        return n
+    if fn is not None:
+        raise LlvmIrParseError(f'Function {fn.name} is not closed', fn.lineno)
 
 
 op_map = {
     'and': '&', 'or': '|', 'xor': '^', 'shl': '<<', 'shr': '>>'
 }
 
+binops = {'add', 'sub', 'mul', 'udiv', 'sdiv', 'urem', 'srem', 'shl', 'lshr',
+          'ashr', 'and', 'or', 'xor', 'fadd', 'fsub', 'fmul', 'fdiv', 'frem'}
+casts = {'trunc', 'zext', 'sext', 'fptrunc', 'fpext', 'fptoui', 'fptosi',
+         'uitofp', 'sitofp', 'ptrtoint', 'inttoptr', 'bitcast',
+         'addrspacecast'}
+# keywords which may sit between an opcode and its type
+flags = {'nuw', 'nsw', 'exact', 'disjoint', 'nneg', 'samesign', 'inbounds',
+         'nusw', 'fast', 'nnan', 'ninf', 'nsz', 'arcp', 'contract', 'afn',
+         'reassoc', 'volatile', 'atomic', 'tail', 'musttail', 'notail'}
+constants = {'true': '1', 'false': '0'}
 
-def _parse_inst_line(line):
-    # match assignment
-    r = re.match(r'(%[^\b]+) = (.+)', line)
+_assign_re = re.compile(r'(%[-\w.$]+|%"[^"]*")\s*=\s*(.+)')
+_define_re = re.compile(r'(@[-\w.$]+|@"[^"]*")\s*\(')
+_label_re = re.compile(r'([-\w.$]+|"[^"]*"):(\s*;.*)?$')
+_type_re = re.compile(r'i\d+|ptr|void|half|bfloat|float|double|fp128|'
+                      r'x86_fp80|ppc_fp128|<.*>|\[.*\]|\{.*\}|%[-\w.$]+\*?')
+_value_re = re.compile(r'[%@][-\w.$"]+|-?\d+(\.\d+)?(e[-+]?\d+)?|0x[\dA-F]+|'
+                       r'true|false|null|undef|poison|zeroinitializer|none')
+
+
+def _parse_inst_line(line, lineno=None):
+    # Inst of a value producing instruction, None for anything else
+    r = _assign_re.match(line)
     if not r:
-        print(f'Failed to parse {line}')
-        return
+        return None
     var, exp = r.groups()
 
-    r = re.match(r'(\w+) (\w+) (.+)', exp)
-    operator, typ, operands = r.groups()
-    operands = operands.split(', ')
+    parts = [p for p in _split_top(_strip_comment(exp))
+             if not p.startswith('!')]
+    words = parts[0].split()
+    op = words[0]
+    rest = [w for w in words[1:] if w not in flags]
+    if op in flags:
+        # `tail call ...`
+        op, rest = rest[0], rest[1:]
+    if not rest:
+        raise LlvmIrParseError(f'Missing operands of {op}', lineno, line)
+
+    if op in binops:
+        typ = rest[0]
+        operands = [' '.join(rest[1:]), *parts[1:]]
+        return Inst(var, op, typ, operands, [typ] * len(operands))
+
+    if op in ('icmp', 'fcmp'):
+        pred, typ = rest[:2]
+        operands = [' '.join(rest[2:]), *parts[1:]]
+        return Inst(var, f'{op} {pred}', 'i1', operands, [typ, typ])
+
+    if op in casts:
+        r = re.match(r'(.+) (\S+) to (.+)', ' '.join(rest))
+        if not r:
+            raise LlvmIrParseError(f'Malformed {op}', lineno, line)
+        typ, opr, to = r.groups()
+        return Inst(var, op, to, [opr], [typ])
+
+    if op == 'phi':
+        typ = rest[0]
+        incoming = [' '.join(rest[1:]), *parts[1:]]
+        operands = [_split_top(i.strip('[] '))[0] for i in incoming]
+        return Inst(var, op, typ, operands, [typ] * len(operands))
+
+    if op == 'call':
+        text = ', '.join([' '.join(rest), *parts[1:]])
+        head, args = _last_group(text)
+        if head is None:
+            raise LlvmIrParseError('Malformed call', lineno, line)
+        # inline asm has its strings where the callee would be
+        callee = 'asm' if 'asm' in head.split() else head.split()[-1]
+        typ = next((w for w in rest if _type_re.fullmatch(w)), None)
+        operands, typs = _typed_values(_split_top(args))
+        return Inst(var, f'call {callee}', typ, operands, typs)
+
+    # load, alloca, getelementptr, select, extractvalue, freeze, ...: the
+    # first type names the result, the typed values are the operands
+    items = [' '.join(rest), *parts[1:]]
+    items = [i for i in items if not i.startswith(('align ', 'addrspace('))]
+    operands, typs = _typed_values(items)
+    typ = items[0].split()[0] if items and items[0] else None
+    return Inst(var, op, typ, operands, typs)
+
+
+def backward_slice(ir_block, targets=()):
+    # Walks the instruction lines backwards from the target values, %x or
+    # just x, by default the last value defined, reading a file from its
+    # end. Returns the Insts kept, first to last, only those get parsed.
+    # Values coming in over a back edge are defined further down and stay
+    # out, as they are cut off at their phi anyway.
+    live = {t if t.startswith('%') else f'%{t}' for t in targets}
+    missing, kept = set(live), []
+    for lineno, line in reversed_inst_lines(ir_block):
+        r = _assign_re.match(line)
+        var = r.group(1) if r else None
+        if var is None:
+            continue
+        if not targets and not kept:
+            live.add(var)
+        missing.discard(var)
+        if var not in live:
+            continue
+        live.discard(var)
+        inst = _parse_inst_line(line, lineno)
+        live.update(opr for opr in inst.operands if opr.startswith('%'))
+        kept.append(inst)
+        if not live:
+            break
+    if missing:
+        raise ValueError(f'{min(missing)} is never defined')
+    kept.reverse()
+    return kept
+
+
+def def_use(lineno, line):
+    # the value an instruction line defines, None for the ones without,
+    # the values it reads in the order they first appear, and whether it is
+    # a phi
+    inst = _parse_inst_line(line, lineno)
+    if inst is None:
+        return None, (), False
+    uses = tuple(dict.fromkeys(opr for opr in inst.operands
+                               if opr.startswith('%')))
+    return inst.var, uses, inst.op == 'phi'
+
 
-    return var, operator, typ, operands
+def _typed_values(items):
+    operands, typs = [], []
+    for item in items:
+        words = item.split()
+        if len(words) >= 2 and _value_re.fullmatch(words[-1]):
+            operands.append(words[-1])
+            typs.append(words[0])
+    return operands, typs
+
+
+def _split_top(s):
+    # comma separated parts outside of any brackets or quotes
+    parts, depth, quoted, start = [], 0, False, 0
+    for i, ch in enumerate(s):
+        if ch == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif ch in '([{<':
+            depth += 1
+        elif ch in ')]}>':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(s[start:i].strip())
+            start = i + 1
+    parts.append(s[start:].strip())
+    return parts
+
+
+def _last_group(s):
+    # what comes before the last parenthesized group and what is inside
+    end = s.rfind(')')
+    depth = 0
+    for i in range(end, -1, -1):
+        if s[i] == ')':
+            depth += 1
+        elif s[i] == '(':
+            depth -= 1
+            if depth == 0:
+                return s[:i].rstrip(), s[i + 1:end]
+    return None, None
+
+
+def _strip_comment(s):
+    quoted = False
+    for i, ch in enumerate(s):
+        if ch == '"':
+            quoted = not quoted
+        elif ch == ';' and not quoted:
+            return s[:i].rstrip()
+    return s
+
+
+def _const_label(text):
+    # integers are constants, anything opaque such as undef is a free input
+    text = constants.get(text, text)
+    if re.fullmatch(r'-?\d+|-?0x[\dA-Fa-f]+', text):
+        return text, 'c'
+    return text, 'v'
+
+
+def _is_pure(op):
+    return op in binops or op in casts or op.startswith(('icmp', 'fcmp')) \
+        or op == 'select'
 
 
 class Test(unittest.TestCase):
+    def test_parse_inst_line_with_metadata(self):
+        line = '%shl1.i90 = shl i32 %reg, 0x6, !dbg !807'
+        expect = ('%shl1.i90', 'shl', 'i32', ['%reg', '0x6'])
+        self.assertEqual(expect, _parse_inst_line(line)[:4])
+
     def test_parse_inst_line(self):
         line = '%1898 = and i32 0x2E2882F, %1897'
         expect = ('%1898', 'and', 'i32', ['0x2E2882F', '%1897'])
-        output = _parse_inst_line(line)
+        output = _parse_inst_line(line)[:4]
         self.assertTrue(expect == output,
                         f'output ({output}) does not equal to '
                         f'expect ({expect})')
+
+    def test_parse_instructions(self):
+        for line, expect in [
+            ('%3 = add nuw nsw i64 %2, 1',
+             ('add', 'i64', ['%2', '1'], ['i64', 'i64'])),
+            ('%c = icmp eq i32 %a, 0', ('icmp eq', 'i1', ['%a', '0'],
+                                        ['i32', 'i32'])),
+            ('%z = zext i8 %x to i32', ('zext', 'i32', ['%x'], ['i8'])),
+            ('%r = tail call i32 @f(i32 noundef %a, ptr @g) #3, !dbg !9',
+             ('call @f', 'i32', ['%a', '@g'], ['i32', 'ptr'])),
+            ('%m = call i64 asm "mov.b64 $0, {$1,$2};", "=l,r,r"(i32 %a, '
+             'i32 %b) #33, !srcloc !33',
+             ('call asm', 'i64', ['%a', '%b'], ['i32', 'i32'])),
+            ('%p = phi i32 [ 0, %entry ], [ %n, %loop ]',
+             ('phi', 'i32', ['0', '%n'], ['i32', 'i32'])),
+            ('%s = select i1 %c, i32 %a, i32 7',
+             ('select', 'i1', ['%c', '%a', '7'], ['i1', 'i32', 'i32'])),
+            ('%v = load i32, ptr %p, align 4, !tbaa !5',
+             ('load', 'i32', ['%p'], ['ptr'])),
+        ]:
+            self.assertEqual(expect, _parse_inst_line(line)[1:], line)
+
+        for line in ['br label %loop', 'store i32 %a, ptr %p', 'ret i32 %a',
+                     'call void @g()', 'loop:    ; preds = %entry']:
+            self.assertIsNone(_parse_inst_line(line), line)
+        with self.assertRaises(LlvmIrParseError):
+            _parse_inst_line('%a = add', 7)
+
+    def test_split_module(self):
+        module = '''
+source_filename = "m.c"
+@g = global i32 0, align 4
+
+define dso_local i32 @f(i32 noundef %0) #0 {
+  %2 = icmp sgt i32 %0, 0
+  br i1 %2, label %3, label %6
+
+3:                                                ; preds = %1
+  %4 = add nsw i32 %0, 1
+  br label %6
+
+6:                                                ; preds = %3, %1
+  %7 = phi i32 [ %4, %3 ], [ 0, %1 ]
+  ret i32 %7
+}
+
+declare i32 @h(i32)
+
+define void @"g.1"() {
+entry:
+  ret void
+}
+'''
+        f, g = split_module(module)
+        self.assertEqual(('@f', 5, ['', '3', '6']), f[:3])
+        self.assertEqual(6, len(f.body))
+        self.assertEqual(('@"g.1"', ['entry'], [(22, 'ret void')]),
+                         (g.name, g.blocks, g.body))
+
+        parser = LlvmIrBlockParser()
+        parser.parser(line for _, line in f.body)
+        ast = parser.ast
+        self.assertEqual(['$2', '$7'], [ast.name(n) for n in
+                                         ast.topological_sort()[:2]])
+        self.assertEqual(['$0'], [ast.name(n) for n in ast.nodes
+                                  if ast.out_degree[n] == 0 and
+                                  ast.ntyp(n) == 'v'])
+
+    def test_parse_slice(self):
+        block = '''
+%1 = xor i32 %a, %b
+%2 = add i32 %1, 3
+%3 = mul i32 %a, %a
+store i32 %3, ptr %p
+%i = phi i32 [ 0, %entry ], [ %4, %loop ]
+%4 = sub i32 %2, %i
+'''
+        def kept(targets=()):
+            return [inst.var for inst in backward_slice(block, targets)]
+
+        self.assertEqual(['%1', '%2', '%i', '%4'], kept())
+        self.assertEqual(['%3'], kept(['3']))
+        self.assertEqual(['%1', '%2', '%3'], kept(['%2', '%3']))
+        with self.assertRaises(ValueError):
+            kept(['%a'])
+
+        parser = LlvmIrBlockParser()
+        parser.parse_slice(block, ['%2'])
+        self.assertEqual({'$2', '$1', '$a', '$b'},
+                         {parser.ast.name(n) for n in parser.ast
+                          if parser.ast.ntyp(n) == 'v'})
+
+    def test_phi_back_edge(self):
+        parser = LlvmIrBlockParser()
+        parser.parser('%i = phi i32 [ 0, %entry ], [ %inc, %loop ]\n'
+                      '%inc = add i32 %i, 1\n')
+        ast = parser.ast
+        ast.topological_sort()
+        phi = next(ast.successors(ast.node_id('$i')))
+        self.assertEqual(['0', '%inc'], [ast.label(n)
+                                         for n in ast.successors(phi)])
+        self.assertEqual(0, ast.out_degree[ast.node_id('$inc@phi')])
@@ -0,0 +1,200 @@
+import concurrent.futures as cf
+import json
+import os
+import re
+import time
+import unittest
+
+from analysis.analysis_manager import AnalysisManager
+from batch import alarm, map_isolated, render_dot, Timeout
+from drawer import ASTDrawer, parse_formats
+from ir_reader import open_ir
+from llvm_ir_parser import LlvmFunction, LlvmIrBlockParser, split_module
+from main import pipeline
+
+
+def analyze_module(ll_file, out_dir=None, workers=None, fmt='dot',
+                   timeout=60, render_timeout=60, max_iterations=16,
+                   time_budget=None, chunk_lines=2000):
+    # One graph per defined function, analyzed across a process pool. The
+    # outputs land in out_dir next to an index.json listing every function
+    # with its status, size and files, in module order.
+    out_dir = out_dir or f'{ll_file}-functions'
+    os.makedirs(out_dir, exist_ok=True)
+    with open_ir(ll_file) as lines:
+        functions = list(split_module(lines))
+    saves = [os.path.join(out_dir, name) for name in file_names(functions)]
+    formats = [f for f in parse_formats(fmt) if f != 'dot']
+    started = time.monotonic()
+
+    results = {}
+    with cf.ThreadPoolExecutor(workers) as renderer:
+        renders = {}
+        for result in _analyze_all(list(zip(functions, saves)), workers,
+                                   timeout, max_iterations, time_budget,
+                                   chunk_lines):
+            results[result['function']] = result
+            save_file = result.pop('save', None)
+            if formats and result['status'] == 'ok':
+                future = renderer.submit(render_dot, result['outputs']['dot'],
+                                         formats, save_file, render_timeout)
+                renders[future] = result
+        for future in cf.as_completed(renders):
+            rendered = future.result()
+            outputs = rendered.pop('outputs', [])
+            renders[future].update(rendered)
+            renders[future]['outputs'].update(zip(formats, outputs))
+
+    counts = {}
+    for r in results.values():
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    index = {'module': ll_file, 'counts': counts,
+             'seconds': time.monotonic() - started,
+             'functions': [results[f.name] for f in functions]}
+    with open(os.path.join(out_dir, 'index.json'), 'w+') as f:
+        json.dump(index, f, indent=2)
+    print(' '.join(f'{k}: {v}' for k, v in counts.items()),
+          f'in {index["seconds"]:.1f}s')
+    return index
+
+
+def analyze_function(fn: LlvmFunction, max_iterations=16, time_budget=None):
+    parser = LlvmIrBlockParser(hash_cons=True)
+    parser.parser(line for _, line in fn.body)
+    return AnalysisManager(pipeline(), max_iterations,
+                           time_budget)(parser.ast)
+
+
+def file_names(functions):
+    # function names turned into unique file names
+    names, seen = [], set()
+    for fn in functions:
+        base = re.sub(r'[^\w.-]', '_', fn.name.lstrip('@').strip('"')) or '_'
+        name, i = base, 1
+        while name.lower() in seen:
+            i += 1
+            name = f'{base}.{i}'
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def _chunks(tasks, chunk_lines):
+    # thousands of small functions are shipped to the workers in batches
+    chunk, size = [], 0
+    for task in tasks:
+        chunk.append(task)
+        size += len(task[0].body)
+        if size >= chunk_lines:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def _analyze_all(tasks, workers, timeout, max_iterations, time_budget,
+                 chunk_lines):
+    def split(task):
+        # a chunk which took its worker down is retried a function at a time
+        chunk, *args = task
+        return [([fn_save], *args) for fn_save in chunk]
+
+    chunks = [(chunk, timeout, max_iterations, time_budget)
+              for chunk in _chunks(tasks, chunk_lines)]
+    for (chunk, *_), results in map_isolated(_analyze_chunk, chunks,
+                                              workers, split):
+        yield from results or (_result(fn, 'crashed', 0.,
+                                       error='worker process died')
+                               for fn, _ in chunk)
+
+
+def _analyze_chunk(chunk, timeout, max_iterations, time_budget):
+    return [_analyze_one(fn, save_file, timeout, max_iterations, time_budget)
+            for fn, save_file in chunk]
+
+
+def _analyze_one(fn: LlvmFunction, save_file, timeout, max_iterations,
+                 time_budget):
+    started = time.monotonic()
+    try:
+        with alarm(timeout):
+            ast = analyze_function(fn, max_iterations, time_budget)
+            ASTDrawer(ast).render(save_file, ['dot'])
+    except Timeout:
+        return _result(fn, 'timeout', time.monotonic() - started)
+    except Exception as e:
+        return _result(fn, 'failed', time.monotonic() - started,
+                       error=f'{type(e).__name__}: {e}')
+    return _result(fn, 'ok', time.monotonic() - started, save=save_file,
+                   outputs={'dot': f'{save_file}.dot'},
+                   nodes=ast.number_of_nodes(), edges=ast.number_of_edges())
+
+
+def _result(fn: LlvmFunction, status, seconds, **extra):
+    return dict(function=fn.name, line=fn.lineno, blocks=len(fn.blocks),
+                instructions=len(fn.body), status=status, seconds=seconds,
+                **extra)
+
+
+class Test(unittest.TestCase):
+    module = '''
+define i32 @f(i32 %a, i32 %b) {
+  %1 = xor i32 %a, %b
+  %2 = and i32 %1, 4294967295
+  %3 = or i32 %2, 0
+  ret i32 %3
+}
+
+define i32 @"f"(i32 %a) {
+  %1 = sdiv i32 %a, 0
+  ret i32 %1
+}
+
+define i32 @loop(i32 %n) {
+entry:
+  br label %body
+
+body:
+  %i = phi i32 [ 0, %entry ], [ %next, %body ]
+  %next = add nuw i32 %i, 1
+  %done = icmp eq i32 %next, %n
+  br i1 %done, label %exit, label %body
+
+exit:
+  ret i32 %next
+}
+'''
+
+    def test_analyze_module(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as d:
+            ll_file = os.path.join(d, 'm.ll')
+            with open(ll_file, 'w') as f:
+                f.write(self.module)
+
+            index = analyze_module(ll_file, workers=2, chunk_lines=1)
+            self.assertEqual({'ok': 3}, index['counts'])
+            f, f2, loop = index['functions']
+            self.assertEqual(('@f', 1, 4), (f['function'], f['blocks'],
+                                            f['instructions']))
+            self.assertTrue(f2['outputs']['dot'].endswith('f.2.dot'))
+            self.assertEqual(3, loop['blocks'])
+            with open(os.path.join(f'{ll_file}-functions',
+                                   'index.json')) as f:
+                self.assertEqual(index['functions'],
+                                 json.load(f)['functions'])
+
+    def test_decimal_constants(self):
+        fn, _, _ = split_module(self.module)
+        ast = analyze_function(fn)
+        # the masks only simplify away when read as decimal
+        self.assertEqual(['$3', 'xor#01', '$a', '$b'],
+                         [ast.name(n) for n in ast.topological_sort()])
+
+
+if __name__ == '__main__':
+    # the counts line is printed already, keep fire from dumping the index
+    import fire
+
+    fire.Fire(analyze_module, serialize=lambda _: None)
@@ -0,0 +1,188 @@
+import heapq
+import unittest
+
+from ir_graph import IrGraph
+
+# ntyp of the nodes standing in for a collapsed subtree
+SUMMARY_NTYP = 'sum'
+
+
+def collapse(ast: IrGraph, budget: int, by='distance', expand=()):
+    # Keeps about `budget` nodes, growing the kept part best first from the
+    # entries, nearest ones (by='distance') or the ones heading the largest
+    # subtrees (by='size') first. Each operand hanging off the kept part
+    # becomes one summary node for everything below it. Names in expand are
+    # kept in any case, so a summary from a former manifest can be opened.
+    if by not in ('distance', 'size'):
+        raise ValueError(f'Unknown level of detail order {by!r}')
+
+    priority = _depths(ast) if by == 'distance' else \
+        {n: -size for n, size in _tree_sizes(ast).items()}
+    kept, frontier = _grow(ast, budget, priority)
+    for name in expand:
+        n = ast.node_id(name)
+        if n is not None:
+            _keep(ast, n, kept, frontier)
+
+    # frontier nodes in priority order claim what they reach, shared
+    # operands end up in the summary reaching them first
+    owner = {n: n for n in kept}
+    groups = {}
+    for f in sorted(frontier, key=lambda n: (priority[n], n)):
+        if f in owner:
+            continue
+        group, stack = [], [f]
+        owner[f] = f
+        while stack:
+            n = stack.pop()
+            group.append(n)
+            for s in ast.successors(n):
+                if s not in owner:
+                    owner[s] = f
+                    stack.append(s)
+        groups[f] = group
+
+    return _build(ast, owner, groups, budget, by)
+
+
+def _grow(ast: IrGraph, budget, priority):
+    roots = [n for n in ast.nodes if ast.in_degree[n] == 0]
+    heap = [(priority[n], n) for n in roots]
+    heapq.heapify(heap)
+    kept, frontier = set(), set(roots)
+    while heap and len(kept) + len(frontier) < budget:
+        _, n = heapq.heappop(heap)
+        frontier.discard(n)
+        kept.add(n)
+        for s in ast.successors(n):
+            if s not in kept and s not in frontier:
+                frontier.add(s)
+                heapq.heappush(heap, (priority[s], s))
+    return kept, frontier
+
+
+def _keep(ast: IrGraph, n, kept, frontier):
+    # a node only shows up together with the path leading to it
+    stack = [n]
+    while stack:
+        n = stack.pop()
+        if n in kept:
+            continue
+        kept.add(n)
+        frontier.discard(n)
+        stack.extend(ast.predecessors(n))
+    for n in kept:
+        frontier.update(s for s in ast.successors(n) if s not in kept)
+
+
+def _build(ast: IrGraph, owner, groups, budget, by):
+    g = IrGraph()
+    ids, manifest = {}, {'budget': budget, 'by': by, 'collapsed': {}}
+    for n in ast.nodes:
+        if owner[n] != n:
+            continue
+
+        group = groups.get(n)
+        if group is None or len(group) == 1:
+            attrs = ast.attrs(n)
+            del attrs['label'], attrs['ntyp']
+            ids[n] = g.add_node(ast.name(n), ast.label(n), ast.ntyp(n),
+                                **attrs)
+            continue
+
+        name, op = ast.name(n), _root_op(ast, n)
+        summary = f'{name}+{len(group)}'
+        ids[n] = g.add_node(summary, f'{op} ({len(group)} nodes)',
+                            SUMMARY_NTYP, root=name, size=len(group))
+        manifest['collapsed'][summary] = {
+            'root': name, 'root_op': op, 'size': len(group),
+            'expand': name, 'nodes': [ast.name(k) for k in group]}
+
+    edges = set()
+    for u, v in ast.edges():
+        e = ids[owner[u]], ids[owner[v]]
+        if e[0] != e[1] and e not in edges:
+            edges.add(e)
+            g.add_edge(*e)
+    return g, manifest
+
+
+def _root_op(ast: IrGraph, n):
+    # a var only holds its op, that one tells what the subtree computes
+    if ast.ntyp(n) != 'op' and ast.out_degree[n] == 1:
+        n = next(ast.successors(n))
+    return ast.label(n)
+
+
+def _depths(ast: IrGraph):
+    depth = {}
+    for n in ast.topological_sort():
+        d = depth.setdefault(n, 0) + 1
+        for s in ast.successors(n):
+            if depth.get(s, d) >= d:
+                depth[s] = d
+    return depth
+
+
+def _tree_sizes(ast: IrGraph):
+    # operands shared by several users count for each, cheap and good
+    # enough to rank subtrees by
+    size = {}
+    for n in reversed(ast.topological_sort()):
+        size[n] = min(1 + sum(size[s] for s in ast.successors(n)), len(ast))
+    return size
+
+
+class Test(unittest.TestCase):
+    @staticmethod
+    def tree(depth):
+        # a complete binary tree of ops under one var
+        g = IrGraph()
+        root = g.add_node('root', 'root', 'v')
+        level = [g.add_node('op', '+', 'op')]
+        g.add_edge(root, level[0])
+        for d in range(depth):
+            below = []
+            for i, n in enumerate(level):
+                for j in range(2):
+                    name = f'op{d}.{2 * i + j}'
+                    below.append(g.add_node(name, '+', 'op'))
+                    g.add_edge(n, below[-1])
+            level = below
+        return g
+
+    def test_collapse(self):
+        ast = self.tree(8)
+        for by in ('distance', 'size'):
+            g, manifest = collapse(ast, 40, by)
+            self.assertLessEqual(len(g), 40)
+            collapsed = manifest['collapsed']
+            self.assertEqual(len(ast), len(g) - len(collapsed) +
+                             sum(c['size'] for c in collapsed.values()))
+
+            summary = g.node_id(next(iter(collapsed)))
+            self.assertEqual(SUMMARY_NTYP, g.ntyp(summary))
+            self.assertEqual(1, g.in_degree[summary])
+            self.assertEqual(0, g.out_degree[summary])
+
+    def test_expand(self):
+        ast = self.tree(6)
+        g, manifest = collapse(ast, 10)
+        name, summary = next(iter(manifest['collapsed'].items()))
+
+        g, manifest = collapse(ast, 10, expand=[summary['expand']])
+        self.assertNotIn(name, manifest['collapsed'])
+        self.assertIsNotNone(g.node_id(summary['root']))
+        self.assertEqual(2, g.out_degree[g.node_id(summary['root'])])
+
+    def test_shared_operand(self):
+        g = IrGraph()
+        a, b, c, d, e = [g.add_node(x, x, 'op') for x in 'abcde']
+        g.add_edges_from([(a, b), (a, c), (b, d), (c, d), (d, e)])
+
+        collapsed, manifest = collapse(g, 3)
+        # d is claimed by b's summary, c still points into it
+        self.assertEqual(['a', 'b+3', 'c'],
+                         sorted(map(collapsed.name, collapsed)))
+        self.assertTrue(collapsed.has_edge(collapsed.node_id('c'),
+                                           collapsed.node_id('b+3')))
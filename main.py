@@ -1,47 +1,198 @@
+import json
 import os
-import fire
+import shutil
+from functools import partial
 
-from analysis.analysis_manager import AnalysisManager
+import snapshot
+from analysis.analysis_manager import AnalysisManager, ParallelAnalysisManager
 from analysis.clean_drop_off import CleanDropOff
+from analysis.egraph import EqualitySaturation
 from analysis.fold_constant import FoldConstant
 from analysis.mark_entries import MarkEntries
+from analysis.profiler import StageProfiler, stage
 from analysis.prune_branches import PruneBranches
 from analysis.simplify import Simplify
+from analysis.value_numbering import ValueNumbering
 from bap_ir_parser import BapIrBlockParser
-from drawer import ASTDrawer
+from drawer import ASTDrawer, parse_formats
+from ir_reader import open_ir
 from llvm_ir_parser import LlvmIrBlockParser
+from lod import collapse
+from result_cache import ResultCache, file_digest
 
 
-def parser_factory(ir_file):
+def parser_factory(ir_file, hash_cons=True):
     _, ext = os.path.splitext(ir_file)
     return {
-        '.bc': LlvmIrBlockParser(),
-        '.bir': BapIrBlockParser()
-    }[ext]
+        '.bc': LlvmIrBlockParser,
+        '.bir': BapIrBlockParser
+    }[ext](hash_cons=hash_cons)
 
 
-def paint(ir_file='.out/sample.bir', tag='ana-new'):
-    tag = f'-{tag}' if tag else tag
-    with open(ir_file, 'r') as f:
-        block = f.read()
-
-    parser = parser_factory(ir_file)
-    parser.parser(block)
-
-    ast = AnalysisManager([
+def pipeline(saturate=False):
+    # saturate adds the e-graph search for smaller equivalent expressions,
+    # which spends seconds where the rest takes milliseconds
+    passes = [
+        ValueNumbering(),
         FoldConstant(),
         CleanDropOff(),
         MarkEntries(fill_color='black'),
         PruneBranches(),
         Simplify()
-    ])(parser.ast)
+    ]
+    if saturate:
+        passes.append(EqualitySaturation())
+    return passes
+
+
+def _manager(passes, saturate, workers, max_iterations, time_budget,
+             profiler):
+    # given workers, the components of the graph are analyzed in that many
+    # processes, each building its own passes
+    if workers is None:
+        return AnalysisManager(passes, max_iterations, time_budget, profiler)
+    return ParallelAnalysisManager(
+        partial(pipeline, saturate), workers,
+        max_iterations, time_budget, profiler)
+
+
+def cache_keys(ir_file, parser, passes, max_iterations, targets=None):
+    # the key of the parse and the key of the analyzed graph, chaining the
+    # first, so that changing a pass keeps the parse
+    targets = None if targets is None else sorted(targets)
+    parse_key = ResultCache.key(file_digest(ir_file), type(parser).__name__,
+                                parser.hash_cons is not None, targets)
+    return parse_key, ResultCache.key(parse_key,
+                                      tuple(p.config() for p in passes),
+                                      max_iterations)
+
+
+def _parse(ir_file, parser, profiler=None, targets=None):
+    # with targets only their backward slice, () for the default ones
+    with stage(profiler, 'parse') as s, open_ir(ir_file) as lines:
+        if targets is None:
+            parser.parser(lines)
+        else:
+            parser.parse_slice(lines, targets)
+        if s is not None:
+            # the parsed size is what the passes start from
+            s.ast = parser.ast
+
 
-    drawer = ASTDrawer(ast)
-    drawer.draw(save_file=f'{ir_file}{tag}')
+def analyze(ir_file, max_iterations=16, time_budget=None, cache=None,
+            profiler=None, targets=None, saturate=False, workers=None,
+            keys=None):
+    if ir_file.endswith(snapshot.EXT):
+        if targets is not None:
+            raise ValueError('Only ir files can be sliced, not snapshots')
+        # a saved graph, on an analyzed one the passes settle at once
+        with stage(profiler, 'load') as s:
+            ast = snapshot.load(ir_file)
+            if s is not None:
+                s.ast = ast
+        return _manager(pipeline(saturate), saturate, workers,
+                        max_iterations, time_budget, profiler)(ast)
 
-    with open(f'{ir_file}{tag}.dot', 'w+') as f:
-        f.write(ast.to_string())
+    parser, passes = parser_factory(ir_file), pipeline(saturate)
+    manager = _manager(passes, saturate, workers, max_iterations,
+                       time_budget, profiler)
+    if cache is None:
+        _parse(ir_file, parser, profiler, targets)
+        return manager(parser.ast)
+
+    # the same run as without a cache, only its parse and its converged
+    # result are kept; keys as given by cache_keys
+    parse_key, result_key = keys or cache_keys(ir_file, parser, passes,
+                                                max_iterations, targets)
+    if cache.has_graph(result_key):
+        with stage(profiler, 'load'):
+            return cache.get_graph(result_key)
+    if cache.has_graph(parse_key):
+        with stage(profiler, 'load'):
+            ast = cache.get_graph(parse_key)
+    else:
+        _parse(ir_file, parser, profiler, targets)
+        ast = parser.ast
+        cache.put_graph(parse_key, ast)
+
+    ast = manager(ast)
+    if manager.converged:
+        cache.put_graph(result_key, ast)
+    return ast
+
+
+def paint(ir_file='.out/sample.bir', tag='ana-new', max_iterations=16,
+          time_budget=None, fmt='png', budget=None, lod_by='distance',
+          expand=(), cache_dir=None, cache_size=1 << 30, profile=None,
+          profile_memory=False, cprofile_dir=None, save_snapshot=False,
+          targets=None, saturate=False, workers=None):
+    tag = f'-{tag}' if tag else tag
+    save_file = f'{ir_file}{tag}'
+    formats = list(dict.fromkeys(['dot', *parse_formats(fmt)]))
+    outputs = {ext: f'{save_file}.{ext}' for ext in formats}
+    expand = [expand] if isinstance(expand, str) else list(expand)
+    if budget:
+        outputs['lod.json'] = f'{save_file}.lod.json'
+    if save_snapshot:
+        outputs['irgs'] = f'{save_file}{snapshot.EXT}'
+    # --targets=RAX,RDX.3 draws only what those depend on, a bare --targets
+    # the default outputs of the block
+    if targets is True:
+        targets = []
+    elif targets is not None:
+        targets = parse_formats(targets)
+
+    cache = keys = key = None
+    # a snapshot input is quick to load already
+    if cache_dir and not ir_file.endswith(snapshot.EXT):
+        cache = ResultCache(cache_dir, cache_size)
+        keys = cache_keys(ir_file, parser_factory(ir_file),
+                          pipeline(saturate), max_iterations, targets)
+        key = ResultCache.key(keys[1], budget, lod_by, expand)
+        hits = {ext: cache.get(key, f'out.{ext}') for ext in outputs}
+        if all(hits.values()):
+            for ext, path in hits.items():
+                shutil.copyfile(path, outputs[ext])
+            return
+
+    # profile is where the json report goes, cprofile_dir gets one dump
+    # of cProfile stats per stage
+    profiler = StageProfiler(profile_memory, cprofile_dir) \
+        if profile or cprofile_dir else None
+    try:
+        ast = analyze(ir_file, max_iterations, time_budget, cache, profiler,
+                      targets, saturate, workers, keys)
+        if save_snapshot:
+            # the whole analyzed graph, for re-rendering without the parse
+            snapshot.save(ast, outputs['irgs'])
+        if budget:
+            # keep the layout bounded, the manifest tells what to expand
+            with stage(profiler, 'lod', ast) as s:
+                ast, manifest = collapse(ast, budget, lod_by, expand)
+                if s is not None:
+                    s.ast = ast
+            with open(outputs['lod.json'], 'w+') as f:
+                json.dump(manifest, f, indent=2)
+        with stage(profiler, 'render', ast):
+            ASTDrawer(ast).render(save_file, formats)
+    finally:
+        if profiler is not None:
+            profiler.close()
+    if profile:
+        profiler.dump(profile)
+    elif profiler is not None:
+        profiler.dump_profiles()
+
+    if cache is not None:
+        # only a converged analysis left its graph behind to stick to
+        if cache.has_graph(keys[1]):
+            for ext, path in outputs.items():
+                cache.put_file(key, f'out.{ext}', path)
+        cache.evict()
 
 
 if __name__ == '__main__':
+    # fire takes as long to import as the rest, only the cli pays for it
+    import fire
+
     fire.Fire(paint)
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import snapshot
+from ir_graph import IrGraph
+
+# bump whenever what is stored changes shape
+CACHE_VERSION = 2
+GRAPH_FILE = f'graph{snapshot.EXT}'
+
+
+class ResultCache:
+    # Content addressed cache on disk. Every key names a directory holding
+    # a few named files. evict() drops the least recently used directories
+    # once the cache outgrows max_bytes, a read refreshes the mtime.
+    def __init__(self, root='.ir-cache', max_bytes=1 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(repr((CACHE_VERSION,) + parts).encode()) \
+            .hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.root, key[:2], key, name)
+
+    def get(self, key, name):
+        path = self.path(key, name)
+        if not os.path.exists(path):
+            return None
+        now = time.time()
+        os.utime(os.path.dirname(path), (now, now))
+        return path
+
+    def put(self, key, name, data: bytes):
+        path = self.path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside and rename, readers never see half written files
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def put_file(self, key, name, src):
+        with open(src, 'rb') as f:
+            return self.put(key, name, f.read())
+
+    def has_graph(self, key):
+        return self.get(key, GRAPH_FILE) is not None
+
+    def get_graph(self, key):
+        path = self.get(key, GRAPH_FILE)
+        if path is None:
+            return None
+        return snapshot.load(path)
+
+    def put_graph(self, key, ast: IrGraph):
+        return self.put(key, GRAPH_FILE, snapshot.dumps(ast))
+
+    def evict(self):
+        entries, total = [], 0
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+
+        entries.sort()
+        # the newest entry stays even if it alone is too large
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Test(unittest.TestCase):
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = ResultCache(d)
+            key = cache.key('a', 1)
+            self.assertNotEqual(key, cache.key('a', 2))
+            self.assertIsNone(cache.get(key, 'out.dot'))
+
+            cache.put(key, 'out.dot', b'digraph {}')
+            with open(cache.get(key, 'out.dot'), 'rb') as f:
+                self.assertEqual(b'digraph {}', f.read())
+
+            g = IrGraph()
+            g.add_edge(g.add_node('a', 'a', 'v'), g.add_node('b', 'b', 'v'))
+            cache.put_graph(key, g)
+            self.assertEqual([(0, 1)], list(cache.get_graph(key).edges()))
+
+    def test_evict_lru(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = ResultCache(d)
+            keys = [cache.key(i) for i in range(3)]
+            for i, key in enumerate(keys):
+                cache.put(key, 'data', bytes(100))
+                os.utime(os.path.dirname(cache.path(key, 'data')),
+                         (i, i))
+
+            # reading the oldest entry makes the middle one the victim
+            self.assertIsNotNone(cache.get(keys[0], 'data'))
+            cache.max_bytes = 250
+            cache.evict()
+            self.assertEqual([True, False, True],
+                             [cache.get(k, 'data') is not None for k in keys])
+
+    def test_pipeline_keys(self):
+        from analysis.mark_entries import MarkEntries
+        from main import analyze, cache_keys, parser_factory, pipeline
+
+        with tempfile.TemporaryDirectory() as d:
+            ir_file = os.path.join(d, 'block.bc')
+            with open(ir_file, 'w') as f:
+                f.write('%1 = xor i32 %reg, %reg\n%2 = add i32 %1, 0x5\n'
+                        '%3 = and i32 %2, 0x3FC0\n%4 = or i32 %3, 0x3fc0\n')
+
+            # cold or warm, the cache gives what an uncached run does
+            cache = ResultCache(os.path.join(d, 'cache'))
+            expected = analyze(ir_file).to_string()
+            self.assertEqual(expected,
+                             analyze(ir_file, cache=cache).to_string())
+            self.assertEqual(expected,
+                             analyze(ir_file, cache=cache).to_string())
+
+            parser, passes = parser_factory(ir_file), pipeline()
+            keys = cache_keys(ir_file, parser, passes, 16)
+            self.assertTrue(all(map(cache.has_graph, keys)))
+
+            # a different MarkEntries keeps the parse
+            i = next(i for i, p in enumerate(passes)
+                     if isinstance(p, MarkEntries))
+            passes[i] = MarkEntries(fill_color='red')
+            changed = cache_keys(ir_file, parser, passes, 16)
+            self.assertEqual(keys[0], changed[0])
+            self.assertNotEqual(keys[1], changed[1])
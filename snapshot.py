@@ -0,0 +1,299 @@
+import gc
+import json
+import mmap
+import struct
+import sys
+import unittest
+from array import array
+from itertools import accumulate
+
+from ir_graph import IrGraph
+
+# Layout, little endian, every section starts 8 byte aligned:
+#   header       magic, version, the counts below
+#   strings      int64 offsets[n_strings + 1] into the utf-8 blob at the end
+#   nodes        int32 name[n], label[n], ntyp[n], string ids, uint8 alive[n]
+#   succ, pred   int64 offsets[n + 1] and int32 targets[n_edges] each, so
+#                operand order and user order both survive
+#   attrs        int32 node[k], key[k], int64 value[k], uint8 kind[k]; a
+#                value is a string id, an int or a string id of json
+#   blob         the string table
+# Node ids are kept as they are, dead ones included, so a loaded graph is
+# interchangeable with the saved one.
+MAGIC = b'IRGS'
+EXT = '.irgs'
+VERSION = 1
+_header = struct.Struct('<4sI5Q')
+
+_STR, _INT, _JSON = range(3)
+
+
+def dumps(ast: IrGraph) -> bytes:
+    return b''.join(_chunks(ast))
+
+
+def save(ast: IrGraph, path):
+    with open(path, 'wb') as f:
+        f.writelines(_chunks(ast))
+
+
+def loads(data) -> IrGraph:
+    with Snapshot(data) as s:
+        return s.graph()
+
+
+def load(path) -> IrGraph:
+    with Snapshot.open(path) as s:
+        return s.graph()
+
+
+def _chunks(ast: IrGraph):
+    strings, name, label, ntyp, alive, succ, pred, attrs = ast.columns()
+    # attribute keys and values go after the strings of the graph
+    strings, extra = list(strings), {}
+
+    def intern(s):
+        sid = extra.get(s)
+        if sid is None:
+            sid = extra[s] = len(strings)
+            strings.append(s)
+        return sid
+
+    attr_node, attr_key = array('i'), array('i')
+    attr_value, attr_kind = array('q'), array('B')
+    for n, a in enumerate(attrs):
+        for key, value in (a or {}).items():
+            attr_node.append(n)
+            attr_key.append(intern(key))
+            if isinstance(value, str):
+                kind, value = _STR, intern(value)
+            elif type(value) is int and -1 << 63 <= value < 1 << 63:
+                kind = _INT
+            else:
+                kind, value = _JSON, intern(json.dumps(value))
+            attr_value.append(value)
+            attr_kind.append(kind)
+
+    encoded = [s.encode() for s in strings]
+    offsets = array('q', accumulate(map(len, encoded), initial=0))
+    succ_offsets, succ = _csr(succ)
+    pred_offsets, pred = _csr(pred)
+
+    yield _header.pack(MAGIC, VERSION, len(strings), offsets[-1], len(name),
+                       len(succ), len(attr_node))
+    for column in (offsets, name, label, ntyp, array('B', alive),
+                   succ_offsets, succ, pred_offsets, pred, attr_node,
+                   attr_key, attr_value, attr_kind):
+        data = _little(column).tobytes()
+        yield data
+        yield bytes(-len(data) % 8)
+    yield b''.join(encoded)
+
+
+def _csr(adjacency):
+    targets = array('i')
+    targets.frombytes(b''.join(adjacency))
+    return array('q', accumulate(map(len, adjacency), initial=0)), targets
+
+
+def _little(column: array):
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class Snapshot:
+    # Read side over bytes or an mmap of a snapshot file. The columns are
+    # zero copy memoryviews, graph() builds an IrGraph out of them.
+    def __init__(self, data):
+        self.__view = memoryview(data)
+        self.__mmap = None
+        self.__file = None
+
+        if len(data) < _header.size:
+            raise ValueError('Not an ir graph snapshot')
+        magic, version, n_strings, blob_size, n, n_edges, n_attrs = \
+            _header.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not an ir graph snapshot')
+        if version != VERSION:
+            raise ValueError(f'Unsupported snapshot version {version}')
+
+        self.id_bound = n
+        self.number_of_edges = n_edges
+        self.__pos = _header.size
+        self.string_offsets = self.__column('q', n_strings + 1)
+        self.name = self.__column('i', n)
+        self.label = self.__column('i', n)
+        self.ntyp = self.__column('i', n)
+        self.alive = self.__column('B', n)
+        self.succ_offsets = self.__column('q', n + 1)
+        self.succ = self.__column('i', n_edges)
+        self.pred_offsets = self.__column('q', n + 1)
+        self.pred = self.__column('i', n_edges)
+        self.attr_node = self.__column('i', n_attrs)
+        self.attr_key = self.__column('i', n_attrs)
+        self.attr_value = self.__column('q', n_attrs)
+        self.attr_kind = self.__column('B', n_attrs)
+        self.blob = self.__view[self.__pos:self.__pos + blob_size]
+        if len(self.blob) != blob_size:
+            raise ValueError('Truncated ir graph snapshot')
+
+    @classmethod
+    def open(cls, path):
+        f = open(path, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            f.close()
+            raise ValueError(f'Not an ir graph snapshot: {path}')
+        try:
+            s = cls(mm)
+        except ValueError:
+            mm.close()
+            f.close()
+            raise
+        s.__mmap, s.__file = mm, f
+        return s
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for column in self.__columns():
+            column.release()
+        self.__view.release()
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__file.close()
+            self.__mmap = self.__file = None
+
+    def strings(self):
+        offsets = self.string_offsets.tolist()
+        data = bytes(self.blob)
+        if data.isascii():
+            # byte offsets are char offsets, one decode for all of them
+            text = data.decode()
+            return [text[a:b] for a, b in zip(offsets, offsets[1:])]
+        return [data[a:b].decode() for a, b in zip(offsets, offsets[1:])]
+
+    def graph(self) -> IrGraph:
+        # Allocating a few containers per node sets off full collections
+        # which find nothing to free and take most of the time otherwise.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self.__graph()
+        finally:
+            if enabled:
+                gc.enable()
+
+    def __graph(self):
+        strings = self.strings()
+        attrs = {}
+        for n, key, value, kind in zip(
+                self.attr_node.tolist(), self.attr_key.tolist(),
+                self.attr_value.tolist(), self.attr_kind.tolist()):
+            if kind == _STR:
+                value = strings[value]
+            elif kind == _JSON:
+                value = json.loads(strings[value])
+            attrs.setdefault(n, {})[strings[key]] = value
+
+        return IrGraph.from_columns(
+            strings, _native('i', self.name), _native('i', self.label),
+            _native('i', self.ntyp), bytes(self.alive),
+            _split(self.succ_offsets, _native('i', self.succ)),
+            _split(self.pred_offsets, _native('i', self.pred)), attrs)
+
+    def __column(self, typecode, count):
+        size = array(typecode).itemsize * count
+        start, self.__pos = self.__pos, self.__pos + size + (-size % 8)
+        view = self.__view[start:start + size]
+        if len(view) != size:
+            raise ValueError('Truncated ir graph snapshot')
+        if sys.byteorder == 'big':
+            # a copy, memoryviews cannot swap bytes
+            return _native(typecode, view)
+        return view.cast(typecode)
+
+    def __columns(self):
+        return [self.string_offsets, self.name, self.label, self.ntyp,
+                self.alive, self.succ_offsets, self.succ, self.pred_offsets,
+                self.pred, self.attr_node, self.attr_key, self.attr_value,
+                self.attr_kind, self.blob]
+
+
+def _native(typecode, column):
+    # an owned array of native byte order, whatever the column is backed by
+    if isinstance(column, array):
+        return column
+    out = array(typecode)
+    out.frombytes(column.cast('B') if column.format != 'B' else column)
+    if sys.byteorder == 'big' and out.itemsize > 1:
+        out.byteswap()
+    return out
+
+
+def _split(offsets, targets: array):
+    offsets = offsets.tolist()
+    return [targets[a:b] for a, b in zip(offsets, offsets[1:])]
+
+
+class Test(unittest.TestCase):
+    @staticmethod
+    def graph():
+        g = IrGraph()
+        v = g.add_node('RSI.1', 'RSI.1', 'v', typ='i32', cast='low:32')
+        op = g.add_node('&#2', '&', 'op')
+        c = g.add_node('0x3FC0#3', '0x3FC0', 'c', size=-5, flags=[1, 'x'])
+        dead = g.add_node('dead', 'dead', 'v')
+        w = g.add_node('RDI.1', 'RDI.1', 'v', label2='ü')
+        g.add_edges_from([(w, op), (v, op), (op, c), (op, w), (op, c)])
+        g.remove_node(dead)
+        return g
+
+    def assertSameGraph(self, expected: IrGraph, actual: IrGraph):
+        def dump(g):
+            return [(g.name(n), g.attrs(n),
+                     [g.name(s) for s in g.successors(n)],
+                     [g.name(p) for p in g.predecessors(n)]) for n in g]
+        self.assertEqual(dump(expected), dump(actual))
+
+    def test_round_trip(self):
+        import os
+        import tempfile
+
+        g = self.graph()
+        self.assertSameGraph(g, loads(dumps(g)))
+        self.assertEqual(g.id_bound(), loads(dumps(g)).id_bound())
+        self.assertSameGraph(IrGraph(), loads(dumps(IrGraph())))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'g.irgs')
+            save(g, path)
+            loaded = load(path)
+            self.assertSameGraph(g, loaded)
+            # the loaded graph is a normal mutable one
+            loaded.add_node('new', 'new', 'v')
+            loaded.remove_node(loaded.node_id('&#2'))
+            self.assertEqual(0, loaded.number_of_edges())
+
+    def test_columns(self):
+        with Snapshot(dumps(self.graph())) as s:
+            self.assertEqual((5, 5), (s.id_bound, s.number_of_edges))
+            strings = s.strings()
+            self.assertEqual(['RSI.1', '&#2', '0x3FC0#3', 'dead', 'RDI.1'],
+                             [strings[i] for i in s.name])
+            self.assertEqual([1, 1, 1, 0, 1], list(s.alive))
+            self.assertEqual([0, 1, 4, 4, 4, 5], list(s.succ_offsets))
+
+        with self.assertRaises(ValueError):
+            Snapshot(b'digraph {}')
+        with self.assertRaises(ValueError):
+            Snapshot(dumps(self.graph())[:-3])
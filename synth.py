@@ -0,0 +1,137 @@
+import random
+import unittest
+
+# weighted like the obfuscated samples, mostly bitwise with some arithmetic
+binops = [('&', 'and', 6), ('|', 'or', 5), ('^', 'xor', 7), ('+', 'add', 1),
+          ('-', 'sub', 1), ('*', 'mul', 1), ('<<', 'shl', 1)]
+regs = ['RAX', 'RBX', 'RCX', 'RDX', 'RSI', 'RDI', 'RBP', 'R8', 'R9']
+
+
+class _Gen:
+    # Picks ops and operands for synthetic MBA-like blocks. Leaves are
+    # constants with probability const_density, else values defined before
+    # with probability sharing, else free inputs.
+    def __init__(self, depth, const_density, sharing, seed):
+        self.depth = depth
+        self.const_density = const_density
+        self.sharing = sharing
+        self.rng = random.Random(seed)
+        self.ops = [op for op in binops for _ in range(op[2])]
+
+    def op(self):
+        return self.rng.choice(self.ops)
+
+    def depth_of(self):
+        return self.rng.randint(1, self.depth)
+
+    def const(self, op):
+        if op == '<<':
+            return f'0x{self.rng.randrange(32):X}'
+        return f'0x{self.rng.getrandbits(32):X}'
+
+    def leaf_kind(self):
+        r = self.rng.random()
+        if r < self.const_density:
+            return 'c'
+        return 'shared' if r < self.const_density + \
+            (1 - self.const_density) * self.sharing else 'free'
+
+
+def bap_block(lines=1000, depth=2, const_density=0.3, sharing=0.7, seed=0):
+    # lines like 'RSI := pad:64[low:32[RSI] & 0x5312623B]', registers
+    # written before are shared, the ones never written are inputs
+    gen = _Gen(depth, const_density, sharing, seed)
+    written = []
+
+    def leaf(op):
+        kind = gen.leaf_kind()
+        if kind == 'c':
+            return gen.const(op)
+        reg = gen.rng.choice(written[-8:]) if kind == 'shared' and written \
+            else gen.rng.choice(regs)
+        return f'low:32[{reg}]'
+
+    def exp(d, op=None, top=False):
+        if d == 0:
+            return leaf(op)
+        if gen.rng.random() < 0.15:
+            return f'~{exp(d - 1)}'
+        sym, _, _ = gen.op()
+        body = f'{exp(d - 1, sym)} {sym} {exp(d - 1, sym)}'
+        return body if top else f'({body})'
+
+    out = []
+    for i in range(lines):
+        reg = gen.rng.choice(regs)
+        body = exp(gen.depth_of(), top=True)
+        out.append(f'{0x5af1f + 9 * i:08x}: {reg} := pad:64[{body}]')
+        written.append(reg)
+    return '\n'.join(out) + '\n'
+
+
+def llvm_block(lines=1000, depth=2, const_density=0.3, sharing=0.7, seed=0):
+    # one op per line; a nested expression of the given depth is spread
+    # over temporaries the way clang emits it
+    gen = _Gen(depth, const_density, sharing, seed)
+    out, defined = [], []
+    inputs = [f'%arg{i}' for i in range(8)]
+
+    def leaf(op):
+        kind = gen.leaf_kind()
+        if kind == 'c':
+            return gen.const(op)
+        if kind == 'shared' and defined:
+            return gen.rng.choice(defined[-8:])
+        return gen.rng.choice(inputs)
+
+    def emit(d, op=None):
+        if d == 0 or len(out) >= lines:
+            return leaf(op)
+        sym, name, _ = gen.op()
+        lhs, rhs = emit(d - 1, sym), emit(d - 1, sym)
+        if len(out) >= lines:
+            return lhs
+        var = f'%{len(out) + 1}'
+        out.append(f'{var} = {name} i32 {lhs}, {rhs}')
+        return var
+
+    while len(out) < lines:
+        defined.append(emit(gen.depth_of()))
+    return '\n'.join(out) + '\n'
+
+
+def write(path, lines=1000, depth=2, const_density=0.3, sharing=0.7,
+          seed=0):
+    block = (llvm_block if path.endswith('.bc') else bap_block)(
+        lines, depth, const_density, sharing, seed)
+    with open(path, 'w+') as f:
+        f.write(block)
+
+
+class Test(unittest.TestCase):
+    def test_parse(self):
+        from bap_ir_parser import BapIrBlockParser
+        from llvm_ir_parser import LlvmIrBlockParser
+
+        for make, parser in [(bap_block, BapIrBlockParser()),
+                             (llvm_block, LlvmIrBlockParser())]:
+            block = make(500, depth=3, seed=1)
+            self.assertEqual(500, len(block.splitlines()))
+            self.assertEqual(block, make(500, depth=3, seed=1))
+            parser.parser(block)
+            self.assertLess(500, len(parser.ast))
+
+    def test_density(self):
+        import re
+
+        no_consts = bap_block(200, const_density=0, seed=2)
+        self.assertFalse(re.search(r'0x[0-9A-F]{3}', no_consts))
+        no_sharing = llvm_block(200, depth=1, const_density=0, sharing=0,
+                                seed=2)
+        self.assertNotRegex(no_sharing, r'i32 %\d|, %\d')
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(write)
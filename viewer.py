@@ -0,0 +1,250 @@
+import html
+import subprocess
+import threading
+import unittest
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+from drawer import ASTDrawer
+from ir_graph import IrGraph
+
+_page = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>body {{ font-family: monospace; }} svg {{ max-width: 100%; }}</style>
+</head><body>
+<form action="/">
+  <input name="node" value="{node}" size="40">
+  <input name="hops" value="{hops}" size="3" type="number" min="0">
+  <input type="submit" value="show">
+</form>
+{body}
+</body></html>
+'''
+
+
+class GraphViewer:
+    # Renders the k-hop neighbourhood of one node at a time, so dot never
+    # lays out more than max_nodes. Rendered svgs stay in a bounded lru.
+    def __init__(self, ast: IrGraph, hops=2, max_nodes=400, cache_size=256):
+        self.ast = ast
+        self.hops = hops
+        self.max_nodes = max_nodes
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def default_node(self):
+        # the entry heading the most operands is a good place to start
+        entries = [n for n in self.ast.nodes if self.ast.in_degree[n] == 0]
+        if not entries:
+            return None
+        return self.ast.name(max(entries, key=lambda n: self.ast.degree[n]))
+
+    def neighbourhood(self, n, hops):
+        # breadth first along both users and operands
+        seen, level = {n}, [n]
+        for _ in range(hops):
+            below = []
+            for k in level:
+                for m in (*self.ast.successors(k), *self.ast.predecessors(k)):
+                    if m not in seen:
+                        if len(seen) >= self.max_nodes:
+                            return seen
+                        seen.add(m)
+                        below.append(m)
+            level = below
+        return seen
+
+    def svg(self, name, hops=None) -> bytes:
+        hops = self.hops if hops is None else hops
+        key = name, hops
+        with self.__lock:
+            if key in self.__cache:
+                self.__cache.move_to_end(key)
+                return self.__cache[key]
+
+        n = self.ast.node_id(name)
+        if n is None:
+            raise KeyError(name)
+        sub = self.ast.subgraph(self.neighbourhood(n, hops))
+        for k in sub.nodes:
+            # every node links to its own neighbourhood
+            sub.set_attr(k, 'URL', f'/?node={quote(sub.name(k))}&hops={hops}')
+            sub.set_attr(k, 'target', '_top')
+        sub.set_attr(sub.node_id(name), 'penwidth', '3')
+        svg = self.render(sub)
+
+        with self.__lock:
+            self.__cache[key] = svg
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        return svg
+
+    @staticmethod
+    def render(sub: IrGraph) -> bytes:
+        return ASTDrawer(sub).create('svg')
+
+    def page(self, name, hops=None):
+        hops = self.hops if hops is None else hops
+        name = name or self.default_node() or ''
+        try:
+            body = self.svg(name, hops).decode()
+            # drop the xml prolog, the svg goes inline
+            body = body[body.find('<svg'):]
+        except KeyError:
+            body = f'<p>No node named {html.escape(name)!r}</p>'
+        return _page.format(title=html.escape(name), node=html.escape(name),
+                            hops=hops, body=body).encode()
+
+    def handler(self):
+        viewer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                try:
+                    hops = int(query['hops']) if 'hops' in query else None
+                    if url.path == '/':
+                        self.__reply(200, 'text/html; charset=utf-8',
+                                     viewer.page(query.get('node'), hops))
+                    elif url.path == '/svg':
+                        self.__reply(200, 'image/svg+xml',
+                                     viewer.svg(query.get('node', ''), hops))
+                    else:
+                        self.__reply(404, 'text/plain', b'not found')
+                except KeyError as e:
+                    self.__reply(404, 'text/plain',
+                                 f'no node {e.args[0]!r}'.encode())
+                except ValueError as e:
+                    self.__reply(400, 'text/plain', str(e).encode())
+                except (OSError, subprocess.CalledProcessError) as e:
+                    # dot missing or failing on the graph
+                    error = e.stderr.decode(errors='replace').strip() \
+                        if isinstance(e, subprocess.CalledProcessError) \
+                        else str(e)
+                    self.__reply(500, 'text/plain',
+                                 f'dot failed: {error}'.encode())
+
+            def __reply(self, code, content_type, data: bytes):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def serve(ir_file='.out/sample.bir', host='127.0.0.1', port=8000, hops=2,
+          max_nodes=400, cache_size=256, cache_dir=None):
+    from main import analyze
+    from result_cache import ResultCache
+
+    cache = ResultCache(cache_dir) if cache_dir else None
+    viewer = GraphViewer(analyze(ir_file, cache=cache), hops, max_nodes,
+                         cache_size)
+    server = ThreadingHTTPServer((host, port), viewer.handler())
+    print(f'serving {ir_file} on http://{host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class Test(unittest.TestCase):
+    class Viewer(GraphViewer):
+        renders = 0
+
+        def render(self, sub: IrGraph) -> bytes:
+            self.renders += 1
+            names = ' '.join(sorted(map(sub.name, sub)))
+            return f'<?xml?><svg>{names}</svg>'.encode()
+
+    @staticmethod
+    def chain(length):
+        g = IrGraph()
+        nodes = [g.add_node(f'n{i}', f'n{i}', 'v') for i in range(length)]
+        g.add_edges_from(zip(nodes, nodes[1:]))
+        return g
+
+    def test_neighbourhood(self):
+        viewer = GraphViewer(self.chain(10), max_nodes=4)
+        self.assertEqual({3, 4, 5, 6, 7}, GraphViewer(self.chain(10))
+                         .neighbourhood(5, 2))
+        self.assertEqual(4, len(viewer.neighbourhood(5, 3)))
+
+    def test_svg_cache(self):
+        viewer = self.Viewer(self.chain(10), hops=1, cache_size=2)
+        self.assertEqual(b'<?xml?><svg>n4 n5 n6</svg>', viewer.svg('n5'))
+        viewer.svg('n5')
+        self.assertEqual(1, viewer.renders)
+
+        viewer.svg('n1')
+        viewer.svg('n2')
+        viewer.svg('n5')
+        self.assertEqual(4, viewer.renders)
+        with self.assertRaises(KeyError):
+            viewer.svg('missing')
+
+    def test_server(self):
+        from urllib.error import HTTPError
+        from urllib.request import urlopen
+
+        viewer = self.Viewer(self.chain(3), hops=1)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), viewer.handler())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_port}'
+            with urlopen(f'{url}/') as r:
+                page = r.read().decode()
+            self.assertIn('<svg>n0 n1</svg>', page)
+            self.assertNotIn('<?xml', page)
+            with urlopen(f'{url}/svg?node=n2&hops=2') as r:
+                self.assertEqual(b'<?xml?><svg>n0 n1 n2</svg>', r.read())
+            with self.assertRaises(HTTPError):
+                urlopen(f'{url}/svg?node=n9')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_render_failure(self):
+        from urllib.error import HTTPError
+        from urllib.request import urlopen
+
+        class Failing(GraphViewer):
+            errors = [OSError('no dot'), subprocess.CalledProcessError(
+                1, ['dot'], b'', b'syntax error')]
+
+            def render(self, sub: IrGraph) -> bytes:
+                raise self.errors.pop()
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                     Failing(self.chain(3)).handler())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_port}'
+            for path, message in [('/', b'dot failed: syntax error'),
+                                  ('/svg?node=n1', b'dot failed: no dot')]:
+                with self.assertRaises(HTTPError) as ctx:
+                    urlopen(f'{url}{path}')
+                self.assertEqual(500, ctx.exception.code)
+                self.assertEqual(message, ctx.exception.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(serve)
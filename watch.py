@@ -0,0 +1,625 @@
+import gc
+import os
+import time
+import unittest
+from difflib import SequenceMatcher
+
+import bap_ir_parser
+import llvm_ir_parser
+from analysis.AnalysisBase import DiGraphAnalysisBase
+from analysis.analysis_manager import AnalysisManager
+from drawer import ASTDrawer, parse_formats
+from ir_reader import numbered_inst_lines, open_ir
+from main import parser_factory, pipeline
+
+
+class IncrementalAnalysis:
+    # Keeps the analyzed graph of an ir file in memory. An update diffs the
+    # lines against the last ones and reparses only what an edit reaches:
+    # the changed lines, the lines using them on down, and the lines whose
+    # nodes the analysis had shared with any of those. The passes then
+    # rerun as settled ones for the nodes touched. The graph kept is the
+    # one before the whole graph passes: which entry is the main one
+    # depends on the whole graph, so PruneBranches picks it afresh on a
+    # copy for every update, staged as in ParallelAnalysisManager.
+    #
+    # Lines are tracked by their def: a use targets the line defining what
+    # it reads, -1 for an input and -2 for a value coming in over a back
+    # edge. A line whose text is kept but whose targets moved, e.g. to a
+    # register definition inserted above it, counts as changed. Nodes the
+    # analysis merged away are followed to the node which took them over.
+    # A line it folded to a constant and dropped comes back as just that
+    # constant for a line rebuilt reading it, not parsed again with all
+    # the lines above it.
+    def __init__(self, ir_file, max_iterations=16, time_budget=None,
+                 saturate=False, full_ratio=0.5):
+        self.ir_file = ir_file
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.full_ratio = full_ratio
+        self.dialect = _Llvm() if ir_file.endswith('.bc') else _Bap()
+        self.passes = pipeline(saturate)
+        self.__local = [i for i, p in enumerate(self.passes)
+                        if not getattr(p, 'whole_graph', False)]
+        self.ast = None
+        self.converged = False
+
+        self.__parser = None
+        self.__merged = {}
+        self.__inputs = {}
+        self.__infos = {}
+        self.__lines = []
+        self.__keys = []
+        self.__names = []
+        self.__uses = []
+        self.__targets = []
+        self.__born = []
+
+    def update(self):
+        # reads the file again, returns what the update took; the graph
+        # kept is big, collections while it is in memory only cost time
+        started = time.monotonic()
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            stats = self.__update()
+        finally:
+            if enabled:
+                gc.enable()
+        stats['seconds'] = time.monotonic() - started
+        return stats
+
+    def __update(self):
+        with open_ir(self.ir_file) as f:
+            lines = list(numbered_inst_lines(f))
+        infos = [self.__info(lineno, text) for lineno, text in lines]
+        state = lines, infos, *self.dialect.replay(infos)
+
+        old = [text for _, text in self.__lines]
+        new = [text for _, text in lines]
+        # the texts of the lines gone are not worth keeping
+        self.__infos = dict(zip(new, infos))
+        try:
+            if self.__parser is None or not self.converged:
+                mode, rebuilt = 'full', self.__full(*state)
+            elif old == new:
+                mode, rebuilt = 'unchanged', 0
+            else:
+                mode, rebuilt = 'incremental', \
+                    self.__incremental(_match(old, new), *state)
+                if rebuilt is None:
+                    mode, rebuilt = 'full', self.__full(*state)
+        except Exception:
+            # half way through, nothing is left worth keeping
+            self.__parser = None
+            raise
+        return dict(mode=mode, lines=len(lines), rebuilt=rebuilt,
+                    nodes=len(self.ast))
+
+    def __info(self, lineno, text):
+        info = self.__infos.get(text)
+        if info is None:
+            info = self.__infos[text] = self.dialect.def_use(lineno, text)
+        return info
+
+    def __full(self, lines, infos, names, uses, targets):
+        self.__parser = parser_factory(self.ir_file)
+        self.__parser.ast.track_merges()
+        self.__merged, self.__inputs = {}, {}
+        self.__lines, self.__keys, self.__names, self.__uses, \
+            self.__targets = lines, infos, names, uses, targets
+        self.__born = [None] * len(lines)
+        self.__build(range(len(lines)), set(range(len(lines))))
+        self.__analyze()
+        return len(lines)
+
+    def __incremental(self, match, lines, infos, names, uses, targets):
+        # the lines rebuilt, None if so many are that a full run is cheaper
+        ast = self.__parser.ast
+        new_of = [None] * len(self.__lines)
+        for j, i in enumerate(match):
+            if i >= 0:
+                new_of[i] = j
+
+        # only a kept line reading what a line added or removed defines
+        # may read from another line now
+        cone = {j for j, i in enumerate(match) if i < 0}
+        defined = {infos[j][0] for j in cone}
+        defined.update(self.__keys[i][0] for i, j in enumerate(new_of)
+                       if j is None)
+        for j, info in enumerate(infos):
+            i = match[j]
+            if i >= 0 and not defined.isdisjoint(info[1]) and \
+                    tuple(t if t < 0 else new_of[t]
+                          for t in self.__targets[i]) != targets[j]:
+                cone.add(j)
+
+        # what an edit reaches, the changed lines and their users
+        users = [[] for _ in lines]
+        for j, ts in enumerate(targets):
+            for t in ts:
+                if t >= 0:
+                    users[t].append(j)
+        worklist = list(cone)
+        while worklist:
+            for u in users[worklist.pop()]:
+                if u not in cone:
+                    cone.add(u)
+                    worklist.append(u)
+        if len(cone) > self.full_ratio * len(lines):
+            return None
+
+        # the nodes of the lines gone or reached, with everything using them
+        old = [i for i, j in enumerate(new_of) if j is None or j in cone]
+        seeds = {self.__rep(self.__born[i]) for i in old} - {None}
+        base = DiGraphAnalysisBase()
+        base.run(ast)
+        dead = base.ancestors(seeds)
+        born = [None if i < 0 or j in cone else self.__born[i]
+                for j, i in enumerate(match)]
+        rebuild = set(cone)
+        for j, n in enumerate(born):
+            if n is not None and (n in dead or n in self.__merged and
+                                  self.__rep(n) in dead):
+                rebuild.add(j)
+                born[j] = None
+        # a copy merged into what it reads is dropped for want of users,
+        # it takes its name back once a line rebuilt reads the same
+        read = {r for j in rebuild for r in _reads(uses[j], targets[j])}
+        for j, n in enumerate(born):
+            if n is not None and \
+                    not read.isdisjoint(_reads(uses[j], targets[j])) and \
+                    self.__rep(n) is None and self.__folded(n) is None:
+                rebuild.add(j)
+                born[j] = None
+        if len(rebuild) > self.full_ratio * len(lines):
+            return None
+
+        ast.track_changes()
+        kept = {s for n in dead for s in ast.successors(n)} - dead
+        ast.remove_nodes_from(dead)
+        base.drop_unused(kept)
+
+        # the ssa numbers after an inserted or removed register definition
+        renamed = {}
+        for j, i in enumerate(match):
+            n = born[j]
+            if n is not None and infos[j][0] in defined and \
+                    names[j] != self.__names[i] and \
+                    ast.has_node(n) and ast.name(n) == self.__names[i]:
+                renamed[n] = names[j]
+                if ast.label(n) == self.__names[i]:
+                    ast.set_attr(n, 'label', names[j])
+        ast.relabel_nodes(renamed)
+
+        self.__lines, self.__keys, self.__names, self.__uses, \
+            self.__targets = lines, infos, names, uses, targets
+        self.__born = born
+        built = self.__build(sorted(rebuild), rebuild)
+        self.__analyze(ast.take_changes())
+        return built
+
+    def __build(self, roots, rebuild):
+        # parses the lines in rebuild, and the ones those read from whose
+        # nodes are gone, operands first
+        # a line folded to a constant comes back as just that, see __parse
+        def needed(t):
+            return t in rebuild or self.__rep(self.__born[t]) is None and \
+                self.__folded(self.__born[t]) is None
+
+        done, analyzed = set(), self.__parser.ast.id_bound()
+        for root in roots:
+            if root in done:
+                continue
+            stack, path = [(root, iter(self.__targets[root]))], {root}
+            while stack:
+                j, targets = stack[-1]
+                for t in targets:
+                    if t < 0 or t == j or t in done or not needed(t):
+                        continue
+                    if t in path:
+                        lineno, text = self.__lines[t]
+                        raise ValueError(f'line {lineno}: cyclic use in '
+                                         f'{text!r}')
+                    path.add(t)
+                    stack.append((t, iter(self.__targets[t])))
+                    break
+                else:
+                    stack.pop()
+                    path.discard(j)
+                    self.__parse(j, analyzed)
+                    done.add(j)
+        return len(done)
+
+    def __parse(self, j, analyzed):
+        # the parser links operands by name and would take analyzed nodes,
+        # folded constants say, for vars; hidden from it, they come out as
+        # new leaves the way a fresh parse has them, which the analyzed
+        # nodes then take over, as do the ones merged into other names
+        ast = self.__parser.ast
+        hidden = {}
+        for t, name in zip(self.__targets[j], self.__uses[j]):
+            n = ast.node_id(name)
+            if t != -2 and n is not None and n < analyzed:
+                hidden[name] = n
+        ast.relabel_nodes({n: ast.free_name(f'{name}#hidden')
+                           for name, n in hidden.items()})
+
+        start = ast.id_bound()
+        lineno, text = self.__lines[j]
+        self.dialect.parse(self.__parser, lineno, text, self.__uses[j],
+                           self.__targets[j], self.__names[j])
+        self.__merged.update(ast.take_merges())
+        if self.__names[j] is not None:
+            self.__born[j] = ast.node_id(self.__names[j])
+
+        for t, name in zip(self.__targets[j], self.__uses[j]):
+            n = ast.node_id(name)
+            if t == -2 or n is None or n < start:
+                continue
+            rep = hidden[name] if name in hidden else self.__rep(
+                self.__born[t] if t >= 0 else self.__inputs.get(name))
+            folded = self.__folded(self.__born[t]) if t >= 0 else None
+            if folded is not None:
+                # the line it reads is not parsed again, its value is
+                node = ast.nodes[n]
+                node['ntyp'] = 'c'
+                node['label'] = ast.label(folded)
+                if ast.get_attr(folded, 'typ'):
+                    ast.set_attr(n, 'typ', ast.get_attr(folded, 'typ'))
+                self.__born[t] = n
+            elif rep is None:
+                if t == -1:
+                    self.__inputs[name] = n
+            elif rep != n:
+                ast.merge_node(rep, n)
+                self.__merged.update(ast.take_merges())
+        ast.relabel_nodes(dict(map(reversed, hidden.items())))
+
+    def __rep(self, n):
+        # the node standing for n, None if there is none anymore
+        n = self.__last(n)
+        return n if n is not None and self.__parser.ast.has_node(n) else None
+
+    def __folded(self, n):
+        # the constant the analysis folded n to and then dropped, as nothing
+        # used it anymore; None if it is still there or was anything else
+        n = self.__last(n)
+        ast = self.__parser.ast
+        if n is None or ast.has_node(n) or ast.ntyp(n) != 'c':
+            return None
+        return n
+
+    def __last(self, n):
+        # the node n was merged into last, if any
+        if n is None:
+            return None
+        path = []
+        while n in self.__merged:
+            path.append(n)
+            n = self.__merged[n]
+        for m in path[:-1]:
+            self.__merged[m] = n
+        return n
+
+    def __analyze(self, changed=None):
+        ast = self.__parser.ast
+        manager = AnalysisManager([self.passes[i] for i in self.__local],
+                                  self.max_iterations, self.time_budget)
+        if changed is None:
+            manager(ast)
+        else:
+            manager(ast, settled=len(self.__local), changed=changed)
+        self.__merged.update(ast.take_merges())
+        self.converged = manager.converged
+
+        # ties go to the line defined first, as in a fresh parse; the copy
+        # numbers the nodes anew, names stay
+        line_of = {name: j for j, name in enumerate(self.__names)}
+        out = ast.copy()
+        for p in self.passes:
+            if hasattr(p, 'rank'):
+                p.rank = lambda n: (line_of.get(out.name(n), len(line_of)),
+                                    n)
+        manager = AnalysisManager(self.passes, self.max_iterations,
+                                  self.time_budget)
+        self.ast = manager(out, settled=self.__local)
+        self.converged = self.converged and manager.converged
+
+
+class _Bap:
+    # a use reads the last definition above it, numbered by the count of
+    # those of its register
+    @staticmethod
+    def def_use(lineno, text):
+        return bap_ir_parser.def_use(lineno, text)
+
+    @staticmethod
+    def replay(infos):
+        names, uses, targets = [], [], []
+        count, last = {}, {}
+        for j, (reg, regs) in enumerate(infos):
+            uses.append(tuple([f'{r}.{count.get(r, 0)}' for r in regs]))
+            targets.append(tuple([last.get(r, -1) for r in regs]))
+            count[reg] = n = count.get(reg, 0) + 1
+            last[reg] = j
+            names.append(f'{reg}.{n}')
+        return names, uses, targets
+
+    @staticmethod
+    def parse(parser, lineno, text, uses, targets, name):
+        ssa = {use.rpartition('.')[0]: int(use.rpartition('.')[2])
+               for use in uses}
+        reg, _, num = name.rpartition('.')
+        ssa[reg] = int(num) - 1
+        parser.parse_line(lineno, text, ssa)
+
+
+class _Llvm:
+    # a use reads the definition wherever it is, a phi the ones further
+    # down over a back edge
+    @staticmethod
+    def def_use(lineno, text):
+        return llvm_ir_parser.def_use(lineno, text)
+
+    @staticmethod
+    def replay(infos):
+        where = {}
+        for j, (var, _, _) in enumerate(infos):
+            if var is not None:
+                where.setdefault(var, j)
+
+        names, uses, targets = [], [], []
+        for j, (var, values, phi) in enumerate(infos):
+            names.append(None if var is None else f'${var[1:]}')
+            ts = [where.get(v, -1) for v in values]
+            if phi:
+                ts = [-2 if t < 0 or t > j else t for t in ts]
+            targets.append(tuple(ts))
+            uses.append(tuple([f'${v[1:]}@phi' if t == -2 else f'${v[1:]}'
+                               for v, t in zip(values, ts)]))
+        return names, uses, targets
+
+    @staticmethod
+    def parse(parser, lineno, text, uses, targets, name):
+        later = {f'%{use[1:-4]}' for use, t in zip(uses, targets) if t == -2}
+        parser.parse_line(lineno, text, later)
+
+
+def _reads(uses, targets):
+    # the lines a line reads from, by name for the inputs
+    return {t if t >= 0 else use for use, t in zip(uses, targets) if t != -2}
+
+
+def _match(old, new):
+    # for every new line the index of the old one it is kept as, -1 for
+    # the ones added; only what lies between the common head and tail is
+    # diffed
+    head, n = 0, min(len(old), len(new))
+    while head < n and old[head] == new[head]:
+        head += 1
+    tail = 0
+    while tail < n - head and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+
+    match = list(range(head)) + [-1] * (len(new) - head - tail) + \
+        list(range(len(old) - tail, len(old)))
+    a, b = old[head:len(old) - tail], new[head:len(new) - tail]
+    if a and b:
+        matcher = SequenceMatcher(None, a, b, autojunk=False)
+        for i, j, size in matcher.get_matching_blocks():
+            match[head + j:head + j + size] = range(head + i, head + i + size)
+    return match
+
+
+def watch(ir_file, tag='ana-watch', fmt='dot', interval=0.5,
+          max_iterations=16, time_budget=None, saturate=False):
+    # analyzes ir_file and renders it again whenever it changes, small
+    # edits only cost what they reach; stop with ctrl-c
+    tag = f'-{tag}' if tag else tag
+    save_file = f'{ir_file}{tag}'
+    formats = list(dict.fromkeys(['dot', *parse_formats(fmt)]))
+    analysis = IncrementalAnalysis(ir_file, max_iterations, time_budget,
+                                   saturate)
+    seen = None
+    while True:
+        try:
+            stat = os.stat(ir_file)
+            stamp = stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            # editors replace a file by moving another one over it
+            stamp = seen
+        if stamp != seen:
+            seen = stamp
+            try:
+                stats = analysis.update()
+            except Exception as e:
+                # e.g. a file half written or being replaced, the last good
+                # rendering stays and the next update is a full one
+                print(f'{ir_file}: {type(e).__name__}: {e}', flush=True)
+            else:
+                if stats['mode'] != 'unchanged':
+                    ASTDrawer(analysis.ast).render(save_file, formats)
+                print(f'{stats["mode"]}: {stats["rebuilt"]} of '
+                      f'{stats["lines"]} lines, {stats["nodes"]} nodes in '
+                      f'{stats["seconds"]:.3f}s', flush=True)
+        time.sleep(interval)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, lines):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    @staticmethod
+    def forms(ast):
+        from analysis.value_numbering import commutative_ops
+
+        # hash consing orders commutative operands by node id
+        def walk(n):
+            oprs = [walk(s) for s in ast.successors(n)]
+            if ast.label(n) in commutative_ops:
+                oprs.sort(key=repr)
+            return (ast.label(n), *oprs) if oprs else ast.label(n)
+        return {ast.name(n): walk(n) for n in ast
+                if '#' not in ast.name(n)}
+
+    @staticmethod
+    def shapes(ast):
+        from analysis.value_numbering import commutative_ops
+
+        # the forms of the entries up to the names of the vars; of the
+        # vars found to hold the same value, the one keeping its name
+        # depends on the order the passes meet them in
+        def walk(n):
+            oprs = sorted((walk(s) for s in ast.successors(n)), key=repr) \
+                if ast.label(n) in commutative_ops else \
+                [walk(s) for s in ast.successors(n)]
+            label = 'v' if ast.ntyp(n) == 'v' else ast.label(n)
+            return (label, *oprs) if oprs else label
+        return sorted((walk(n) for n in ast if ast.in_degree[n] == 0),
+                      key=repr)
+
+    def assertUpdates(self, name, versions):
+        # every version updated into the same graph as analyzed afresh
+        analysis = IncrementalAnalysis(self.write(name, versions[0]),
+                                       full_ratio=1)
+        self.assertEqual('full', analysis.update()['mode'])
+        for lines in versions[1:]:
+            path = self.write(name, lines)
+            self.assertEqual('incremental', analysis.update()['mode'])
+            fresh = IncrementalAnalysis(path)
+            fresh.update()
+            self.assertEqual(self.forms(fresh.ast), self.forms(analysis.ast))
+        return analysis
+
+    def test_bap(self):
+        block = ['00000001: RAX := RDI ^ RSI',
+                 '00000002: RBX := RAX & RSI',
+                 '00000003: RAX := RBX + 1',
+                 '00000004: RCX := RAX | 0',
+                 '00000005: RDX := RCX - RAX']
+        inserted = block[:1] + ['00000006: RAX := RAX + RDX'] + block[1:]
+        edited = inserted[:4] + ['00000003: RAX := RBX ^ RBX'] + inserted[5:]
+        appended = edited + ['00000007: RSI := RDX & RAX']
+        removed = appended[:1] + appended[2:]
+        analysis = self.assertUpdates('block.bir', [
+            block, inserted, edited, appended, removed])
+        self.assertEqual(['RAX.1', 'RAX.2', 'RBX.1', 'RDI.0', 'RSI.0'],
+                         sorted(self.forms(analysis.ast)))
+
+    def test_main_entry_removed(self):
+        # the line PruneBranches kept goes, the one it dropped is the main
+        # entry now
+        block = ['00000000: RCX := RSI - 2',
+                 '00000001: RBX := RBX ^ 1']
+        analysis = self.assertUpdates('block.bir', [block, block[1:]])
+        self.assertEqual(('RBX.1', ('^', '1', 'RBX.0')),
+                         self.forms(analysis.ast)['RBX.1'])
+
+    def test_random_edits(self):
+        import random
+
+        rng = random.Random(0)
+        regs, ops = ['RAX', 'RBX', 'RCX', 'RSI'], ['+', '-', '^', '&', '|']
+
+        def line(addr):
+            return f'{addr:08x}: {rng.choice(regs)} := ' \
+                f'{rng.choice(regs + ["0", "1", "2"])} {rng.choice(ops)} ' \
+                f'{rng.choice(regs + ["1", "2"])}'
+
+        for case in range(100):
+            lines = [line(i) for i in range(rng.randint(2, 8))]
+            path = self.write('random.bir', lines)
+            analysis = IncrementalAnalysis(path, full_ratio=1)
+            analysis.update()
+            for _ in range(3):
+                edit = rng.randrange(3)
+                if edit == 0 or len(lines) < 2:
+                    lines.insert(rng.randint(0, len(lines)),
+                                 line(0x100 + rng.randrange(0x100)))
+                elif edit == 1:
+                    del lines[rng.randrange(len(lines))]
+                else:
+                    lines[rng.randrange(len(lines))] = \
+                        line(0x200 + rng.randrange(0x100))
+                self.write('random.bir', lines)
+                analysis.update()
+                fresh = IncrementalAnalysis(path)
+                fresh.update()
+                self.assertEqual(self.shapes(fresh.ast),
+                                 self.shapes(analysis.ast),
+                                 f'case {case}: {lines}')
+
+    def test_llvm(self):
+        block = ['%1 = xor i32 %a, %b',
+                 '%2 = and i32 %1, %b',
+                 'loop:',
+                 '%i = phi i32 [ 0, %entry ], [ %n, %loop ]',
+                 '%n = add i32 %i, %2',
+                 '%3 = or i32 %n, 0']
+        edited = block[:1] + ['%2 = and i32 %1, 4294967295'] + block[2:]
+        defined = ['%b = add i32 %c, 1'] + edited
+        self.assertUpdates('block.bc', [block, edited, defined, block])
+
+    def test_insert_cost(self):
+        from bench import check
+        from synth import bap_block
+
+        # a line inserted near the end rebuilds no more than the lines
+        # below it, and the update grows no faster than the file
+        results = {}
+        for size in (1000, 4000):
+            lines = bap_block(size).splitlines()
+            path = self.write('big.bir', lines)
+            analysis = IncrementalAnalysis(path)
+            full = analysis.update()
+            reg, _ = bap_ir_parser.def_use(0, lines[-20])
+            self.write('big.bir', lines[:-20] + [f'000fffff: {reg} := '
+                                                 f'{reg} + 1'] + lines[-20:])
+            update = analysis.update()
+            self.assertEqual('incremental', update['mode'])
+            self.assertLessEqual(update['rebuilt'], 21)
+            self.assertLess(update['seconds'], full['seconds'] / 4)
+            results[str(size)] = {'seconds': update['seconds']}
+        self.assertEqual([], check({'bir': {'watch update': results}}))
+
+    def test_unchanged_and_errors(self):
+        path = self.write('block.bir', ['00000001: RAX := RDI ^ RSI'])
+        analysis = IncrementalAnalysis(path)
+        analysis.update()
+        self.assertEqual('unchanged', analysis.update()['mode'])
+        self.write('block.bir', ['00000001: RAX = RDI'])
+        with self.assertRaises(ValueError):
+            analysis.update()
+
+        # a full run failing half way is not built on
+        def block(first, k):
+            return [first, f'%2 = mul i32 %1, {k}'] + \
+                [f'%{i} = mul i32 %a, {k}' for i in range(3, 12)]
+
+        path = self.write('block.bc', block('%1 = add i32 %a, 1', 1))
+        analysis = IncrementalAnalysis(path)
+        analysis.update()
+        self.write('block.bc', block('%1 = add i32 %2, 1', 3))
+        with self.assertRaises(ValueError):
+            analysis.update()
+        self.write('block.bc', block('%1 = add i32 %a, 1', 3))
+        self.assertEqual('full', analysis.update()['mode'])
+
+
+if __name__ == '__main__':
+    # fire takes as long to import as the rest, only the cli pays for it
+    import fire
+
+    fire.Fire(watch)